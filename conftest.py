@@ -0,0 +1,47 @@
+"""
+Shared pytest fixtures: a two-image COCO layout and an untrained tiny checkpoint for the CLI smoke tests.
+"""
+import json
+
+import pytest
+import torch
+from PIL import Image
+
+
+def _write_split(root, split, num_images=2, size=(96, 64)):
+    folder = root / f"{split}2017"
+    folder.mkdir()
+    images, annotations = [], []
+    for i in range(1, num_images + 1):
+        Image.new("RGB", size, color=(40 * i, 80, 120)).save(folder / f"{i:012d}.jpg")
+        images.append({"id": i, "file_name": f"{i:012d}.jpg", "width": size[0], "height": size[1]})
+        annotations.append({"id": i, "image_id": i, "category_id": 1, "bbox": [8., 8., 32., 24.],
+                            "area": 32. * 24., "iscrowd": 0})
+    with open(root / "annotations" / f"instances_{split}2017.json", "w") as f:
+        json.dump({"images": images, "annotations": annotations,
+                   "categories": [{"id": 1, "name": "person", "supercategory": "person"}]}, f)
+
+
+@pytest.fixture(scope="session")
+def coco_path(tmp_path_factory):
+    """ A COCO root with two images and one box each in train2017 and val2017 """
+    root = tmp_path_factory.mktemp("coco")
+    (root / "annotations").mkdir()
+    for split in ("train", "val"):
+        _write_split(root, split)
+    return root
+
+
+@pytest.fixture(scope="session")
+def tiny_checkpoint(tmp_path_factory):
+    """ An untrained tiny detector built from the default args, saved like main.py saves checkpoints """
+    from main import get_args_parser, set_input_size
+    from models import build_model
+
+    args = get_args_parser().parse_args(["--model_name", "tiny", "--device", "cpu"])
+    set_input_size(args)
+    torch.manual_seed(0)
+    model, _, _ = build_model(args)
+    path = tmp_path_factory.mktemp("checkpoint") / "tiny.pth"
+    torch.save({"model": model.state_dict(), "args": args}, path)
+    return path
@@ -163,18 +163,24 @@ def make_coco_transforms(image_set, args):
     #         normalize,
     #     ])
 
-    print(f"uniformed size: {args.img_size}")
+    if getattr(args, 'keep_ratio', False):
+        print(f"aspect-preserving size: {args.img_size} (multiple of {args.size_divisibility})")
+        resize = T.ResizeToGrid(args.img_size, args.size_divisibility)
+    else:
+        print(f"uniformed size: {args.img_size}")
+        resize = T.Resize(args.img_size)
+
     if image_set == 'train':
         return T.Compose([
             T.RandomHorizontalFlip(),
-            T.Resize(args.img_size),
+            resize,
             # T.RandomResize([size_list]),
             normalize,
         ])
 
     if image_set == 'val':
         return T.Compose([
-            T.Resize(args.img_size),
+            resize,
             # T.RandomResize([size_list]),
             normalize,
         ])
@@ -202,8 +202,13 @@ class RandomHorizontalFlip(object):
         self.p = p
 
     def __call__(self, img, target):
-        if random.random() < self.p:
-            return hflip(img, target)
+        flipped = random.random() < self.p
+        if flipped:
+            img, target = hflip(img, target)
+        else:
+            target = target.copy()
+        # the augmentation variant of the sample, it keys the cached encoder features (util.feature_store)
+        target["flipped"] = torch.tensor(int(flipped))
         return img, target
 
 
@@ -229,6 +234,24 @@ class Resize(object):
         return resize(img, target, self.size, max_size=None)
 
 
+class ResizeToGrid(object):
+    """
+    Keeps the aspect ratio instead of squashing to a square: the longer side becomes `max_size`
+    and both sides are rounded to a multiple of `divisor` (the encoder's size divisibility).
+    """
+    def __init__(self, max_size, divisor):
+        assert max_size % divisor == 0, f"max_size {max_size} is not a multiple of {divisor}"
+        self.max_size = max_size
+        self.divisor = divisor
+
+    def __call__(self, img, target=None):
+        w, h = img.size
+        scale = self.max_size / max(w, h)
+        ow = max(self.divisor, int(round(w * scale / self.divisor)) * self.divisor)
+        oh = max(self.divisor, int(round(h * scale / self.divisor)) * self.divisor)
+        return resize(img, target, (ow, oh), max_size=None)
+
+
 class RandomPad(object):
     def __init__(self, max_pad):
         self.max_pad = max_pad
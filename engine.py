@@ -12,6 +12,10 @@ import torch
 import util.misc as utils
 from datasets.coco_eval import CocoEvaluator
 
+
+def _neck(model):
+    return getattr(model, 'module', model).backbone
+
 # def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 #                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
 #                     device: torch.device, epoch: int, max_norm: float = 0):
@@ -72,7 +76,7 @@ from datasets.coco_eval import CocoEvaluator
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0):
+                    device: torch.device, epoch: int, max_norm: float = 0, feature_store=None):
     model.train()
     criterion.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -80,6 +84,10 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     metric_logger.add_meter('class_error', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 100
+    if feature_store is not None:
+        # frozen encoder, see `Detector.freeze_encoder`
+        encoder = getattr(model, 'module', model).backbone.encoder
+        metric_logger.add_meter('feature_hit', utils.SmoothedValue(window_size=print_freq, fmt='{avg:.2f}'))
 
     # count = 0
 
@@ -88,10 +96,20 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         # count += 1
         # if count == 10: break
 
-        samples = samples.to(device)
+        if feature_store is None:
+            samples = samples.to(device)
+            outputs = model(samples)
+        else:
+            rows = feature_store.rows(targets)
+            features = feature_store.get(rows, device)
+            metric_logger.update(feature_hit=float(features is not None))
+            if features is None:
+                with torch.no_grad():
+                    features = encoder(samples.to(device).tensors)
+                feature_store.put(rows, features)
+            outputs = model(None, features=features)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        outputs = model(samples)
         loss_dict = criterion(outputs, targets)
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
@@ -120,6 +138,9 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
         metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+    if feature_store is not None:
+        feature_store.flush()
+    metric_logger.update(pos_interpolations=_neck(model).pos_interpolations)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -158,6 +179,9 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
                              **loss_dict_reduced_scaled,
                              **loss_dict_reduced_unscaled)
         metric_logger.update(class_error=loss_dict_reduced['class_error'])
+        if 'exit_depth' in outputs:
+            # mean number of neck blocks run per image
+            metric_logger.update(exit_depth=outputs['exit_depth'].float().mean().item())
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
         results = postprocessors['bbox'](outputs, orig_target_sizes)
@@ -168,6 +192,7 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         if coco_evaluator is not None:
             coco_evaluator.update(res)
 
+    metric_logger.update(pos_interpolations=_neck(model).pos_interpolations)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -18,6 +18,8 @@ from engine import evaluate, train_one_epoch
 from models import build_model as build_tssd
 
 from util.scheduler import create_scheduler
+from util.checkpoint_planner import plan_for_budget
+from util.feature_store import FeatureStore
 
 
 def get_args_parser():
@@ -29,12 +31,16 @@ def get_args_parser():
     parser.add_argument('--epochs', default=150, type=int)
     # parser.add_argument('--eval_size', default=800, type=int)
     parser.add_argument('--img_size', default=672, type=int)
+    parser.add_argument('--keep_ratio', action='store_true',
+                        help='keep the aspect ratio (longer side = img_size) instead of resizing to a square')
 
     parser.add_argument('--clip_max_norm', default=0.1, type=float,
                         help='gradient clipping max norm')
 
     parser.add_argument('--use_checkpoint', action='store_true',
                         help='use checkpoint.checkpoint to save mem')
+    parser.add_argument('--checkpoint_budget', default=0, type=int,
+                        help='activation memory budget in MiB, checkpoint only the cheapest blocks to fit it')
     # scheduler
     # Learning rate schedule parameters
     parser.add_argument('--sched', default='warmupcos', type=str, metavar='SCHEDULER',
@@ -69,6 +75,50 @@ def get_args_parser():
                         help='pre-train weight of neck')
     parser.add_argument('--encoder_pt', default='',
                         help='pre-train weight of encoder')
+    parser.add_argument('--encoder_attn', default='naive', type=str, choices=['naive', 'sdpa', 'chunked'],
+                        help="window attention backend of the swin encoder")
+    parser.add_argument('--neck_attn', default='naive', type=str, choices=['naive', 'sdpa', 'chunked'],
+                        help="attention backend of the deit neck")
+    parser.add_argument('--merge_ratio', default=[0.], nargs='+', type=float,
+                        help="fraction of the neck patch tokens merged after each block (token merging), "
+                             "one value for all blocks or one per block")
+    parser.add_argument('--det_only_blocks', default=0, type=int,
+                        help="number of last neck blocks that only update the det tokens (cross-attention "
+                             "to the patch tokens of the block before)")
+    parser.add_argument('--keep_tokens', default=0, type=int,
+                        help="patch tokens kept per image by a learned scoring head before the neck, 0 keeps all")
+    parser.add_argument('--neck_window', default=0, type=int,
+                        help="structured sparse neck attention: patch tokens attend to this local window of their "
+                             "scale plus cross-scale anchors, 0 is dense")
+    parser.add_argument('--linear_blocks', default=None, type=int, nargs='+',
+                        help="indices of the neck blocks with kernelized linear attention (e.g. 0 1 2 3 4 5 6 7), "
+                             "the weights are shared with softmax attention, so dense checkpoints fine-tune")
+    parser.add_argument('--post_top_k', default=0, type=int,
+                        help="post-processing keeps the top k (det token, class) pairs per image, 0 keeps one "
+                             "detection per det token")
+    parser.add_argument('--post_score_threshold', default=0., type=float,
+                        help="post-processing drops the detections scored at most this")
+    parser.add_argument('--post_nms_threshold', default=0., type=float,
+                        help="class-aware NMS IoU threshold of the post-processing, 0 disables NMS")
+    parser.add_argument('--exit_blocks', default=None, type=int, nargs='+',
+                        help="neck blocks followed by auxiliary (shared) heads, trained with auxiliary losses")
+    parser.add_argument('--exit_threshold', default=0., type=float,
+                        help="early exit at the exit blocks once all det token classes are stable with at least "
+                             "this probability, 0 disables it")
+    parser.add_argument('--window_layout', action='store_true',
+                        help="keep encoder activations in window-major order inside each stage")
+    parser.add_argument('--num_list', default=None, nargs=4, type=int,
+                        help="pooled tokens per encoder scale, 0 drops a scale (default: 169/225/289 per scale)")
+    parser.add_argument('--neck_tokens', default=None, type=int,
+                        help="total neck token budget spread evenly over the scales, overrides --num_list")
+    parser.add_argument('--exit_stage', default=None, type=int, choices=[2, 3, 4],
+                        help="run the encoder up to this stage only and feed its scales to the neck (latency tier)")
+    parser.add_argument('--freeze_encoder', action='store_true',
+                        help="freeze the swin encoder, only the neck and heads are trained")
+    parser.add_argument('--feature_cache', default='', type=str,
+                        help="directory of the memory-mapped encoder feature store, implies --freeze_encoder")
+    parser.add_argument('--feature_cache_dtype', default='float32', type=str, choices=['float32', 'float16'],
+                        help="storage dtype of the feature store")
     # parser.add_argument('--init_pe_size', nargs='+', type=int,
     #                     help="init pe size (h,w)")
     # parser.add_argument('--mid_pe_size', nargs='+', type=int,
@@ -81,6 +131,15 @@ def get_args_parser():
                         help="L1 box coefficient in the matching cost")
     parser.add_argument('--set_cost_giou', default=2, type=float,
                         help="giou box coefficient in the matching cost")
+    parser.add_argument('--matcher_workers', default=0, type=int,
+                        help="threads solving the per-image assignments of the matcher concurrently, 0 is serial")
+    parser.add_argument('--matcher_solver', default='scipy', choices=['scipy', 'auction'],
+                        help="assignment solver of the matcher, auction runs batched on the training device")
+    parser.add_argument('--auction_eps', default=1e-3, type=float,
+                        help="final bid increment of the epsilon-scaled auction solver (optimality gap per matched "
+                             "target)")
+    parser.add_argument('--matcher_memory_mb', default=256, type=float,
+                        help="memory budget of the matching cost temporaries, computed by blocks of targets")
     # * Loss coefficients
 
     parser.add_argument('--dice_loss_coef', default=1, type=float)
@@ -130,6 +189,12 @@ def main(args):
     model, criterion, postprocessors = build_tssd(args)
     # model, criterion, postprocessors = build_model(args)
     model.to(device)
+    if args.freeze_encoder or args.feature_cache:
+        model.freeze_encoder()
+    if args.checkpoint_budget > 0 and not args.eval:
+        # dry run on a single image, activations scale linearly with the batch size
+        samples = torch.randn(1, 3, args.img_size, args.img_size, device=device)
+        plan_for_budget(model, samples, args.checkpoint_budget * 2 ** 20, batch_size=args.batch_size)
 
     model_without_ddp = model
     if args.distributed:
@@ -207,6 +272,18 @@ def main(args):
             args.start_epoch = checkpoint['epoch'] + 1
             print("\tresumed!\n")
 
+    feature_store = None
+    if args.feature_cache and not args.eval:
+        if getattr(args, 'keep_ratio', False):
+            raise ValueError("--feature_cache needs a fixed input size, it cannot be used with --keep_ratio")
+        encoder = model_without_ddp.backbone.encoder
+        # weights (after resuming), input size and pooling identify the cached features
+        checksum = sum(p.double().sum().item() for p in encoder.parameters())
+        tag = f"{args.img_size}-{encoder.num_list[:encoder.exit_stage]}-{checksum:.10e}"
+        feature_store = FeatureStore(args.feature_cache, dataset_train.ids,
+                                     list(zip(encoder.num_list, encoder.dim_list))[:encoder.exit_stage],
+                                     tag=tag, dtype=args.feature_cache_dtype)
+
     if args.eval:
         test_stats, coco_evaluator = evaluate(model, criterion, postprocessors,
                                               data_loader_val, base_ds, device, args.output_dir)
@@ -221,7 +298,7 @@ def main(args):
             sampler_train.set_epoch(epoch)
         train_stats = train_one_epoch(
             model, criterion, data_loader_train, optimizer, device, epoch,
-            args.clip_max_norm)
+            args.clip_max_norm, feature_store=feature_store)
         lr_scheduler.step(epoch)
         if args.output_dir:
             checkpoint_paths = [output_dir / 'checkpoint.pth']
@@ -266,20 +343,27 @@ def main(args):
     print('Training time {}'.format(total_time_str))
 
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser('ConvTention Detector train & eval script', parents=[get_args_parser()])
-    args = parser.parse_args()
-
+def set_input_size(args):
+    # size_divisibility: patch_size * 2^3 * window_size of the encoder
     if args.model_name == "tiny":
         args.img_size = 672
+        args.size_divisibility = 224
     elif args.model_name == "small":
         args.img_size = 672
+        args.size_divisibility = 224
     elif args.model_name == "base":
         args.img_size = 768
+        args.size_divisibility = 384
     else:
         raise ValueError(f"{args.model_name} does not exists!")
 
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('ConvTention Detector train & eval script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    set_input_size(args)
+
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
     main(args)
@@ -0,0 +1,150 @@
+# ---*--- File Information ---*---
+# @File       :  attention.py
+# @Date&Time  :  2026-10-16, 10:12:40
+# @Project    :  swin-ssd
+# @Software   :  PyCharm
+# @Author     :  yoc
+# @Email      :  yyyyyoc@hotmail.com
+
+
+import torch
+import torch.nn.functional as F
+
+# naive:   q @ k^T -> + bias/mask -> softmax -> @ v, the original implementation
+# sdpa:    torch.nn.functional.scaled_dot_product_attention with a single additive mask
+# chunked: the naive math evaluated slice by slice, so only one slice of scores is alive at a time
+# (the neck can additionally switch blocks to `linear_attention`, an approximation, see `linear_attention`)
+ATTN_BACKENDS = ("naive", "sdpa", "chunked")
+
+
+def check_attn_backend(backend):
+    if backend not in ATTN_BACKENDS:
+        raise ValueError(f"attention backend `{backend}` does not exist! (options: {ATTN_BACKENDS})")
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise ValueError("attention backend `sdpa` needs torch>=2.0")
+    return backend
+
+
+def sdpa_attention(q, k, v, attn_mask=None, scale=None, dropout_p=0.):
+    """
+    Args:
+        q, k, v: (..., L, d)
+        attn_mask: additive float mask broadcastable to (..., Lq, Lk) or None
+        scale (float): qk scale, None for d ** -0.5
+        dropout_p (float): attention dropout, pass 0 in eval mode
+    """
+    if attn_mask is not None:
+        attn_mask = attn_mask.to(q.dtype)
+    # the `scale` kwarg of sdpa needs torch>=2.1, a custom scale is folded into q on top of the default d ** -0.5
+    if scale is not None and scale != q.shape[-1] ** -0.5:
+        q = q * (scale * q.shape[-1] ** 0.5)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+
+def chunked_attention(q, k, v, attn_mask=None, scale=None, dropout_p=0., chunk_size=64, dim=-2):
+    """ Exact attention evaluated over slices of `dim`, peak score memory is bounded by `chunk_size`.
+
+    Args:
+        q, k, v: (..., L, d)
+        attn_mask: additive float mask broadcastable to (..., Lq, Lk) or None
+        scale (float): qk scale, None for d ** -0.5
+        dropout_p (float): attention dropout, pass 0 in eval mode
+        chunk_size (int): slice length along `dim`
+        dim (int): negative dim to slice. -2 slices queries only, any batch dim slices q, k, v and the mask
+    """
+    assert dim < 0, "chunk dim must be counted from the end"
+    scale = scale if scale is not None else q.shape[-1] ** -0.5
+    slice_kv = dim != -2
+    # the mask is right-aligned with the scores, it is only sliced if it is not broadcast along `dim`
+    slice_mask = attn_mask is not None and attn_mask.dim() >= -dim and attn_mask.shape[dim] > 1
+
+    out = []
+    for start in range(0, q.shape[dim], chunk_size):
+        length = min(chunk_size, q.shape[dim] - start)
+        q_c = q.narrow(dim, start, length)
+        k_c = k.narrow(dim, start, length) if slice_kv else k
+        v_c = v.narrow(dim, start, length) if slice_kv else v
+
+        attn = (q_c * scale) @ k_c.transpose(-2, -1)
+        if attn_mask is not None:
+            attn = attn + (attn_mask.narrow(dim, start, length) if slice_mask else attn_mask)
+        attn = attn.softmax(dim=-1)
+        if dropout_p > 0.:
+            attn = F.dropout(attn, p=dropout_p)
+        out.append(attn @ v_c)
+    return torch.cat(out, dim=dim)
+
+
+def local_anchor_index(grids, window=3, num_head=1):
+    """ Keys of every patch token in the structured sparse attention of the neck.
+
+    The patch tokens are laid out scale after scale (row-major `gh x gw` grids) behind `num_head` leading tokens.
+    A patch token attends to the `window x window` neighbourhood in its own grid (shifted inwards at the borders,
+    so that every token has the same number of keys), to the token at the same relative position in every other
+    scale (cross-scale anchors) and to the leading tokens.
+
+    Args:
+        grids (list[tuple[int]]): (gh, gw) of every scale, empty scales are skipped
+        window (int): side of the local neighbourhood, clipped to the smallest grid
+        num_head (int): leading tokens (cls)
+    Returns:
+        (L, K) long tensor of sequence positions, L = sum(gh * gw)
+    """
+    grids = [tuple(g) for g in grids if g[0] * g[1] > 0]
+    wh = min([window] + [gh for gh, _ in grids])
+    ww = min([window] + [gw for _, gw in grids])
+    offsets, offset = [], num_head
+    for gh, gw in grids:
+        offsets.append(offset)
+        offset += gh * gw
+
+    index = []
+    for s, ((gh, gw), start) in enumerate(zip(grids, offsets)):
+        i, j = torch.meshgrid(torch.arange(gh), torch.arange(gw), indexing="ij")
+        i, j = i.reshape(-1, 1), j.reshape(-1, 1)
+        i0 = (i - wh // 2).clamp(0, gh - wh)
+        j0 = (j - ww // 2).clamp(0, gw - ww)
+        di, dj = torch.meshgrid(torch.arange(wh), torch.arange(ww), indexing="ij")
+        keys = [start + (i0 + di.reshape(1, -1)) * gw + j0 + dj.reshape(1, -1)]
+        for t, ((th, tw), t_start) in enumerate(zip(grids, offsets)):
+            if t != s:
+                ti = ((i * 2 + 1) * th // (gh * 2)).clamp(max=th - 1)
+                tj = ((j * 2 + 1) * tw // (gw * 2)).clamp(max=tw - 1)
+                keys.append(t_start + ti * tw + tj)
+        keys.append(torch.arange(num_head).expand(gh * gw, -1))
+        index.append(torch.cat(keys, dim=1))
+    return torch.cat(index, dim=0)
+
+
+def gathered_attention(q, k, v, index, scale=None, dropout_p=0.):
+    """ Every query attends to its own keys only, the (Lq, Lk) scores are never built.
+
+    Args:
+        q: (..., Lq, d)
+        k, v: (..., Lk, d)
+        index: (Lq, K) key positions of every query
+        scale (float): qk scale, None for d ** -0.5
+        dropout_p (float): attention dropout, pass 0 in eval mode
+    """
+    scale = scale if scale is not None else q.shape[-1] ** -0.5
+    k, v = k[..., index, :], v[..., index, :]  # ..., Lq, K, d
+    attn = ((q * scale).unsqueeze(-2) @ k.transpose(-2, -1)).squeeze(-2)
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0.:
+        attn = F.dropout(attn, p=dropout_p)
+    return (attn.unsqueeze(-2) @ v).squeeze(-2)
+
+
+def linear_attention(q, k, v, eps=1e-6):
+    """ Kernelized attention in O(L d^2): softmax(q k^T) is replaced by phi(q) phi(k)^T, phi = elu + 1
+    ("Transformers are RNNs", Katharopoulos et al., ICML 2020). No extra weights, so the blocks of a dense
+    checkpoint can be switched and fine-tuned.
+
+    Args:
+        q: (..., Lq, d)
+        k, v: (..., Lk, d)
+    """
+    q, k = F.elu(q) + 1, F.elu(k) + 1
+    kv = k.transpose(-2, -1) @ v  # ..., d, d
+    normalizer = q @ k.sum(dim=-2).unsqueeze(-1)  # ..., Lq, 1
+    return (q @ kv) / (normalizer + eps)
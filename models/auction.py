@@ -0,0 +1,204 @@
+# ---*--- File Information ---*---
+# @File       :  auction.py
+# @Date&Time  :  2026-10-17, 09:42:18
+# @Project    :  swin-ssd
+# @Software   :  PyCharm
+# @Author     :  yoc
+# @Email      :  yyyyyoc@hotmail.com
+# batched auction algorithm (Bertsekas) for the matcher, runs on the device of the costs
+
+
+import torch
+
+
+def _top2(values):
+    """ Best and second best of the last dim (the second is -inf if there is one candidate) and the argmax """
+    if values.shape[-1] > 1:
+        top, index = values.topk(2, dim=-1)
+        return top[..., 0], top[..., 1], index[..., 0]
+    return values[..., 0], torch.full_like(values[..., 0], float("-inf")), values.new_zeros(
+        values.shape[:-1], dtype=torch.int64)
+
+
+def _auction(benefit, active, eps, final_eps, scaling, check_every):
+    """ Forward auction (Jacobi bidding: every unassigned bidder bids at once) with epsilon scaling.
+
+    Every image runs its own phases: once all its bidders are assigned and its `eps` is above `final_eps`, the
+    assignment is dropped, the prices are kept and the next phase bids with `eps / scaling` (at least
+    `final_eps`).
+
+    Args:
+        benefit: (B, N, M) benefit of bidder n for object m, N <= M, -inf for the padding objects
+        active: (B, N) bool, the padding bidders never bid
+        eps: (B, 1) bid increment of the first phase of every image
+        final_eps (float): bid increment of the last phase
+        scaling (float): eps ratio between two phases
+    Returns:
+        (B, N) object of every bidder (-1 for the padding bidders), (B, M) prices
+    """
+    B, N, M = benefit.shape
+    bidders = torch.arange(N, device=benefit.device)
+    prices = benefit.new_zeros((B, M))
+    owner = benefit.new_full((B, M), -1, dtype=torch.int64)
+    assigned = benefit.new_full((B, N), -1, dtype=torch.int64)
+    neg_inf = benefit.new_full((), float("-inf"))
+
+    step = 0
+    while True:
+        done = ~(active & (assigned < 0)).any(1, keepdim=True)
+        refine = done & (eps > final_eps)
+        if step % check_every == 0 and bool((done & ~refine).all()):
+            return assigned, prices
+        # next phase of the images done with a coarse eps (on the device, no sync)
+        eps = torch.where(refine, (eps / scaling).clamp(min=final_eps), eps)
+        assigned = torch.where(refine, -1, assigned)
+        owner = torch.where(refine, -1, owner)
+        step += 1
+        bidding = active & (assigned < 0)
+
+        best, second, target = _top2(benefit - prices[:, None, :])
+        # a single object is won by any increment
+        second = torch.where(second > neg_inf, second, best)
+        bid = torch.where(bidding, prices.gather(1, target) + best - second + eps, neg_inf)
+
+        # the highest bid for every object wins, ties go to the lowest bidder
+        high = torch.full_like(prices, float("-inf")).scatter_reduce(1, target, bid, "amax")
+        wins = bidding & (bid == high.gather(1, target))
+        winner = owner.new_full((B, M), N).scatter_reduce(
+            1, target, torch.where(wins, bidders.expand(B, -1), N), "amin")
+        won = winner < N
+
+        # the previous owners of the won objects bid again
+        previous = torch.where(won, owner, -1)
+        b, m = (previous >= 0).nonzero(as_tuple=True)
+        assigned[b, previous[b, m]] = -1
+        b, m = won.nonzero(as_tuple=True)
+        assigned[b, winner[b, m]] = m
+        owner = torch.where(won, winner, owner)
+        prices = torch.where(won, high, prices)
+
+
+def _reverse_auction(benefit, active, valid_objects, assigned, prices, eps, check_every):
+    """ Reverse auction (Jacobi: every offending object bids at once) run after the forward phases.
+
+    Prices carried over from coarser phases can leave unassigned objects more expensive than the cheapest
+    assigned one (`lam`), the assignment is then not eps-optimal. Such an object either drops its price to `lam`
+    or lowers it to attract its best bidder, whose previous object becomes unassigned (Bertsekas, reverse
+    auction for asymmetric assignment). Eps-complementary slackness is kept throughout, it ends with every
+    unassigned object at most at `lam`.
+
+    Args:
+        benefit, active: as `_auction`
+        valid_objects: (B, M) bool, False on the padding objects
+        assigned, prices: output of `_auction`
+        eps (float): bid increment of the last phase
+    Returns:
+        (B, N) object of every bidder
+    """
+    B, N, M = benefit.shape
+    objects = torch.arange(M, device=benefit.device)
+    neg_inf = benefit.new_full((), float("-inf"))
+    owner = assigned.new_full((B, M), -1)
+    b, n = (assigned >= 0).nonzero(as_tuple=True)
+    owner[b, assigned[b, n]] = n
+    taken = owner >= 0
+    lam = torch.where(taken, prices, float("inf")).amin(1, keepdim=True)
+    profit = torch.where(active, benefit.gather(2, assigned.clamp(min=0)[..., None])[..., 0]
+                         - prices.gather(1, assigned.clamp(min=0)), neg_inf)
+
+    step = 0
+    while True:
+        offending = valid_objects & (owner < 0) & (prices > lam)
+        if step % check_every == 0 and not bool(offending.any()):
+            return assigned
+        step += 1
+
+        # value of every object for every bidder, on top of the bidder's current profit
+        best, second, target = _top2(torch.where(active[..., None], benefit - profit[..., None], neg_inf)
+                                     .transpose(1, 2))
+        # no bidder gains eps from it: the price drops to lam and the object stays unassigned
+        drop = offending & (best - eps <= lam)
+        prices = torch.where(drop, lam.expand(-1, M), prices)
+
+        bidding = offending & ~drop
+        price = torch.maximum(lam, second - eps)
+        offer = torch.where(bidding, benefit.gather(1, target[:, None, :])[:, 0] - price, neg_inf)
+        # every bidder accepts its best offer, ties go to the lowest object
+        high = torch.full_like(profit, float("-inf")).scatter_reduce(1, target, offer, "amax")
+        wins = bidding & (offer == high.gather(1, target))
+        winner = owner.new_full((B, N), M).scatter_reduce(
+            1, target, torch.where(wins, objects.expand(B, -1), M), "amin")
+        won = winner < M
+
+        # the previous objects of the won bidders become unassigned, at their price
+        previous = torch.where(won, assigned, -1)
+        b, n = (previous >= 0).nonzero(as_tuple=True)
+        owner[b, previous[b, n]] = -1
+        b, n = won.nonzero(as_tuple=True)
+        owner[b, winner[b, n]] = n
+        assigned = torch.where(won, winner, assigned)
+        profit = torch.where(won, high, profit)
+        accepted = owner.new_zeros((B, M), dtype=torch.bool)
+        accepted[b, winner[b, n]] = True
+        prices = torch.where(accepted, price, prices)
+
+
+@torch.no_grad()
+def auction_assignment(cost, num_rows, num_cols, eps=1e-3, scaling=4., check_every=8):
+    """ Minimum cost assignment of a padded batch of cost matrices.
+
+    Every row is assigned to a distinct column when rows <= columns, else every column to a distinct row (the
+    smaller side is fully matched, as `scipy.optimize.linear_sum_assignment`). The smaller side bids with
+    epsilon scaling: the first phase bids with a quarter of the cost spread of the image, every following one
+    with `scaling` times less, down to `eps`, so the number of iterations grows with log(spread / eps) instead
+    of spread / eps. A reverse auction then lowers the prices left over by the coarser phases on the objects
+    that end unassigned. The total cost of every image is at most `min(rows, cols) * eps` above the optimum
+    (exact for integer costs and eps < 1 / min(rows, cols)).
+
+    The only host syncs are the termination checks every `check_every` iterations: the images are grouped and
+    the result is sliced with the host-side `num_rows` and `num_cols`.
+
+    Args:
+        cost: (B, R, C) padded costs, image i uses cost[i, :num_rows[i], :num_cols[i]]
+        num_rows, num_cols: lists of ints (tensors are copied to the host once)
+        eps (float): bid increment of the last phase, the optimality gap per assigned pair
+        scaling (float): bid increment ratio between two phases
+        check_every (int): auction iterations between two termination checks (host syncs)
+    Returns:
+        list of (row index, column index) long tensors on the device of `cost`, sorted by row
+    """
+    B, R, C = cost.shape
+    device = cost.device
+    num_rows, num_cols = torch.as_tensor(num_rows).tolist(), torch.as_tensor(num_cols).tolist()
+    empty = torch.empty(0, dtype=torch.int64, device=device)
+    results = [(empty, empty)] * B
+
+    for bid_with_rows in (True, False):
+        # images without rows or columns match nothing
+        images = [i for i, (n, m) in enumerate(zip(num_rows, num_cols))
+                  if min(n, m) > 0 and (n <= m) == bid_with_rows]
+        if not images:
+            continue
+        index = torch.as_tensor(images, device=device)
+        # bidders are the smaller side of every image
+        benefit = -cost[index] if bid_with_rows else -cost[index].transpose(1, 2)
+        bidders, objects = (num_rows, num_cols) if bid_with_rows else (num_cols, num_rows)
+        bidders, objects = [bidders[i] for i in images], [objects[i] for i in images]
+        N, M = benefit.shape[1:]
+        active = torch.arange(N, device=device) < torch.as_tensor(bidders, device=device)[:, None]
+        valid_objects = torch.arange(M, device=device) < torch.as_tensor(objects, device=device)[:, None]
+        valid = active[..., None] & valid_objects[:, None, :]
+        spread = torch.where(valid, benefit, benefit.new_zeros(())).abs().amax(dim=(1, 2))
+        benefit = torch.where(valid_objects[:, None, :], benefit, benefit.new_full((), float("-inf")))
+
+        start = (spread[:, None] / 4).clamp(min=eps)
+        assigned, prices = _auction(benefit, active, start, eps, scaling, check_every)
+        assigned = _reverse_auction(benefit, active, valid_objects, assigned, prices, eps, check_every)
+
+        for k, (i, n) in enumerate(zip(images, bidders)):
+            rows, cols = torch.arange(n, device=device), assigned[k, :n]
+            if not bid_with_rows:
+                rows, cols = cols, rows
+            order = rows.argsort()
+            results[i] = (rows[order], cols[order])
+    return results
@@ -11,6 +11,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torchvision.ops import batched_nms
 
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
@@ -19,7 +20,7 @@ from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
 from models.matcher import build_matcher
 
 from models.transformer import deit_tiny_patch16_224, deit_small_patch16_224, deit_base_patch16_224
-from models.encoder import encoder_tiny_672_192, encoder_small_672_384, encoder_base_768_768
+from models.encoder import encoder_tiny_672_192, encoder_small_672_384, encoder_base_768_768, split_token_budget
 
 from functools import partial
 
@@ -41,7 +42,10 @@ class MLP(nn.Module):
 
 class Detector(nn.Module):
     def __init__(self, backbone: nn.Module, encoder: nn.Module, token_len=600, sample_name="tiny",
-                 det_token_num=100, num_classes=91):
+                 det_token_num=100, num_classes=91, exit_threshold=0.):
+        """ `exit_threshold`: with exit blocks in the neck, an image leaves the neck at inference once every det
+        token predicts the same class as at the previous exit with a probability of at least `exit_threshold`
+        (no-object included), 0 runs all the blocks """
         super().__init__()
 
         self.backbone = backbone
@@ -50,17 +54,85 @@ class Detector(nn.Module):
 
         self.class_embed = MLP(self.backbone.embed_dim, self.backbone.embed_dim, num_classes + 1, 3)
         self.bbox_embed = MLP(self.backbone.embed_dim, self.backbone.embed_dim, 4, 3)
-
-    def forward(self, samples: NestedTensor):
-
-        if isinstance(samples, (list, torch.Tensor)):
-            samples = nested_tensor_from_tensor_list(samples)
-
-        x = self.backbone(samples.tensors)
-
+        self.encoder_frozen = False
+        self.exit_threshold = exit_threshold
+        self._exit_frozen = []  # parameters frozen by `set_exit_stage`
+
+    def freeze_encoder(self):
+        """ No gradients into the Swin encoder and eval mode (no drop path) even while training, so that its
+        output only depends on the image and can be cached """
+        self.encoder_frozen = True
+        for p in self.backbone.encoder.parameters():
+            p.requires_grad_(False)
+        self.backbone.encoder.eval()
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.encoder_frozen:
+            self.backbone.encoder.eval()
+        return self
+
+    def set_exit_stage(self, exit_stage):
+        """ Runs the encoder up to `exit_stage` only (low-latency tier), None runs all the stages. The weights
+        of the skipped stages and of their neck projections are kept, so the same checkpoint still serves the
+        full model, but they get no gradient and are frozen here. Stages that run again after `exit_stage` is
+        raised get back the gradients frozen here (not those of `freeze_encoder`). """
+        encoder = self.backbone.encoder
+        encoder.exit_stage = exit_stage = exit_stage or encoder.num_layers
+        skipped = list(encoder.layers[exit_stage:]) + list(encoder.norm_list[exit_stage:]) + \
+            [proj for proj in self.backbone.scale_projections()[exit_stage:] if proj is not None]
+        skipped = {id(p) for m in skipped for p in m.parameters()}
+        frozen = {id(p) for p in self._exit_frozen}
+        encoder_params = {id(p) for p in encoder.parameters()}
+        for p in self._exit_frozen:
+            if id(p) not in skipped and not (self.encoder_frozen and id(p) in encoder_params):
+                p.requires_grad_(True)
+        self._exit_frozen = [p for p in self.parameters() if id(p) in skipped and (p.requires_grad or id(p) in frozen)]
+        for p in self._exit_frozen:
+            p.requires_grad_(False)
+
+    def exit_fn(self, batch_size):
+        """ Early exit test of the neck, see `exit_threshold` """
+        labels = None
+
+        def settled(det, active):
+            nonlocal labels
+            prob, label = self.class_embed(det).softmax(-1).max(-1)
+            if labels is None:
+                labels = torch.full((batch_size,) + label.shape[1:], -1, dtype=label.dtype, device=label.device)
+            done = ((prob >= self.exit_threshold) & (label == labels[active])).all(-1)
+            labels[active] = label
+            return done
+
+        return settled
+
+    def forward(self, samples: NestedTensor, features=None):
+        """ `features`: encoder token lists of `samples` computed beforehand, the encoder is skipped then """
+        early_exit = not self.training and self.exit_threshold > 0 and bool(self.backbone.exit_blocks)
+        if features is not None:
+            batch_size = features[0].shape[0]
+        else:
+            if isinstance(samples, (list, torch.Tensor)):
+                samples = nested_tensor_from_tensor_list(samples)
+            batch_size = samples.tensors.shape[0]
+        exit_fn = self.exit_fn(batch_size) if early_exit else None
+        if features is not None:
+            x = self.backbone(None, features=features, exit_fn=exit_fn)
+        else:
+            x = self.backbone(samples.tensors, mask=samples.mask, exit_fn=exit_fn)
+
+        aux = []
+        if self.backbone.exit_blocks and not early_exit:
+            x, aux = x
         outputs_class = self.class_embed(x)
         outputs_coord = self.bbox_embed(x).sigmoid()
         out = {'pred_logits': outputs_class, 'pred_boxes': outputs_coord}
+        if aux:
+            # the heads are shared by all the exits
+            out['aux_outputs'] = [{'pred_logits': self.class_embed(a), 'pred_boxes': self.bbox_embed(a).sigmoid()}
+                                  for a in aux]
+        if early_exit:
+            out['exit_depth'] = self.backbone.exit_depth
         return out
 
     def forward_return_attention(self, samples: NestedTensor):
@@ -146,9 +218,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -247,7 +319,76 @@ class SetCriterion(nn.Module):
 
 
 class PostProcess(nn.Module):
-    """ This module converts the model's output into the format expected by the coco api"""
+    """ This module converts the model's output into the format expected by the coco api
+
+    Args:
+        top_k (int): keep the `top_k` best (det token, class) pairs of every image instead of the best class of
+            every det token, 0 keeps one row per det token
+        score_threshold (float): drop the detections scored at most `score_threshold`
+        nms_threshold (float): class-aware NMS IoU threshold, 0 disables NMS
+    With the defaults, every det token is returned as it is.
+    """
+
+    def __init__(self, top_k=0, score_threshold=0., nms_threshold=0.):
+        super().__init__()
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+
+    def filtering(self):
+        return self.top_k > 0 or self.score_threshold > 0 or self.nms_threshold > 0
+
+    @torch.no_grad()
+    def forward_padded(self, outputs, target_sizes):
+        """ Same as `forward`, vectorized over the batch on the model device, as padded tensors.
+
+        Returns:
+            {'scores': (B, K), 'labels': (B, K), 'boxes': (B, K, 4), 'num_valid': (B,)}, the valid detections
+            of image i are the first num_valid[i] rows sorted by score, K = max(num_valid), the padding rows have
+            score 0, label -1 and an empty box
+        """
+        out_logits, out_bbox = outputs['pred_logits'], outputs['pred_boxes']
+
+        assert len(out_logits) == len(target_sizes)
+        assert target_sizes.shape[1] == 2
+
+        prob = F.softmax(out_logits, -1)[..., :-1]
+        B, Q, C = prob.shape
+        if self.top_k > 0:
+            # global top-k over the (token, class) pairs of every image
+            scores, index = prob.flatten(1).topk(min(self.top_k, Q * C), dim=1)
+            labels = index % C
+            tokens = index // C
+            out_bbox = out_bbox.gather(1, tokens.unsqueeze(-1).expand(-1, -1, 4))
+        else:
+            scores, labels = prob.max(-1)
+
+        # convert to [x0, y0, x1, y1] format
+        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
+        # and from relative [0, 1] to absolute [0, height] coordinates
+        img_h, img_w = target_sizes.unbind(1)
+        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
+        boxes = boxes * scale_fct[:, None, :]
+
+        valid = scores > self.score_threshold
+        if self.nms_threshold > 0:
+            # one NMS call for the whole batch, the boxes of other images / classes never suppress each other
+            candidates = valid.flatten().nonzero().squeeze(1)
+            groups = (torch.arange(B, device=labels.device)[:, None] * C + labels).flatten()[candidates]
+            keep = batched_nms(boxes.flatten(0, 1)[candidates].float(), scores.flatten()[candidates],
+                               groups, self.nms_threshold)
+            valid = torch.zeros_like(valid).flatten().index_fill_(0, candidates[keep], True).view(valid.shape)
+
+        # valid detections first, by score
+        order = torch.where(valid, scores, scores.new_full((), -1.)).argsort(dim=1, descending=True)
+        num_valid = valid.sum(1)
+        K = int(num_valid.max()) if B > 0 else 0
+        order = order[:, :K]
+        rows = torch.arange(K, device=scores.device) < num_valid[:, None]
+        scores = torch.where(rows, scores.gather(1, order), scores.new_zeros(()))
+        labels = torch.where(rows, labels.gather(1, order), labels.new_full((), -1))
+        boxes = boxes.gather(1, order.unsqueeze(-1).expand(-1, -1, 4)) * rows.unsqueeze(-1)
+        return {'scores': scores, 'labels': labels, 'boxes': boxes, 'num_valid': num_valid}
 
     @torch.no_grad()
     def forward(self, outputs, target_sizes):
@@ -258,6 +399,12 @@ class PostProcess(nn.Module):
                           For evaluation, this must be the original image size (before any data augmentation)
                           For visualization, this should be the image size after data augment, but before padding
         """
+        if self.filtering():
+            results = self.forward_padded(outputs, target_sizes)
+            return [{'scores': s[:n], 'labels': l[:n], 'boxes': b[:n]}
+                    for s, l, b, n in zip(results['scores'], results['labels'], results['boxes'],
+                                          results['num_valid'].tolist())]
+
         out_logits, out_bbox = outputs['pred_logits'], outputs['pred_boxes']
 
         assert len(out_logits) == len(target_sizes)
@@ -278,36 +425,39 @@ class PostProcess(nn.Module):
         return results
 
 
-def swin_ssd_tiny(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91):
-    encoder = encoder_tiny_672_192(pretrain=encoder_pt)
-    neck = deit_tiny_patch16_224(pretrained=deit_pt)
-    detector = Detector(encoder=encoder, backbone=neck,
-                        token_len=sum(encoder.num_list),
-                        det_token_num=det_token_num, num_classes=num_classes, sample_name="tiny")
-
-    if neck_pt:
-        checkpoint = torch.load(neck_pt, map_location="cpu")
-        cls_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, 0, :].unsqueeze(0)
-        det_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, -det_token_num:, :]
-        patch_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, 1:-det_token_num, :]
-        patch_pos_weight = F.interpolate(patch_pos_weight.transpose(1, 2),
-                                         size=sum(encoder.num_list),
-                                         mode='linear',
-                                         align_corners=False).transpose(1, 2)
-        checkpoint["model"]['backbone.pos_embed'] = torch.cat((cls_pos_weight, patch_pos_weight, det_pos_weight), dim=1)
-        detector.load_state_dict(state_dict=checkpoint["model"], strict=False)
-        print("tiny neck weights loaded!")
-    print("SwinSSD-Tiny Successfully Built")
-
-    return detector
+# model size -> (encoder builder, neck builder, display name)
+SWIN_SSD_CONFIGS = {
+    "tiny": (encoder_tiny_672_192, deit_tiny_patch16_224, "Tiny"),
+    "small": (encoder_small_672_384, deit_small_patch16_224, "Small"),
+    "base": (encoder_base_768_768, deit_base_patch16_224, "Base"),
+}
 
 
-def swin_ssd_small(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91):
-    encoder = encoder_small_672_384(pretrain=encoder_pt)
-    neck = deit_small_patch16_224(pretrained=deit_pt)
+def _swin_ssd(cfg, pretrained, det_token_num=100, num_classes=91, encoder_attn="naive", window_layout=False,
+              num_list=None, neck_tokens=None, use_checkpoint=False, exit_stage=None, exit_threshold=0.,
+              neck_attn="naive", keep_tokens=0, neck_window=0, **neck_kwargs):
+    """
+    Args:
+        cfg (str): model size, a key of `SWIN_SSD_CONFIGS`
+        pretrained: (encoder_pt, deit_pt, neck_pt) weight files, None to skip
+        neck_kwargs: other neck options, passed to the `VisionTransformer` as they are
+            (merge_ratio, det_only_blocks, exit_blocks, linear_blocks)
+    """
+    build_encoder, build_neck, title = SWIN_SSD_CONFIGS[cfg]
+    encoder_pt, deit_pt, neck_pt = pretrained
+    if neck_tokens:
+        num_list = split_token_budget(neck_tokens)
+    encoder = build_encoder(pretrain=encoder_pt, attn_backend=encoder_attn, window_layout=window_layout,
+                            num_list=num_list, use_checkpoint=use_checkpoint)
+    neck = build_neck(pretrained=deit_pt, use_checkpoint=use_checkpoint, attn_backend=neck_attn,
+                      token_scorer=keep_tokens > 0, keep_tokens=keep_tokens, local_window=neck_window,
+                      **neck_kwargs)
     detector = Detector(encoder=encoder, backbone=neck,
                         token_len=sum(encoder.num_list),
-                        det_token_num=det_token_num, num_classes=num_classes, sample_name="small")
+                        det_token_num=det_token_num, num_classes=num_classes, sample_name=cfg,
+                        exit_threshold=exit_threshold)
+    if exit_stage:
+        detector.set_exit_stage(exit_stage)
 
     if neck_pt:
         checkpoint = torch.load(neck_pt, map_location="cpu")
@@ -320,34 +470,25 @@ def swin_ssd_small(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=Non
                                          align_corners=False).transpose(1, 2)
         checkpoint["model"]['backbone.pos_embed'] = torch.cat((cls_pos_weight, patch_pos_weight, det_pos_weight), dim=1)
         detector.load_state_dict(state_dict=checkpoint["model"], strict=False)
-        print("small neck weights loaded!")
-    print("SwinSSD-Small Successfully Built")
+        print(f"{cfg} neck weights loaded!")
+    print(f"SwinSSD-{title} Successfully Built")
 
     return detector
 
 
-def swin_ssd_base(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91):
-    encoder = encoder_base_768_768(pretrain=encoder_pt)
-    neck = deit_base_patch16_224(pretrained=deit_pt)
-    detector = Detector(encoder=encoder, backbone=neck,
-                        token_len=sum(encoder.num_list),
-                        det_token_num=det_token_num, num_classes=num_classes, sample_name="base")
+def swin_ssd_tiny(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91, **kwargs):
+    return _swin_ssd("tiny", (encoder_pt, deit_pt, neck_pt), det_token_num=det_token_num, num_classes=num_classes,
+                     **kwargs)
 
-    if neck_pt:
-        checkpoint = torch.load(neck_pt, map_location="cpu")
-        cls_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, 0, :].unsqueeze(0)
-        det_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, -det_token_num:, :]
-        patch_pos_weight = checkpoint["model"]['backbone.pos_embed'][:, 1:-det_token_num, :]
-        patch_pos_weight = F.interpolate(patch_pos_weight.transpose(1, 2),
-                                         size=sum(encoder.num_list),
-                                         mode='linear',
-                                         align_corners=False).transpose(1, 2)
-        checkpoint["model"]['backbone.pos_embed'] = torch.cat((cls_pos_weight, patch_pos_weight, det_pos_weight), dim=1)
-        detector.load_state_dict(state_dict=checkpoint["model"], strict=False)
-        print("base neck weights loaded!")
-    print("SwinSSD-Base Successfully Built")
 
-    return detector
+def swin_ssd_small(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91, **kwargs):
+    return _swin_ssd("small", (encoder_pt, deit_pt, neck_pt), det_token_num=det_token_num, num_classes=num_classes,
+                     **kwargs)
+
+
+def swin_ssd_base(encoder_pt=None, deit_pt=None, det_token_num=100, neck_pt=None, num_classes=91, **kwargs):
+    return _swin_ssd("base", (encoder_pt, deit_pt, neck_pt), det_token_num=det_token_num, num_classes=num_classes,
+                     **kwargs)
 
 
 def build(args):
@@ -368,17 +509,15 @@ def build(args):
 
     print("\n* ---------- Model Information ---------- *")
 
-    if args.model_name == "tiny":
-        model = swin_ssd_tiny(encoder_pt=args.encoder_pt, deit_pt=None, det_token_num=args.det_token_num,
-                              neck_pt=args.neck_pt, num_classes=num_classes)
-    elif args.model_name == 'small':
-        model = swin_ssd_small(encoder_pt=args.encoder_pt, deit_pt=None, det_token_num=args.det_token_num,
-                               neck_pt=args.neck_pt, num_classes=num_classes)
-    elif args.model_name == "base":
-        model = swin_ssd_base(encoder_pt=args.encoder_pt, deit_pt=None, det_token_num=args.det_token_num,
-                              neck_pt=args.neck_pt, num_classes=num_classes)
-    else:
+    if args.model_name not in SWIN_SSD_CONFIGS:
         raise ValueError(f"{args.model_name} does not exist!")
+    model = _swin_ssd(args.model_name, (args.encoder_pt, None, args.neck_pt), det_token_num=args.det_token_num,
+                      num_classes=num_classes, encoder_attn=args.encoder_attn, window_layout=args.window_layout,
+                      num_list=args.num_list, neck_tokens=args.neck_tokens, use_checkpoint=args.use_checkpoint,
+                      exit_stage=args.exit_stage, exit_threshold=args.exit_threshold, neck_attn=args.neck_attn,
+                      keep_tokens=args.keep_tokens, neck_window=args.neck_window, merge_ratio=args.merge_ratio,
+                      det_only_blocks=args.det_only_blocks, exit_blocks=args.exit_blocks,
+                      linear_blocks=args.linear_blocks)
 
     print(
         "\tParameters Total: {:.2f}M ({:.2f}M trainable)!".format(
@@ -392,18 +531,18 @@ def build(args):
     matcher = build_matcher(args)
     weight_dict = {'loss_ce': 1, 'loss_bbox': args.bbox_loss_coef}
     weight_dict['loss_giou'] = args.giou_loss_coef
-    # TODO this is a hack
-    # if args.aux_loss:
-    #     aux_weight_dict = {}
-    #     for i in range(args.dec_layers - 1):
-    #         aux_weight_dict.update({k + f'_{i}': v for k, v in weight_dict.items()})
-    #     weight_dict.update(aux_weight_dict)
+    # the auxiliary outputs of the neck exit blocks
+    aux_weight_dict = {}
+    for i in range(len(args.exit_blocks or [])):
+        aux_weight_dict.update({k + f'_{i}': v for k, v in weight_dict.items()})
+    weight_dict.update(aux_weight_dict)
 
     losses = ['labels', 'boxes', 'cardinality']
     criterion = SetCriterion(num_classes, matcher=matcher, weight_dict=weight_dict,
                              eos_coef=args.eos_coef, losses=losses)
     criterion.to(device)
-    postprocessors = {'bbox': PostProcess()}
+    postprocessors = {'bbox': PostProcess(top_k=args.post_top_k, score_threshold=args.post_score_threshold,
+                                          nms_threshold=args.post_nms_threshold)}
 
     return model, criterion, postprocessors
 
@@ -442,9 +581,30 @@ if __name__ == "__main__":
             self.dataset_file = "coco"
             self.model_name = "tiny"
             self.det_token_num = 100
+            self.encoder_attn = "naive"
+            self.window_layout = False
+            self.num_list = None
+            self.neck_tokens = None
+            self.use_checkpoint = False
+            self.exit_stage = None
+            self.neck_attn = "naive"
+            self.merge_ratio = 0.
+            self.det_only_blocks = 0
+            self.keep_tokens = 0
+            self.exit_blocks = None
+            self.exit_threshold = 0.
+            self.neck_window = 0
+            self.linear_blocks = None
+            self.post_top_k = 0
+            self.post_score_threshold = 0.
+            self.post_nms_threshold = 0.
             self.set_cost_class = 1
             self.set_cost_bbox = 5
             self.set_cost_giou = 2
+            self.matcher_workers = 0
+            self.matcher_solver = 'scipy'
+            self.auction_eps = 1e-3
+            self.matcher_memory_mb = 256
             self.bbox_loss_coef = 5
             self.giou_loss_coef = 2
             self.bbox_loss_coef = 5
@@ -470,6 +630,8 @@ if __name__ == "__main__":
     class Samples:
         def __init__(self, tensor):
             self.tensors = tensor
+            # unpadded batch
+            self.mask = torch.zeros(tensor.shape[0], *tensor.shape[2:], dtype=torch.bool, device=tensor.device)
 
 
     import torchvision.transforms as transforms
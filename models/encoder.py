@@ -12,10 +12,13 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 # from models.layers import DropPath, to_2tuple, trunc_normal_
+from models.attention import check_attn_backend, sdpa_attention, chunked_attention
 
+from collections import OrderedDict
 from typing import List
 from torch import Tensor
 
@@ -71,6 +74,161 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+def compute_shift_mask(H, W, window_size, shift_size, device=None):
+    """
+    Args:
+        H (int): Height of the feature map
+        W (int): Width of the feature map
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, window_size*window_size, window_size*window_size)
+    """
+    img_mask = torch.zeros((1, H, W, 1), device=device)  # 1 H W 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
+def window_order(H, W, window_size, shift_size, device=None):
+    """
+    Args:
+        H (int): Height of the feature map
+        W (int): Width of the feature map
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+
+    Returns:
+        index: (H*W, ) the row-major token index found at every position of the (shifted) window-major layout,
+            i.e. window_partition(roll(x)) == x[:, index] for x of shape (B, H*W, C)
+    """
+    index = torch.arange(H * W, device=device).view(1, H, W, 1)
+    if shift_size > 0:
+        index = torch.roll(index, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    return window_partition(index, window_size).flatten()
+
+
+def pad_mask_to_grid(mask, H, W):
+    """
+    Args:
+        mask: (B, Hm, Wm) bool, True on padding, Hm and Wm multiples of H and W
+        H (int): Height of the token grid
+        W (int): Width of the token grid
+
+    Returns:
+        mask: (B, H, W), a token is padding if every pixel / token it covers is padding
+    """
+    B, Hm, Wm = mask.shape
+    return mask.view(B, H, Hm // H, W, Wm // W).all(4).all(2)
+
+
+def relative_position_index(window_size, device=None):
+    """
+    Args:
+        window_size (tuple[int]): The height and width of the window.
+
+    Returns:
+        index: (Wh*Ww, Wh*Ww) pair-wise index into the relative position bias table
+    """
+    coords_h = torch.arange(window_size[0], device=device)
+    coords_w = torch.arange(window_size[1], device=device)
+    coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
+    coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+    relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
+    relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
+    relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+    relative_coords[:, :, 1] += window_size[1] - 1
+    relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+    return relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+
+
+class StageGeometry(object):
+    """ Index and mask tensors shared by all blocks of a stage.
+
+    They only depend on (resolution, window, shift), so they are built once per key and referenced by every
+    block instead of being registered as buffers of each block. This is a plain object, not a module: nothing
+    ends up in `state_dict`, and the tensors are rebuilt lazily after loading or on another device.
+
+    Args:
+        cache_size (int, optional): Number of resolution dependent entries (shift masks, layout tables)
+            kept in the LRU cache. Default: 16
+    """
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self._index = {}
+        self._cache = OrderedDict()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(cache_size={self.cache_size}, cached={len(self._cache)})"
+
+    def clear(self):
+        self._index.clear()
+        self._cache.clear()
+
+    def _lookup(self, key, build):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = build()
+        self._cache[key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def relative_position_index(self, window_size, device):
+        """ (Wh*Ww, Wh*Ww) index, one per window size and device """
+        key = (tuple(window_size), str(device))
+        if key not in self._index:
+            self._index[key] = relative_position_index(window_size, device=device)
+        return self._index[key]
+
+    def attn_mask(self, H, W, window_size, shift_size, device):
+        """ (num_windows, N, N) shift mask of an (H, W) feature map, None for W-MSA """
+        if shift_size == 0:
+            return None
+        key = ("mask", H, W, window_size, shift_size, str(device))
+        return self._lookup(key, lambda: compute_shift_mask(H, W, window_size, shift_size, device=device))
+
+    def layout_tables(self, H, W, windows, device):
+        """
+        Args:
+            windows: [(window_size, shift_size)] of the consecutive blocks
+
+        Returns depth + 1 gather indices: row-major -> layout of block 0, block i-1 -> block i, last block ->
+        row-major. None marks an identity step (consecutive blocks sharing a layout).
+        """
+        key = ("layout", H, W, tuple(windows), str(device))
+        return self._lookup(key, lambda: self._build_layout_tables(H, W, windows, device))
+
+    @staticmethod
+    def _build_layout_tables(H, W, windows, device):
+        identity = torch.arange(H * W, device=device)
+        tables, inverse = [], identity
+        for window_size, shift_size in windows:
+            order = window_order(H, W, window_size, shift_size, device=device)
+            tables.append(inverse[order])
+            inverse = torch.empty_like(order)
+            inverse[order] = identity
+        tables.append(inverse)
+        return [None if torch.equal(t, identity) else t for t in tables]
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -83,9 +241,13 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        attn_backend (str, optional): naive | sdpa | chunked, see `models.attention`. Default: naive
+        chunk_size (int, optional): Number of windows per slice of the chunked backend. Default: 64
+        geometry (StageGeometry | None, optional): Index cache shared by the stage, a private one if None.
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 attn_backend="naive", chunk_size=64, geometry=None):
 
         super().__init__()
         self.dim = dim
@@ -93,23 +255,15 @@ class WindowAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.attn_backend = check_attn_backend(attn_backend)
+        self.chunk_size = chunk_size
 
         # define a parameter table of relative position bias
         self.relative_position_bias_table = nn.Parameter(
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
-        # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        # pair-wise relative position index for each token inside the window, shared by the whole stage
+        self.geometry = geometry if geometry is not None else StageGeometry()
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -119,6 +273,49 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        # (key, bias) materialized from the table in eval / frozen mode, see `get_relative_position_bias`
+        self._bias_cache = None
+
+    def train(self, mode=True):
+        self._bias_cache = None
+        return super().train(mode)
+
+    def _apply(self, fn):
+        self._bias_cache = None
+        return super()._apply(fn)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._bias_cache = None
+        # `relative_position_index` used to be a buffer, old checkpoints still carry it
+        state_dict.pop(prefix + "relative_position_index", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_relative_position_bias(self):
+        """
+        Returns:
+            relative position bias with shape of (1, nH, Wh*Ww, Wh*Ww)
+
+        The gather from the table is cached whenever no gradient has to flow into the table, i.e. in eval mode
+        under no_grad or when the table is frozen. The cache is keyed on the storage and version counter of the
+        table, so in-place updates (optimizer steps, `load_state_dict`, `.to()`) never return a stale bias. Writes
+        through `.data` bypass the version counter, `train()` drops the cache after those.
+        """
+        table = self.relative_position_bias_table
+        cacheable = not table.requires_grad or (not self.training and not torch.is_grad_enabled())
+        if cacheable and self._bias_cache is not None:
+            key, bias = self._bias_cache
+            if key == (table.data_ptr(), table._version):
+                return bias
+
+        N = self.window_size[0] * self.window_size[1]
+        index = self.geometry.relative_position_index(self.window_size, table.device)
+        bias = table[index.view(-1)].view(N, N, -1)  # Wh*Ww,Wh*Ww,nH
+        bias = bias.permute(2, 0, 1).contiguous().unsqueeze(0)  # 1, nH, Wh*Ww, Wh*Ww
+
+        if cacheable:
+            self._bias_cache = ((table.data_ptr(), table._version), bias.detach())
+        return bias
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -129,13 +326,13 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend != "naive":
+            return self.forward_fused(q, k, v, mask)
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
+        attn = attn + self.get_relative_position_bias()  # 1, nH, Wh*Ww, Wh*Ww
 
         if mask is not None:
             nW = mask.shape[0]
@@ -152,8 +349,40 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def forward_fused(self, q, k, v, mask=None):
+        """
+        Relative position bias and shift mask are folded into one additive mask, so no (B_, nH, N, N)
+        score tensor is built outside of the kernel.
+
+        Args:
+            q, k, v: (num_windows*B, nH, N, C/nH)
+            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+        """
+        B_, nH, N, d = q.shape
+
+        attn_mask = self.get_relative_position_bias()  # 1, nH, Wh*Ww, Wh*Ww
+
+        if mask is not None:
+            nW = mask.shape[0]
+            attn_mask = attn_mask + mask.unsqueeze(1)  # nW, nH, Wh*Ww, Wh*Ww
+            q, k, v = [t.view(B_ // nW, nW, nH, N, d) for t in (q, k, v)]
+
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if self.attn_backend == "sdpa":
+            x = sdpa_attention(q, k, v, attn_mask=attn_mask, scale=self.scale, dropout_p=dropout_p)
+        else:
+            # slice along the window dim (B_ or nW), the only dim that grows with the input resolution
+            x = chunked_attention(q, k, v, attn_mask=attn_mask, scale=self.scale, dropout_p=dropout_p,
+                                  chunk_size=self.chunk_size, dim=-4)
+
+        x = x.reshape(B_, nH, N, d).transpose(1, 2).reshape(B_, N, nH * d)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
     def extra_repr(self) -> str:
-        return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
+        return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}, ' \
+               f'attn_backend={self.attn_backend}'
 
     def flops(self, N):
         # calculate flops for 1 window with token length of N
@@ -186,11 +415,13 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        attn_backend (str, optional): Window attention backend: naive | sdpa | chunked. Default: naive
+        geometry (StageGeometry | None, optional): Mask / index cache shared by the stage, a private one if None.
     """
 
     def __init__(self, dim, input_resolution, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_backend="naive", geometry=None):
         super().__init__()
         self.dim = dim
         self.input_resolution = input_resolution
@@ -203,54 +434,96 @@ class SwinTransformerBlock(nn.Module):
             self.shift_size = 0
             self.window_size = min(self.input_resolution)
         assert 0 <= self.shift_size < self.window_size, "shift_size must in 0-window_size"
+        self.geometry = geometry if geometry is not None else StageGeometry()
 
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            attn_backend=attn_backend, geometry=self.geometry)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        # recompute this block in backward instead of storing its activations, set by BasicLayer / the planner
+        self.use_checkpoint = False
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # `attn_mask` used to be a buffer, old checkpoints still carry it
+        state_dict.pop(prefix + "attn_mask", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_shift_size(self, H, W):
+        # as in __init__, there is nothing to shift once a single window covers the feature map
+        return self.shift_size if min(H, W) > self.window_size else 0
+
+    def get_attn_mask(self, H, W, device):
+        """ Shift mask of an (H, W) feature map, None for W-MSA """
+        return self.geometry.attn_mask(H, W, self.window_size, self.get_shift_size(H, W), device)
+
+    def forward_padded_windows(self, x_windows, pad_windows, H, W):
+        """
+        The whole block (norms, attention, MLP and residuals) on the windows that hold at least one real token,
+        windows made of padding only pass through unchanged. Padded keys are masked with -100 in the kept
+        windows, so real tokens never see the padding.
+
+        Args:
+            x_windows: (B*num_windows, N, C) block input, image after image
+            pad_windows: (B*num_windows, N) bool, True on padding
+        Returns:
+            (B*num_windows, N, C) block output
+        """
+        index = (~pad_windows.all(-1)).nonzero().squeeze(1)
+        if index.numel() == 0:
+            return x_windows
+
+        N = x_windows.shape[1]
+        num_windows = (H // self.window_size) * (W // self.window_size)
+        mask = pad_windows[index].unsqueeze(1).to(x_windows.dtype) * -100.  # B_kept, 1, N
+        attn_mask = self.get_attn_mask(H, W, x_windows.device)
+        if attn_mask is not None:
+            # window i of every image uses shift mask i
+            mask = mask + attn_mask[index % num_windows]
         else:
-            attn_mask = None
+            mask = mask.expand(-1, N, -1)
 
-        self.register_buffer("attn_mask", attn_mask)
+        # stochastic depth drops whole images: one draw per image, shared by its windows
+        B = x_windows.shape[0] // num_windows
+        image = index // num_windows
+        keep_attn = self.drop_path(x_windows.new_ones(B, 1, 1))[image]
+        keep_mlp = self.drop_path(x_windows.new_ones(B, 1, 1))[image]
 
-    def forward(self, x):
-        H, W = self.input_resolution
+        # one mask per kept window: (B_kept, N, N) acts as num_windows = B_kept of a single image
+        x = x_windows[index]
+        x = x + keep_attn * self.attn(self.norm1(x), mask=mask)
+        x = x + keep_mlp * self.mlp(self.norm2(x))
+        return x_windows.index_copy(0, index, x)
+
+    def forward(self, x, H=None, W=None, pad_mask=None):
+        """
+        Args:
+            x: (B, H*W, C)
+            pad_mask: (B, H, W) bool, True on padding, or None
+        """
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
+        assert H % self.window_size == 0 and W % self.window_size == 0, \
+            f"input feature ({H}*{W}) is not divisible by window size {self.window_size}"
+        shift_size = self.get_shift_size(H, W)
+        if pad_mask is not None:
+            return self.forward_padded(x, H, W, pad_mask)
 
         shortcut = x
         x = self.norm1(x)
         x = x.view(B, H, W, C)
 
         # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+        if shift_size > 0:
+            shifted_x = torch.roll(x, shifts=(-shift_size, -shift_size), dims=(1, 2))
         else:
             shifted_x = x
 
@@ -259,15 +532,15 @@ class SwinTransformerBlock(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        attn_windows = self.attn(x_windows, mask=self.get_attn_mask(H, W, x.device))  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
         shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
 
         # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
+        if shift_size > 0:
+            x = torch.roll(shifted_x, shifts=(shift_size, shift_size), dims=(1, 2))
         else:
             x = shifted_x
         x = x.view(B, H * W, C)
@@ -278,6 +551,107 @@ class SwinTransformerBlock(nn.Module):
 
         return x
 
+    def forward_padded(self, x, H, W, pad_mask):
+        """
+        `forward` of a padded batch: the block runs on the windows with real tokens only, see
+        `forward_padded_windows`. Real tokens get the same output as in `forward` of the image alone.
+
+        Args:
+            x: (B, H*W, C)
+            pad_mask: (B, H, W) bool, True on padding
+        """
+        B, L, C = x.shape
+        ws, shift_size = self.window_size, self.get_shift_size(H, W)
+
+        def partition(t):
+            t = t.view(B, H, W, -1)
+            if shift_size > 0:
+                t = torch.roll(t, shifts=(-shift_size, -shift_size), dims=(1, 2))
+            return window_partition(t, ws).view(B * (H // ws) * (W // ws), ws * ws, -1)
+
+        x_windows = self.forward_padded_windows(partition(x), partition(pad_mask).squeeze(-1), H, W)
+        x = window_reverse(x_windows.view(-1, ws, ws, C), ws, H, W)
+        if shift_size > 0:
+            x = torch.roll(x, shifts=(shift_size, shift_size), dims=(1, 2))
+        return x.reshape(B, L, C)
+
+    def forward_windows(self, x, H, W, pad_mask=None):
+        """
+        Same as `forward` for activations that are already in this block's (shifted) window-major layout,
+        see `window_order`. Norms, MLP and residuals are token-wise, so no roll / partition / reverse is needed.
+
+        Args:
+            x: (B, H*W, C) in window-major order
+            pad_mask: (B, H*W) bool in the same order, True on padding, or None
+        """
+        B, L, C = x.shape
+        assert L == H * W, "input feature has wrong size"
+        N = self.window_size * self.window_size
+        if pad_mask is not None:
+            return self.forward_padded_windows(x.view(-1, N, C), pad_mask.view(-1, N), H, W).view(B, L, C)
+
+        shortcut = x
+        x = self.norm1(x)
+
+        # W-MSA/SW-MSA, windows are contiguous runs of window_size*window_size tokens
+        x_windows = x.view(-1, N, C)  # nW*B, window_size*window_size, C
+        attn_windows = self.attn(x_windows, mask=self.get_attn_mask(H, W, x.device))
+        x = shortcut + self.drop_path(attn_windows.view(B, L, C))
+
+        # FFN
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+
+        return x
+
+    def forward_reuse(self, x, H, W, cache, threshold=0.):
+        """
+        Inference on a frame of a stream: only the (shifted) windows whose input moved by more than `threshold`
+        (max abs difference) since their output was computed are recomputed, the others keep the cached output.
+        A window's output only depends on its own input tokens, so the reuse is exact for `threshold` 0.
+
+        Args:
+            x: (B, H*W, C)
+            cache: dict of this block, empty on the first frame, updated in place with the input behind every
+                cached output window (so slow changes accumulate until they cross `threshold`)
+        Returns:
+            x, number of recomputed windows
+        """
+        if not cache or cache["x"].shape != x.shape:
+            out = self.forward(x, H, W)
+            cache["x"], cache["out"] = x, out
+            return out, x.shape[0] * (H // self.window_size) * (W // self.window_size)
+
+        B, L, C = x.shape
+        ws, shift_size = self.window_size, self.get_shift_size(H, W)
+
+        def partition(t):
+            t = t.view(B, H, W, C)
+            if shift_size > 0:
+                t = torch.roll(t, shifts=(-shift_size, -shift_size), dims=(1, 2))
+            return window_partition(t, ws).view(-1, ws * ws, C)
+
+        def reverse(t):
+            t = window_reverse(t.view(-1, ws, ws, C), ws, H, W)
+            if shift_size > 0:
+                t = torch.roll(t, shifts=(shift_size, shift_size), dims=(1, 2))
+            return t.reshape(B, H * W, C)
+
+        x_windows, cached_windows = partition(x), partition(cache["x"])
+        index = ((x_windows - cached_windows).abs().amax(dim=(1, 2)) > threshold).nonzero().squeeze(1)
+        if index.numel() == 0:
+            return cache["out"], 0
+
+        x_kept = x_windows[index]
+        attn_mask = self.get_attn_mask(H, W, x.device)
+        # window i of every image uses shift mask i, one mask per recomputed window
+        mask = attn_mask[index % attn_mask.shape[0]] if attn_mask is not None else None
+        y = x_kept + self.drop_path(self.attn(self.norm1(x_kept), mask=mask))
+        y = y + self.drop_path(self.mlp(self.norm2(y)))
+
+        cache["x"] = reverse(cached_windows.index_copy(0, index, x_kept))
+        cache["out"] = reverse(partition(cache["out"]).index_copy(0, index, y))
+        return cache["out"], index.numel()
+
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
                f"window_size={self.window_size}, shift_size={self.shift_size}, mlp_ratio={self.mlp_ratio}"
@@ -313,11 +687,12 @@ class PatchMerging(nn.Module):
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
         assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
@@ -364,17 +739,25 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        attn_backend (str, optional): Window attention backend: naive | sdpa | chunked. Default: naive
+        window_layout (bool, optional): Keep activations in window-major order between blocks. Default: False
+        geometry_cache_size (int, optional): Number of resolution dependent masks / layout tables kept by the
+            stage geometry. Default: 16
     """
 
     def __init__(self, dim, input_resolution, depth, num_heads, window_size,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., norm_layer=nn.LayerNorm, downsample=None, use_checkpoint=False):
+                 drop_path=0., norm_layer=nn.LayerNorm, downsample=None, use_checkpoint=False,
+                 attn_backend="naive", window_layout=False, geometry_cache_size=16):
 
         super().__init__()
         self.dim = dim
         self.input_resolution = input_resolution
         self.depth = depth
-        self.use_checkpoint = use_checkpoint
+        self.window_layout = window_layout
+
+        # relative position index, shift masks and layout tables, built once and shared by all blocks
+        self.geometry = StageGeometry(cache_size=geometry_cache_size)
 
         # build blocks
         self.blocks = nn.ModuleList([
@@ -386,8 +769,12 @@ class BasicLayer(nn.Module):
                                  mlp_ratio=mlp_ratio,
                                  qkv_bias=qkv_bias, qk_scale=qk_scale, drop=drop, attn_drop=attn_drop,
                                  drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
-                                 norm_layer=norm_layer)
+                                 norm_layer=norm_layer,
+                                 attn_backend=attn_backend,
+                                 geometry=self.geometry)
             for i in range(depth)])
+        for blk in self.blocks:
+            blk.use_checkpoint = use_checkpoint
 
         # patch merging layer
         if downsample is not None:
@@ -395,16 +782,78 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x):
-        for blk in self.blocks:
-            if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
-            else:
-                x = blk(x)
+    def get_layout_tables(self, H, W, device):
+        """
+        Returns depth + 1 gather indices: row-major -> layout of block 0, block i-1 -> block i, last block ->
+        row-major. None marks an identity step (consecutive blocks sharing a layout).
+        """
+        windows = [(blk.window_size, blk.get_shift_size(H, W)) for blk in self.blocks]
+        return self.geometry.layout_tables(H, W, windows, device)
+
+    def forward(self, x, H=None, W=None, pad_mask=None):
+        """
+        x: B, H*W, C, (H, W) defaults to `input_resolution`
+        pad_mask: B, H, W, True on padding, or None
+        """
+        if H is None:
+            H, W = self.input_resolution
+        if self.window_layout:
+            x = self.forward_window_layout(x, H, W, pad_mask)
+        else:
+            for blk in self.blocks:
+                if blk.use_checkpoint and torch.is_grad_enabled():
+                    x = checkpoint.checkpoint(blk, x, H, W, pad_mask, use_reentrant=False)
+                else:
+                    x = blk(x, H, W, pad_mask)
         if self.downsample is not None:
-            x = self.downsample(x)
+            x = self.downsample(x, H, W)
         return x
 
+    def forward_window_layout(self, x, H, W, pad_mask=None):
+        """
+        One gather per block replaces view -> roll -> partition -> reverse -> roll, the row-major layout
+        is only restored once at the end of the stage. The padding mask follows the same gathers.
+        """
+        tables = self.get_layout_tables(H, W, x.device)
+        if pad_mask is not None:
+            pad_mask = pad_mask.flatten(1)
+        for blk, table in zip(self.blocks, tables[:-1]):
+            if table is not None:
+                x = x.index_select(1, table)
+                if pad_mask is not None:
+                    pad_mask = pad_mask.index_select(1, table)
+            if blk.use_checkpoint and torch.is_grad_enabled():
+                x = checkpoint.checkpoint(blk.forward_windows, x, H, W, pad_mask, use_reentrant=False)
+            else:
+                x = blk.forward_windows(x, H, W, pad_mask)
+        if tables[-1] is not None:
+            x = x.index_select(1, tables[-1])
+        return x
+
+    def forward_reuse(self, x, H, W, caches, threshold=0.):
+        """
+        `SwinTransformerBlock.forward_reuse` block after block, `caches` holds one dict per block.
+        Returns x and the number of recomputed / total windows of the stage.
+        """
+        recomputed = total = 0
+        for blk, cache in zip(self.blocks, caches):
+            x, n = blk.forward_reuse(x, H, W, cache, threshold)
+            recomputed += n
+            total += x.shape[0] * (H // blk.window_size) * (W // blk.window_size)
+        if self.downsample is not None:
+            x = self.downsample(x, H, W)
+        return x, recomputed, total
+
+    def _apply(self, fn):
+        # cached geometry lives on the old device
+        self.geometry.clear()
+        return super()._apply(fn)
+
+    def output_resolution(self, H, W):
+        if self.downsample is not None:
+            return H // 2, W // 2
+        return H, W
+
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, depth={self.depth}"
 
@@ -449,9 +898,8 @@ class PatchEmbed(nn.Module):
 
     def forward(self, x):
         B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        assert H % self.patch_size[0] == 0 and W % self.patch_size[1] == 0, \
+            f"Input image size ({H}*{W}) is not divisible by patch size {self.patch_size}."
         x = self.proj(x).flatten(2).transpose(1, 2)  # B Ph*Pw C
         if self.norm is not None:
             x = self.norm(x)
@@ -465,6 +913,74 @@ class PatchEmbed(nn.Module):
         return flops
 
 
+# (stage size, pooled size) -> (kernel, stride) hand-picked for the released checkpoints (169 / 225 / 289 tokens),
+# kept so that their features do not change
+LEGACY_POOLS = {
+    (84, 13): (7, 6), (42, 13): (5, 3), (21, 13): (9, 1),
+    (84, 15): (10, 5), (42, 15): (13, 2), (21, 15): (7, 1),
+    (96, 17): (12, 5), (48, 17): (15, 2), (24, 17): (8, 1),
+}
+
+
+def pool_params(size, out):
+    """ (kernel, stride) of an average pooling that maps `size` to `out` positions along one axis """
+    assert 0 < out <= size, f"cannot pool {size} positions to {out}"
+    if (size, out) in LEGACY_POOLS:
+        return LEGACY_POOLS[(size, out)]
+    stride = size // out
+    kernel = size - (out - 1) * stride
+    return kernel, stride
+
+
+def split_token_budget(num_tokens, num_scales=4):
+    """ Spreads a total neck token budget evenly over the scales """
+    return [num_tokens // num_scales + (1 if i < num_tokens % num_scales else 0) for i in range(num_scales)]
+
+
+class TokenPool(nn.Module):
+    r""" Average pooling of one encoder stage down to a requested number of tokens.
+
+    Args:
+        resolution (tuple[int]): Stage resolution the pooling is derived for.
+        num_tokens (int): Requested number of tokens, 0 drops the scale. The pooled grid keeps the aspect ratio
+            of `resolution`, so `num_tokens` holds the actual count after rounding.
+    """
+
+    def __init__(self, resolution, num_tokens):
+        super().__init__()
+        self.resolution = tuple(resolution)
+        self.requested_tokens = num_tokens
+
+        Rh, Rw = self.resolution
+        if num_tokens > 0:
+            gh = min(Rh, max(1, round((num_tokens * Rh / Rw) ** 0.5)))
+            gw = min(Rw, max(1, round(num_tokens / gh)))
+            (kh, sh), (kw, sw) = pool_params(Rh, gh), pool_params(Rw, gw)
+        else:
+            gh = gw = kh = sh = kw = sw = 0
+        self.grid = (gh, gw)
+        self.num_tokens = gh * gw
+        self.kernel_size = (kh, kw)
+        self.stride = (sh, sw)
+
+    def forward(self, x):
+        """
+        x: B, D, H, W -> B, num_tokens, D
+        """
+        B, D, H, W = x.shape
+        if self.num_tokens == 0:
+            return x.new_zeros(B, 0, D)
+        if H < self.kernel_size[0] or W < self.kernel_size[1]:
+            # smaller inputs than the pooling was derived for (arbitrary resolution), keep at most the grid
+            x = F.adaptive_avg_pool2d(x, (min(H, self.grid[0]), min(W, self.grid[1])))
+        elif self.kernel_size != (1, 1) or self.stride != (1, 1):
+            x = F.avg_pool2d(x, self.kernel_size, self.stride)
+        return x.flatten(2).transpose(1, 2)
+
+    def extra_repr(self) -> str:
+        return f"resolution={self.resolution}, grid={self.grid}, kernel_size={self.kernel_size}, stride={self.stride}"
+
+
 class SwinTransformer(nn.Module):
     r""" Swin Transformer
         A PyTorch impl of : `Swin Transformer: Hierarchical Vision Transformer using Shifted Windows`  -
@@ -489,6 +1005,8 @@ class SwinTransformer(nn.Module):
         ape (bool): If True, add absolute position embedding to the patch embedding. Default: False
         patch_norm (bool): If True, add normalization after patch embedding. Default: True
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False
+        attn_backend (str): Window attention backend: naive | sdpa | chunked. Default: naive
+        window_layout (bool): Keep activations in window-major order inside every stage. Default: False
     """
 
     def __init__(self, img_size=224, patch_size=4, in_chans=3, num_classes=1000,
@@ -496,7 +1014,7 @@ class SwinTransformer(nn.Module):
                  window_size=7, mlp_ratio=4., qkv_bias=True, qk_scale=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1,
                  norm_layer=nn.LayerNorm, ape=False, patch_norm=True,
-                 use_checkpoint=False, **kwargs):
+                 use_checkpoint=False, attn_backend="naive", window_layout=False, **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -540,7 +1058,9 @@ class SwinTransformer(nn.Module):
                                drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                                norm_layer=norm_layer,
                                downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                               use_checkpoint=use_checkpoint)
+                               use_checkpoint=use_checkpoint,
+                               attn_backend=attn_backend,
+                               window_layout=window_layout)
             self.layers.append(layer)
 
         self.norm = norm_layer(self.num_features)
@@ -567,13 +1087,15 @@ class SwinTransformer(nn.Module):
         return {'relative_position_bias_table'}
 
     def forward_features(self, x):
+        H, W = x.shape[2] // self.patch_embed.patch_size[0], x.shape[3] // self.patch_embed.patch_size[1]
         x = self.patch_embed(x)
         if self.ape:
             x = x + self.absolute_pos_embed
         x = self.pos_drop(x)
 
         for layer in self.layers:
-            x = layer(x)
+            x = layer(x, H, W)
+            H, W = layer.output_resolution(H, W)
 
         x = self.norm(x)  # B L C
         x = self.avgpool(x.transpose(1, 2))  # B C 1
@@ -603,8 +1125,8 @@ class Encoder(nn.Module):
                  window_size=7, mlp_ratio=4., qkv_bias=True, qk_scale=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1,
                  norm_layer=nn.LayerNorm, ape=False, patch_norm=True,
-                 use_checkpoint=False,
-                 dim_list=[192, 384, 768, 768], num_list=[150, 150, 150, 150], **kwargs):
+                 use_checkpoint=False, attn_backend="naive", window_layout=False,
+                 dim_list=[192, 384, 768, 768], num_list=[150, 150, 150, 150], exit_stage=None, **kwargs):
         super().__init__()
 
         self.img_size = img_size
@@ -617,6 +1139,11 @@ class Encoder(nn.Module):
 
         self.dim_list = dim_list
         self.num_list = num_list
+        # number of stages run by `forward_features`, fewer stages for a low-latency tier, can be changed at runtime
+        self.exit_stage = exit_stage or self.num_layers
+        assert 1 <= self.exit_stage <= self.num_layers, f"exit_stage must be in 1-{self.num_layers}"
+        # every stage has to tile into whole windows: patch_size * 2^(num_layers-1) * window_size
+        self.size_divisibility = to_2tuple(patch_size)[0] * 2 ** (self.num_layers - 1) * window_size
 
         # split image into non-overlapping patches
         self.patch_embed = PatchEmbed(
@@ -651,7 +1178,9 @@ class Encoder(nn.Module):
                                drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                                norm_layer=norm_layer,
                                downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                               use_checkpoint=use_checkpoint)
+                               use_checkpoint=use_checkpoint,
+                               attn_backend=attn_backend,
+                               window_layout=window_layout)
             self.layers.append(layer)
 
         # TODO: added
@@ -659,22 +1188,13 @@ class Encoder(nn.Module):
         for dim in self.dim_list:
             self.norm_list.append(norm_layer(dim))
         # TODO: added
+        # per-scale pooling derived from the stage resolution, `num_list` then holds the actual token counts
         self.pool_list = nn.ModuleList([])
-        if num_list[0] == 169:
-            self.pool_list.append(nn.AvgPool2d(kernel_size=7, stride=6))  # sqrt(7056): 84 -> 13
-            self.pool_list.append(nn.AvgPool2d(kernel_size=5, stride=3))  # sqrt(1764): 42 -> 13
-            self.pool_list.append(nn.AvgPool2d(kernel_size=9, stride=1))  # sqrt(441): 21 -> 13
-            self.pool_list.append(nn.AvgPool2d(kernel_size=9, stride=1))  # sqrt(441): 21 -> 13
-        elif num_list[0] == 225:
-            self.pool_list.append(nn.AvgPool2d(kernel_size=10, stride=5))  # sqrt(7056): 84 -> 15
-            self.pool_list.append(nn.AvgPool2d(kernel_size=13, stride=2))  # sqrt(1764): 42 -> 15
-            self.pool_list.append(nn.AvgPool2d(kernel_size=7, stride=1))  # sqrt(441): 21 -> 15
-            self.pool_list.append(nn.AvgPool2d(kernel_size=7, stride=1))  # sqrt(441): 21 -> 15
-        elif num_list[0] == 289:
-            self.pool_list.append(nn.AvgPool2d(kernel_size=12, stride=5))  # sqrt(9216): 96 -> 17
-            self.pool_list.append(nn.AvgPool2d(kernel_size=15, stride=2))  # sqrt(2304): 48 -> 17
-            self.pool_list.append(nn.AvgPool2d(kernel_size=8, stride=1))  # sqrt(576): 24 -> 17
-            self.pool_list.append(nn.AvgPool2d(kernel_size=8, stride=1))  # sqrt(576): 24 -> 17
+        H, W = patches_resolution
+        for layer, num_tokens in zip(self.layers, num_list):
+            H, W = layer.output_resolution(H, W)
+            self.pool_list.append(TokenPool((H, W), num_tokens))
+        self.num_list = [pool.num_tokens for pool in self.pool_list]
 
         # self.pool_list = nn.ModuleList([])
         # for n in self.num_list:
@@ -704,10 +1224,25 @@ class Encoder(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
-    def forward_features(self, x):
+    def forward_features(self, x, mask=None):
+        """
+        Args:
+            x: (B, 3, H, W)
+            mask: (B, H, W) bool padding mask of a NestedTensor, True on padding, or None
+        """
+        B, _, H, W = x.shape
+        if H % self.size_divisibility != 0 or W % self.size_divisibility != 0:
+            raise ValueError(f"Input image size ({H}*{W}) must be divisible by {self.size_divisibility}.")
+        H, W = H // self.patch_embed.patch_size[0], W // self.patch_embed.patch_size[1]
+
         x = self.patch_embed(x)
         if self.ape:
-            x = x + self.absolute_pos_embed
+            pos = self.absolute_pos_embed
+            if pos.shape[1] != H * W:
+                Ph, Pw = self.patches_resolution
+                pos = F.interpolate(pos.transpose(1, 2).reshape(1, -1, Ph, Pw), size=(H, W), mode='bicubic',
+                                    align_corners=False).flatten(2).transpose(1, 2)
+            x = x + pos
         x = self.pos_drop(x)
 
         # for layer in self.layers:
@@ -719,16 +1254,20 @@ class Encoder(nn.Module):
         # x = torch.flatten(x, 1)
         # return x
 
+        # padded windows are skipped / padded keys masked, only worth it if there is padding at all
+        pad_mask = pad_mask_to_grid(mask, H, W) if mask is not None and mask.any() else None
+
         out_list = torch.jit.annotate(List[Tensor], [])
-        for layer, norm, pool in zip(self.layers, self.norm_list, self.pool_list):
-            x = layer(x)
+        for layer, norm, pool in zip(self.layers[:self.exit_stage], self.norm_list, self.pool_list):
+            x = layer(x, H, W, pad_mask)
+            H, W = layer.output_resolution(H, W)
+            if pad_mask is not None:
+                pad_mask = pad_mask_to_grid(pad_mask, H, W)
             t = norm(x).transpose(1, 2)
             # t = rearrange(t, "b d (e1 e2) -> b d e1 e2", e1=e, e2=e)
             # t = rearrange(pool(t), "b d e1 e2 -> b (e1 e2) d")
-            B, D, EE = t.shape
-            E = int(EE ** 0.5)
-            t = t.view(B, D, E, E)
-            t = pool(t).flatten(2).transpose(1, 2)
+            t = t.view(B, -1, H, W)
+            t = pool(t)  # B, n, D
             # print(t.size())
             # t = pool(t).transpose(1, 2)
             out_list.append(t)
@@ -738,8 +1277,51 @@ class Encoder(nn.Module):
 
         return out_list
 
-    def forward(self, x):
-        x = self.forward_features(x)
+    def init_reuse_state(self):
+        """ Empty per-stream state of `forward_features_reuse` """
+        return {"blocks": [[{} for _ in layer.blocks] for layer in self.layers], "tokens": [None] * len(self.layers)}
+
+    @torch.no_grad()
+    def forward_features_reuse(self, x, state, threshold=0.):
+        """
+        `forward_features` of the next frame of a stream (no padding), reusing the window outputs of the previous
+        frames, see `SwinTransformerBlock.forward_reuse`. The pooled tokens of a stage are only recomputed if one
+        of its windows was.
+
+        Args:
+            x: (B, 3, H, W)
+            state: from `init_reuse_state`, updated in place
+            threshold (float): max abs input change of a window below which its cached output is kept
+        Returns:
+            out_list, (recomputed windows, total windows)
+        """
+        B, _, H, W = x.shape
+        if H % self.size_divisibility != 0 or W % self.size_divisibility != 0:
+            raise ValueError(f"Input image size ({H}*{W}) must be divisible by {self.size_divisibility}.")
+        H, W = H // self.patch_embed.patch_size[0], W // self.patch_embed.patch_size[1]
+
+        x = self.patch_embed(x)
+        if self.ape:
+            pos = self.absolute_pos_embed
+            if pos.shape[1] != H * W:
+                Ph, Pw = self.patches_resolution
+                pos = F.interpolate(pos.transpose(1, 2).reshape(1, -1, Ph, Pw), size=(H, W), mode='bicubic',
+                                    align_corners=False).flatten(2).transpose(1, 2)
+            x = x + pos
+
+        out_list = []
+        recomputed = total = 0
+        for i, (layer, norm, pool) in enumerate(zip(self.layers[:self.exit_stage], self.norm_list, self.pool_list)):
+            x, n, windows = layer.forward_reuse(x, H, W, state["blocks"][i], threshold)
+            recomputed, total = recomputed + n, total + windows
+            H, W = layer.output_resolution(H, W)
+            if n > 0 or state["tokens"][i] is None:
+                state["tokens"][i] = pool(norm(x).transpose(1, 2).view(B, -1, H, W))
+            out_list.append(state["tokens"][i])
+        return out_list, (recomputed, total)
+
+    def forward(self, x, mask=None):
+        x = self.forward_features(x, mask=mask)
         return x
 
     def flops(self):
@@ -847,23 +1429,18 @@ def swin_base_patch4_window12_384_22kto1k_finetune(pretrain=None):
     return model
 
 
-def encoder_tiny_672_192(pretrain=None):
+def encoder_tiny_672_192(pretrain=None, attn_backend="naive", window_layout=False, num_list=None,
+                         use_checkpoint=False):
     dim_list = [192, 384, 768, 768]
-    num_list = [169, 169, 169, 169]
+    num_list = num_list or [169, 169, 169, 169]
     encoder = Encoder(img_size=672,
                       num_classes=0,
                       embed_dim=96, depths=[2, 2, 6, 2], num_heads=[3, 6, 12, 24], window_size=7,
                       drop_path_rate=.1,
-                      dim_list=dim_list, num_list=num_list, name="tiny")
+                      dim_list=dim_list, num_list=num_list, attn_backend=attn_backend, window_layout=window_layout,
+                      use_checkpoint=use_checkpoint, name="tiny")
     if pretrain:
         checkpoint = torch.load(pretrain, map_location='cpu')
-        pop_list = []
-        for k in checkpoint["model"].keys():
-            if str(k).split(".")[-1] == "attn_mask":
-                pop_list.append(k)
-        for p in pop_list:
-            # print(p)
-            checkpoint["model"].pop(p)
         encoder.load_state_dict(checkpoint["model"], strict=False)
         print("encoder_tiny_672_192 built!\n"
               "\tWeights: `swin_tiny_patch4_window7_224_22kto1k_finetune` loaded!")
@@ -871,22 +1448,18 @@ def encoder_tiny_672_192(pretrain=None):
     return encoder
 
 
-def encoder_small_672_384(pretrain=None):
+def encoder_small_672_384(pretrain=None, attn_backend="naive", window_layout=False, num_list=None,
+                          use_checkpoint=False):
     dim_list = [192, 384, 768, 768]
-    num_list = [225, 225, 225, 225]
+    num_list = num_list or [225, 225, 225, 225]
     encoder = Encoder(img_size=672,
                       num_classes=0,
                       embed_dim=96, depths=[2, 2, 18, 2], num_heads=[3, 6, 12, 24], window_size=7,
                       drop_path_rate=.2,
-                      dim_list=dim_list, num_list=num_list)
+                      dim_list=dim_list, num_list=num_list, attn_backend=attn_backend, window_layout=window_layout,
+                      use_checkpoint=use_checkpoint)
     if pretrain:
         checkpoint = torch.load(pretrain, map_location='cpu')
-        pop_list = []
-        for k in checkpoint["model"].keys():
-            if str(k).split(".")[-1] == "attn_mask":
-                pop_list.append(k)
-        for p in pop_list:
-            checkpoint["model"].pop(p)
         encoder.load_state_dict(checkpoint["model"], strict=False)
         print("encoder_small_672_384 built!\n"
               "\tWeights: `swin_small_patch4_window7_224_22kto1k_finetune` loaded!")
@@ -894,23 +1467,18 @@ def encoder_small_672_384(pretrain=None):
     return encoder
 
 
-def encoder_base_768_768(pretrain=None):
+def encoder_base_768_768(pretrain=None, attn_backend="naive", window_layout=False, num_list=None,
+                         use_checkpoint=False):
     dim_list = [256, 512, 1024, 1024]
-    num_list = [289, 289, 289, 289]
+    num_list = num_list or [289, 289, 289, 289]
     encoder = Encoder(img_size=768,
                       num_classes=0,
                       embed_dim=128, depths=[2, 2, 18, 2], num_heads=[4, 8, 16, 32], window_size=12,
                       drop_path_rate=.2,
-                      dim_list=dim_list, num_list=num_list)
+                      dim_list=dim_list, num_list=num_list, attn_backend=attn_backend, window_layout=window_layout,
+                      use_checkpoint=use_checkpoint)
     if pretrain:
         checkpoint = torch.load(pretrain, map_location='cpu')
-        pop_list = []
-        for k in checkpoint["model"].keys():
-            if str(k).split(".")[-1] == "attn_mask":
-                pop_list.append(k)
-        for p in pop_list:
-            # print(p)
-            checkpoint["model"].pop(p)
         encoder.load_state_dict(checkpoint["model"], strict=False)
         print("encoder_small_768_768 built!\n"
               "\tWeights: `swin_base_patch4_window12_384_22kto1k_finetune` loaded!")
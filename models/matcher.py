@@ -2,11 +2,15 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
-from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+from models.auction import auction_assignment
+from util.box_ops import matching_cost
 
 
 class HungarianMatcher(nn.Module):
@@ -17,20 +21,82 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, num_workers: int = 0,
+                 solver: str = "scipy", auction_eps: float = 1e-3, memory_mb: float = 256):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_workers: threads solving the assignments of the images concurrently (scipy releases the GIL),
+                0 solves them one after the other. The threads are started on the first call and stopped by
+                `close` (or when the matcher is garbage collected)
+            solver: "scipy" solves the assignments exactly on the CPU, "auction" solves the whole batch on the
+                device of the predictions (no host copy of the costs), within len(targets) * auction_eps of the
+                optimal cost of every image
+            auction_eps: bid increment of the last epsilon scaling phase of the auction solver
+            memory_mb: budget of the temporaries of the cost computation, the cost is computed by blocks of
+                targets within it (crowded images)
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        self.num_workers = num_workers
+        assert solver in ("scipy", "auction"), f"unknown assignment solver {solver}"
+        self.solver = solver
+        self.auction_eps = auction_eps
+        self.memory_mb = memory_mb
+        self._pool = None  # (number of threads, executor)
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
+    def __getstate__(self):
+        # threads cannot be pickled / deep-copied, a copy starts its own pool
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Stops the assignment threads, the next call starts them again """
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            self._pool = None
+            pool[1].shutdown(wait=False)
+
+    def assignment_pool(self):
+        if self._pool is not None and self._pool[0] != self.num_workers:
+            self.close()
+        if self._pool is None:
+            self._pool = (self.num_workers, ThreadPoolExecutor(self.num_workers, thread_name_prefix="matcher"))
+        return self._pool[1]
+
+    @torch.no_grad()
+    def cost_matrices(self, outputs, targets):
+        """ Matching cost between the predictions and the targets of every image, the images are batched by
+        padding the targets to the largest count, so no cost between an image and the targets of another one is
+        computed (O(B * Q * max T) instead of O(B * Q * B * mean T)).
+
+        Returns:
+            [batch_size, num_queries, max_num_targets] cost, only the first len(targets[i]["boxes"]) columns of
+            image i are meaningful
+        """
+        out_prob = outputs["pred_logits"].softmax(-1)  # [batch_size, num_queries, num_classes]
+        out_bbox = outputs["pred_boxes"]  # [batch_size, num_queries, 4]
+
+        # the padding boxes only need to be valid boxes
+        tgt_ids = pad_sequence([v["labels"] for v in targets], batch_first=True)
+        tgt_bbox = pad_sequence([v["boxes"] for v in targets], batch_first=True, padding_value=0.5)
+
+        # Final cost matrix: L1 + giou cost between boxes, and the classification cost. Contrary to the loss,
+        # we don't use the NLL, but approximate it in 1 - proba[target class].
+        # The 1 is a constant that doesn't change the matching, it can be ommitted.
+        return matching_cost(out_prob, out_bbox, tgt_ids, tgt_bbox, self.cost_class, self.cost_bbox, self.cost_giou,
+                             max_bytes=int(self.memory_mb * 2 ** 20))
+
     @torch.no_grad()
     def forward(self, outputs, targets):
         """ Performs the matching
@@ -52,35 +118,23 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        bs, num_queries = outputs["pred_logits"].shape[:2]
-
-        # We flatten to compute the cost matrices in a batch
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
-
-        # Also concat the target labels and boxes
-        tgt_ids = torch.cat([v["labels"] for v in targets])
-        tgt_bbox = torch.cat([v["boxes"] for v in targets])
-
-        # Compute the classification cost. Contrary to the loss, we don't use the NLL,
-        # but approximate it in 1 - proba[target class].
-        # The 1 is a constant that doesn't change the matching, it can be ommitted.
-        cost_class = -out_prob[:, tgt_ids]
-
-        # Compute the L1 cost between boxes
-        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
-
-        # Compute the giou cost betwen boxes
-        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
-
-        # Final cost matrix
-        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
-
         sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+        if self.solver == "auction":
+            C = self.cost_matrices(outputs, targets)
+            return auction_assignment(C, [C.shape[1]] * len(sizes), sizes, eps=self.auction_eps)
+
+        # the padding columns are dropped before the host copy, image i hands [num_queries, sizes[i]] to scipy
+        C = self.cost_matrices(outputs, targets)
+        C = torch.cat([c[:, :n] for c, n in zip(C, sizes)], dim=1).cpu()
+        blocks = C.split(sizes, dim=1)
+        if self.num_workers > 0 and len(blocks) > 1:
+            indices = list(self.assignment_pool().map(linear_sum_assignment, blocks))
+        else:
+            indices = [linear_sum_assignment(c) for c in blocks]
         return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
 
 def build_matcher(args):
-    return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou)
+    return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou,
+                            num_workers=args.matcher_workers, solver=args.matcher_solver,
+                            auction_eps=args.auction_eps, memory_mb=args.matcher_memory_mb)
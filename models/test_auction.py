@@ -0,0 +1,54 @@
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from models.auction import auction_assignment
+from models.matcher import HungarianMatcher
+from util.benchmark import synthetic_matching
+
+
+def _assert_near_optimal(cost, indices, eps):
+    """ Every image is fully matched, at most len(targets) * eps above the optimal (scipy) assignment """
+    for c, (i, j) in zip(cost, indices):
+        n = c.shape[1]
+        assert len(i) == n and len(i.unique()) == n and len(j.unique()) == n, "incomplete auction assignment"
+        ri, rj = linear_sum_assignment(c.numpy())
+        gap = (c[i, j].sum() - c[ri, rj].sum()).item() / (n * eps)
+        assert gap <= 1 + 1e-3, f"auction assignment is {gap:.3f} x len(targets) * eps above the optimum"
+
+
+def test_auction_matcher_is_within_the_bound(eps=1e-3):
+    outputs, targets = synthetic_matching(16)
+    indices = HungarianMatcher(1, 5, 2, solver="auction", auction_eps=eps)(outputs, targets)
+    cost = HungarianMatcher(1, 5, 2).cost_matrices(outputs, targets)
+    sizes = [len(t["boxes"]) for t in targets]
+    _assert_near_optimal([c[:, :n] for c, n in zip(cost, sizes)], indices, eps)
+
+
+def test_auction_price_war(eps=1e-3):
+    """ Every target prefers the same few queries, a single phase auction needs spread / eps rounds """
+    war = torch.full((4, 100, 20), 10.)
+    war[:, :19] = 0.
+    war += torch.rand(war.shape, generator=torch.Generator().manual_seed(0)) * 1e-6
+    _assert_near_optimal(war, auction_assignment(war, [100] * 4, [20] * 4, eps=eps), eps)
+
+
+def test_auction_random_sizes(eps=.05):
+    """ Padded costs of both orientations, including images without any row or column """
+    g = torch.Generator().manual_seed(0)
+    rows, cols = [5, 3, 0, 7, 6], [3, 5, 4, 7, 0]
+    cost = torch.rand(len(rows), max(rows), max(cols), generator=g) * 10
+    indices = auction_assignment(cost, rows, cols, eps=eps)
+    for c, (i, j), r, n in zip(cost, indices, rows, cols):
+        c = c[:r, :n]
+        m = min(r, n)
+        assert len(i) == len(j) == m and len(i.unique()) == len(j.unique()) == m
+        if m:
+            ri, rj = linear_sum_assignment(c.numpy())
+            assert (c[i, j].sum() - c[ri, rj].sum()).item() <= m * eps + 1e-4
+
+
+def test_auction_without_targets():
+    outputs, targets = synthetic_matching(4)
+    empty = [{"labels": t["labels"][:0], "boxes": t["boxes"][:0]} for t in targets]
+    for i, j in HungarianMatcher(1, 5, 2, solver="auction")(outputs, empty):
+        assert len(i) == len(j) == 0 and i.dtype == j.dtype == torch.int64
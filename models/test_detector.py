@@ -0,0 +1,92 @@
+import pytest
+import torch
+
+from models.detector import swin_ssd_tiny, PostProcess
+from util.benchmark import synthetic_detections, reference_postprocess
+
+
+def _max_result_diff(results, reference):
+    diff = 0.
+    for r, ref in zip(results, reference):
+        assert torch.equal(r["labels"], ref["labels"]), "different detections"
+        diff = max([diff] + [(r[k].float() - ref[k].float()).abs().max().item() for k in ("scores", "boxes")
+                             if len(ref[k])])
+    return diff
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("exit_stage", [2, 3])
+def test_exit_stage(exit_stage):
+    """ The encoder stopped after stage k returns the first k scales of the full encoder, the neck slices the pos
+    embeddings of those scales, and `set_exit_stage` freezes only the skipped stages and projections """
+    model = swin_ssd_tiny().eval()
+    keys = set(model.state_dict())
+    neck, encoder = model.backbone, model.backbone.encoder
+    x = torch.randn(1, 3, 672, 672)
+    full = encoder(x)
+    model.set_exit_stage(exit_stage)
+    out = encoder(x)
+    assert len(out) == exit_stage
+    assert all(torch.equal(o, r) for o, r in zip(out, full))
+
+    num_patches = sum(t.shape[1] for t in out)
+    interpolations = neck.pos_interpolations
+    pos = neck.get_pos_embed(num_patches, num_scales=exit_stage)
+    expected = torch.cat((neck.pos_embed[:, :1 + num_patches], neck.pos_embed[:, -neck.det_token_num:]), dim=1)
+    assert neck.pos_interpolations == interpolations and torch.equal(pos, expected), "pos embeddings not sliced"
+
+    skipped = list(encoder.layers[exit_stage:]) + list(encoder.norm_list[exit_stage:]) + \
+        [proj for proj in neck.scale_projections()[exit_stage:] if proj is not None]
+    frozen = {id(p) for m in skipped for p in m.parameters()}
+    assert all(p.requires_grad != (id(p) in frozen) for p in model.parameters()), "wrong frozen parameters"
+    assert set(model.state_dict()) == keys, "the parameter set changed"
+    with torch.enable_grad():
+        model(x)["pred_boxes"].sum().backward()
+    assert all(p.grad is None for m in skipped for p in m.parameters()), "gradient of a skipped stage"
+
+
+@torch.no_grad()
+def test_postprocess_matches_per_image_references(batch_size=8, top_k=100, score_threshold=.05, nms_threshold=.5):
+    """ The padded path without filtering gives one row per det token output (sorted by score), and the filtered
+    path the per-image top-k + threshold + class-wise `torchvision.ops.nms` loop """
+    outputs, target_sizes = synthetic_detections(batch_size)
+    legacy = PostProcess()(outputs, target_sizes)
+    padded = PostProcess().forward_padded(outputs, target_sizes)
+    assert (padded["num_valid"] == outputs["pred_logits"].shape[1]).all(), "unfiltered rows dropped"
+    sorted_legacy = [{k: v[r["scores"].argsort(descending=True)] for k, v in r.items()} for r in legacy]
+    assert _max_result_diff([{k: padded[k][i] for k in ("scores", "labels", "boxes")} for i in range(batch_size)],
+                            sorted_legacy) < 1e-4
+
+    reference = reference_postprocess(outputs, target_sizes, top_k, score_threshold, nms_threshold)
+    assert sum(len(r["scores"]) for r in reference) < batch_size * top_k, "nothing filtered"
+    filtered = PostProcess(top_k, score_threshold, nms_threshold)(outputs, target_sizes)
+    assert _max_result_diff(filtered, reference) < 1e-4
+
+
+@torch.no_grad()
+def test_postprocess_empty_batch():
+    outputs, target_sizes = synthetic_detections(1)
+    empty = {k: v[:0] for k, v in outputs.items()}
+    for postprocess in (PostProcess(), PostProcess(100, .05, .5)):
+        assert postprocess(empty, target_sizes[:0]) == []
+
+
+def test_raising_the_exit_stage_unfreezes_the_stages_it_runs_again():
+    model = swin_ssd_tiny()
+    model.backbone.encoder.layers[0].requires_grad_(False)  # frozen by the user, stays frozen
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    model.set_exit_stage(2)
+    model.set_exit_stage(3)
+    encoder = model.backbone.encoder
+    assert not any(p.requires_grad for p in encoder.layers[3].parameters())
+    assert all(p.requires_grad for p in encoder.layers[2].parameters())
+    model.set_exit_stage(None)
+    assert encoder.exit_stage == 4
+    assert {name for name, p in model.named_parameters() if p.requires_grad} == trainable
+
+    model.set_exit_stage(2)
+    model.freeze_encoder()
+    model.set_exit_stage(None)
+    assert not any(p.requires_grad for p in encoder.parameters()), "encoder unfrozen despite freeze_encoder"
+    assert {name for name, p in model.named_parameters() if p.requires_grad} == \
+        {name for name in trainable if not name.startswith("backbone.encoder.")}
@@ -0,0 +1,164 @@
+import copy
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.encoder import encoder_tiny_672_192, WindowAttention, relative_position_index, compute_shift_mask
+from util.benchmark import with_attn_backend
+
+IMG_SIZE = 672
+
+# per-scale pooling of the released checkpoints before `TokenPool`: per-scale count -> [(kernel, stride)] per stage
+FIXED_POOLS = {
+    169: [(7, 6), (5, 3), (9, 1), (9, 1)],
+    225: [(10, 5), (13, 2), (7, 1), (7, 1)],
+    289: [(12, 5), (15, 2), (8, 1), (8, 1)],
+}
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    torch.manual_seed(0)
+    return encoder_tiny_672_192().eval()
+
+
+def _reference_bias(attn):
+    """ Relative position bias gathered from the table, bypassing the cache """
+    N = attn.window_size[0] * attn.window_size[1]
+    table = attn.relative_position_bias_table.detach()
+    index = relative_position_index(attn.window_size, device=table.device)
+    return table[index.view(-1)].view(N, N, -1).permute(2, 0, 1).unsqueeze(0)
+
+
+def _stage_outputs(encoder, x, mask=None):
+    """ (B, C, H, W) output of every encoder stage """
+    outputs = []
+
+    def hook(layer, inputs, out):
+        H, W = layer.output_resolution(*inputs[1:3])
+        outputs.append(out.transpose(1, 2).reshape(out.shape[0], -1, H, W))
+
+    handles = [layer.register_forward_hook(hook) for layer in encoder.layers]
+    try:
+        encoder(x, mask=mask)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return outputs
+
+
+def _max_diff(outputs, reference):
+    return max((o - r).abs().max().item() for o, r in zip(outputs, reference))
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("backend", ["sdpa", "chunked"])
+def test_window_attention_backends_match_naive(encoder, backend):
+    x = torch.randn(1, 3, IMG_SIZE, IMG_SIZE)
+    assert _max_diff(with_attn_backend(encoder, backend)(x), encoder(x)) < 1e-4
+
+
+def test_relative_bias_cache():
+    encoder = encoder_tiny_672_192().eval()
+    attns = [m for m in encoder.modules() if isinstance(m, WindowAttention)]
+    x = torch.randn(1, 3, IMG_SIZE, IMG_SIZE)
+
+    uncached = [o.detach() for o in encoder(x)]
+    assert all(m._bias_cache is None for m in attns), "bias cached while a gradient can reach the table"
+    with torch.no_grad():
+        encoder(x)
+        biases = [m.get_relative_position_bias() for m in attns]
+        assert all(b is m.get_relative_position_bias() for b, m in zip(biases, attns)), "bias cache miss"
+        assert _max_diff(encoder(x), uncached) == 0
+        assert all(torch.equal(b, _reference_bias(m)) for b, m in zip(biases, attns))
+
+    # one optimizer step updates the tables in place
+    optimizer = torch.optim.SGD([m.relative_position_bias_table for m in attns], lr=1.)
+    for m in attns:
+        m.relative_position_bias_table.grad = torch.randn_like(m.relative_position_bias_table)
+    optimizer.step()
+    with torch.no_grad():
+        updated = [m.get_relative_position_bias() for m in attns]
+        assert all((u - b).abs().max() > 0 for u, b in zip(updated, biases)), "stale bias after an update"
+        assert all(torch.equal(u, _reference_bias(m)) for u, m in zip(updated, attns))
+
+
+@torch.no_grad()
+def test_resolution_caches_match_fresh_encoders(encoder, cache_size=2):
+    """ Cycling through several input shapes with small geometry LRU caches (evicted and rebuilt shift masks)
+    gives the outputs of a fresh encoder per shape, and every cached shift mask is the one built from scratch """
+    encoder = copy.deepcopy(encoder)
+    step = encoder.size_divisibility
+    shapes = [(IMG_SIZE, IMG_SIZE - step), (IMG_SIZE - step, IMG_SIZE), (IMG_SIZE, IMG_SIZE),
+              (IMG_SIZE - step, IMG_SIZE - step)]
+    inputs = {shape: torch.randn(1, 3, *shape) for shape in shapes}
+    reference = {shape: copy.deepcopy(encoder)(x) for shape, x in inputs.items()}
+    for layer in encoder.layers:
+        layer.geometry.cache_size = cache_size
+
+    for shape in shapes + shapes[::-1]:
+        assert _max_diff(encoder(inputs[shape]), reference[shape]) == 0, f"{shape}: cached geometry"
+        H, W = shape[0] // encoder.patch_embed.patch_size[0], shape[1] // encoder.patch_embed.patch_size[1]
+        for layer in encoder.layers:
+            assert len(layer.geometry._cache) <= cache_size, "geometry cache exceeds its size"
+            for blk in layer.blocks:
+                mask, shift_size = blk.get_attn_mask(H, W, torch.device("cpu")), blk.get_shift_size(H, W)
+                if shift_size > 0:
+                    assert torch.equal(mask, compute_shift_mask(H, W, blk.window_size, shift_size)), \
+                        f"{shape}: cached shift mask"
+            H, W = layer.output_resolution(H, W)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("builder", ["encoder_tiny_672_192", "encoder_small_672_384", "encoder_base_768_768"])
+def test_default_token_pools_match_the_fixed_table(builder):
+    import models.encoder
+
+    encoder = getattr(models.encoder, builder)()
+    for pool, (kernel, stride) in zip(encoder.pool_list, FIXED_POOLS[encoder.num_list[0]]):
+        x = torch.randn(1, 8, *pool.resolution)
+        assert torch.equal(pool(x), F.avg_pool2d(x, kernel, stride).flatten(2).transpose(1, 2))
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("num_list", [[300, 200, 100, 0], [50, 100, 200, 400]])
+def test_token_pools_keep_the_stage_aspect_ratio(num_list):
+    encoder = encoder_tiny_672_192(num_list=num_list).eval()
+    out = encoder(torch.randn(1, 3, IMG_SIZE, IMG_SIZE))
+    assert [t.shape[1] for t in out] == encoder.num_list
+    for pool, requested in zip(encoder.pool_list, num_list):
+        (gh, gw), (Rh, Rw) = pool.grid, pool.resolution
+        # up to rounding of the grid sides
+        assert requested == 0 or abs(gh / gw - Rh / Rw) <= Rh / Rw * 2 / min(gh, gw), \
+            f"grid {pool.grid} of a {pool.resolution} stage"
+
+
+@torch.no_grad()
+def test_window_layout_matches_row_major(encoder):
+    encoder = copy.deepcopy(encoder)
+    x = torch.randn(1, 3, IMG_SIZE, IMG_SIZE)
+    reference = encoder(x)
+    for layer in encoder.layers:
+        layer.window_layout = True
+    assert _max_diff(encoder(x), reference) < 1e-5
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("window_layout", [False, True])
+def test_padded_image_matches_the_image_alone(encoder, window_layout):
+    """ On the valid region of every stage, an image padded in a batch (fully padded windows skipped, padded keys
+    masked) gives the outputs of the same image run alone """
+    encoder = copy.deepcopy(encoder)
+    for layer in encoder.layers:
+        layer.window_layout = window_layout
+    width = IMG_SIZE - encoder.size_divisibility
+    image = torch.randn(1, 3, IMG_SIZE, width)
+    batch = torch.randn(2, 3, IMG_SIZE, IMG_SIZE)
+    batch[0, :, :, :width] = image[0]
+    mask = torch.zeros(2, IMG_SIZE, IMG_SIZE, dtype=torch.bool)
+    mask[0, :, width:] = True
+
+    reference = _stage_outputs(encoder, image)
+    out = _stage_outputs(encoder, batch, mask)
+    assert max((o[:1, :, :, :r.shape[-1]] - r).abs().max().item() for o, r in zip(out, reference)) < 1e-5
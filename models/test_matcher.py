@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from models.matcher import HungarianMatcher
+from util.benchmark import synthetic_matching, flattened_matching, unfused_cost_matrices
+
+
+def matching_cost(matcher, outputs, targets, indices):
+    """ Total cost of the assignments `indices` of every image """
+    C = matcher.cost_matrices(outputs, targets).cpu()
+    return torch.stack([C[b, i, j].sum() for b, (i, j) in enumerate(indices)])
+
+
+@pytest.mark.parametrize("num_workers", [0, 4])
+def test_block_matcher_matches_the_flattened_one(num_workers):
+    outputs, targets = synthetic_matching(8)
+    matcher = HungarianMatcher(1, 5, 2, num_workers=num_workers)
+    reference = matching_cost(matcher, outputs, targets, flattened_matching(matcher, outputs, targets))
+    cost = matching_cost(matcher, outputs, targets, matcher(outputs, targets))
+    assert (cost - reference).abs().max().item() < 1e-4
+    matcher.close()
+
+
+@pytest.mark.parametrize("memory_mb", [0, 1])
+def test_fused_cost_matches_the_unfused_one(memory_mb):
+    """ One block of targets with budget 0, several otherwise """
+    outputs, targets = synthetic_matching(4, max_targets=300)
+    matcher = HungarianMatcher(1, 5, 2, memory_mb=memory_mb)
+    reference = unfused_cost_matrices(matcher, outputs, targets)
+    assert (matcher.cost_matrices(outputs, targets) - reference).abs().max().item() < 1e-5
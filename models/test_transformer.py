@@ -0,0 +1,147 @@
+import copy
+
+import pytest
+import torch
+
+from models.detector import swin_ssd_tiny
+from models.transformer import deit_tiny_patch16_224, select_tokens
+from util.benchmark import with_attn_backend, random_features
+
+
+def _with_attention_mask(model, mask):
+    """ Copy of the detector whose neck blocks run dense attention with the additive (N, N) `mask` """
+    def masked(attn):
+        def forward(x, sparse_index=None):
+            B, N, C = x.shape
+            q, k, v = attn.qkv(x).reshape(B, N, 3, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)
+            x = ((q @ k.transpose(-2, -1)) * attn.scale + mask).softmax(dim=-1) @ v
+            return attn.proj(x.transpose(1, 2).reshape(B, N, C))
+        return forward
+
+    model = copy.deepcopy(model)
+    for blk in model.backbone.blocks:
+        blk.attn.forward = masked(blk.attn)
+    return model
+
+
+def _max_output_diff(out, reference):
+    return max((out[k] - reference[k]).abs().max().item() for k in reference)
+
+
+def test_pos_embed_cache(lengths=(400, 500, 600), cache_size=2):
+    """ The resized neck pos embeddings are cached and bounded in eval under no_grad, uncached while a gradient
+    can reach `pos_embed` and not stale after an in-place (optimizer) update; the length of the first two scales
+    requested with 2 scales (sliced) and 4 scales (interpolated) must not share a cache entry """
+    neck = swin_ssd_tiny().backbone.eval()
+    neck.pos_cache_size = cache_size
+
+    def fresh(n):
+        return neck.pos_interpolation(pos_embed=neck.pos_embed.detach(), actual_len=n)
+
+    with torch.no_grad():
+        for n in list(lengths) * 2:
+            pos = neck.get_pos_embed(n)
+            count = neck.pos_interpolations
+            assert torch.equal(neck.get_pos_embed(n), pos) and neck.pos_interpolations == count, f"{n}: cache miss"
+            assert len(neck._pos_cache) <= cache_size, "pos cache exceeds its size"
+            assert torch.equal(pos, fresh(n))
+
+        n = sum(neck.encoder.num_list[:2])
+        sliced = torch.cat((neck.pos_embed[:, :1 + n], neck.pos_embed[:, -neck.det_token_num:]), dim=1)
+        for _ in range(2):
+            assert torch.equal(neck.get_pos_embed(n, num_scales=2), sliced)
+            assert torch.equal(neck.get_pos_embed(n, num_scales=4), fresh(n))
+        before = neck.get_pos_embed(lengths[0])
+
+    count = neck.pos_interpolations
+    pos = neck.get_pos_embed(lengths[0])
+    assert pos.requires_grad and neck.pos_interpolations == count + 1, "cached while pos_embed needs a gradient"
+    assert torch.equal(pos, fresh(lengths[0]))
+
+    optimizer = torch.optim.SGD([neck.pos_embed], lr=1.)
+    neck.pos_embed.grad = torch.randn_like(neck.pos_embed)
+    optimizer.step()
+    with torch.no_grad():
+        after = neck.get_pos_embed(lengths[0])
+        assert (after - before).abs().max() > 0, "stale pos embeddings after an update"
+        assert torch.equal(after, fresh(lengths[0]))
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("backend", ["sdpa", "chunked"])
+def test_neck_attention_backends_match_naive(backend):
+    blocks = deit_tiny_patch16_224().blocks.eval()
+    # cls + default pooled tokens + det tokens
+    x = torch.randn(1, 1 + 676 + 100, blocks[0].norm1.normalized_shape[0])
+    assert (with_attn_backend(blocks, backend)(x) - blocks(x)).abs().max().item() < 1e-4
+
+
+@torch.no_grad()
+def test_keeping_all_tokens_matches_the_dense_neck():
+    model = swin_ssd_tiny(keep_tokens=1).eval()
+    features = random_features(model, 2)
+    num_patches = sum(f.shape[1] for f in features)
+    model.backbone.keep_tokens = 0
+    dense = model(None, features=features)
+    for k in (num_patches, num_patches + 1):
+        model.backbone.keep_tokens = k
+        assert _max_output_diff(model(None, features=features), dense) == 0, f"keep_tokens {k}"
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("k", [100, 300])
+def test_token_selection_keeps_the_top_k_in_order(k):
+    x, pos, scores = torch.randn(2, 676, 192), torch.randn(1, 676, 192), torch.randn(2, 676)
+    kept, kept_pos, index = select_tokens(x, pos, scores, k)
+    assert torch.equal(index, scores.topk(k, dim=1).indices.sort(dim=1).values)
+    assert torch.allclose(kept, x.gather(1, index[..., None].expand(-1, -1, x.shape[-1])))
+    assert torch.equal(kept_pos, pos[0][index])
+
+    model = swin_ssd_tiny(keep_tokens=k).eval()
+    features = random_features(model, 2)
+    out = model(None, features=features)
+    model.backbone.keep_tokens = 0
+    dense = model(None, features=features)
+    assert all(out[key].shape == dense[key].shape for key in dense)
+
+
+@torch.no_grad()
+def test_pruned_det_tokens_match_masked_keys(tmp_path, keep_det=60):
+    """ A pruned detector gives the outputs of the full one on the surviving slots when the pruned det tokens are
+    masked out as keys, and a fresh detector loads it strictly from its checkpoint """
+    model = swin_ssd_tiny().eval()
+    neck = model.backbone
+    features = random_features(model, 2)
+    num_det = neck.det_token_num
+    keep = torch.randperm(num_det)[:keep_det].sort().values
+
+    N = 1 + sum(f.shape[1] for f in features) + num_det
+    pruned_keys = torch.ones(num_det, dtype=torch.bool).index_fill_(0, keep, False)
+    mask = torch.zeros(N, N)
+    mask[:, N - num_det:][:, pruned_keys] = float("-inf")
+    reference = _with_attention_mask(model, mask)(None, features=features)
+
+    neck.prune_det_tokens(keep)
+    out = model(None, features=features)
+    assert _max_output_diff(out, {k: v[:, keep] for k, v in reference.items()}) < 1e-5
+
+    torch.save({"model": model.state_dict(), "det_slots": keep}, tmp_path / "pruned.pth")
+    loaded = swin_ssd_tiny(det_token_num=keep_det).eval()
+    loaded.load_state_dict(torch.load(tmp_path / "pruned.pth", map_location="cpu")["model"])
+    assert _max_output_diff(loaded(None, features=features), out) < 1e-5
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("window", [3, 5])
+def test_sparse_neck_matches_the_masked_dense_neck(window):
+    model = swin_ssd_tiny(neck_window=window).eval()
+    features = random_features(model, 1)
+    index = model.backbone.sparse_index([f.shape[1] for f in features], torch.device("cpu"))
+    L = index.shape[0]
+    N = 1 + L + model.backbone.det_token_num
+    mask = torch.zeros(N, N)
+    mask[1:1 + L] = torch.full((L, N), float("-inf")).scatter_(1, index, 0.)
+
+    out = model(None, features=features)["pred_boxes"]
+    reference = _with_attention_mask(model, mask)(None, features=features)["pred_boxes"]
+    assert (out - reference).abs().max().item() < 1e-4
@@ -0,0 +1,13 @@
+import torch
+
+from models.detector import swin_ssd_tiny
+from models.video import VideoDetector
+from util.benchmark import synthetic_stream
+
+
+@torch.no_grad()
+def test_exact_window_reuse_matches_full_forwards():
+    model = swin_ssd_tiny().eval()
+    video = VideoDetector(model, threshold=0., keyframe_interval=0)
+    for frame in synthetic_stream(1, 672, frames=4):
+        assert (video(frame)["pred_boxes"] - model(frame)["pred_boxes"]).abs().max().item() < 1e-5
@@ -0,0 +1,74 @@
+# ---*--- File Information ---*---
+# @File       :  token_merging.py
+# @Date&Time  :  2026-10-16, 15:20:11
+# @Project    :  swin-ssd
+# @Software   :  PyCharm
+# @Author     :  yoc
+# @Email      :  yyyyyoc@hotmail.com
+# bipartite soft matching of "Token Merging: Your ViT But Faster" (Bolya et al., ICLR 2023)
+# https://github.com/facebookresearch/ToMe
+
+
+import torch
+import torch.nn.functional as F
+
+
+def merge_ratios(ratio, depth):
+    """ Per-block merge ratios from a single float (same ratio after every block but the last) or a list.
+    A one-element list (the default of `--merge_ratio`) counts as a single float """
+    if isinstance(ratio, (list, tuple)) and len(ratio) == 1:
+        ratio = ratio[0]
+    if isinstance(ratio, (list, tuple)):
+        assert len(ratio) == depth, f"expected {depth} merge ratios, got {len(ratio)}"
+        return [float(r) for r in ratio]
+    return [float(ratio)] * (depth - 1) + [0.]
+
+
+def bipartite_merge(x, size, r, num_head=1, num_tail=0):
+    """ Merges the `r` most similar pairs of the tokens between the protected head and tail tokens.
+
+    The tokens are split alternately into sets A and B, every token of A is matched to its most similar token
+    of B (cosine similarity), and the `r` best matched tokens of A are averaged into their match, weighted by
+    the number of original tokens they already stand for.
+
+    Args:
+        x: (B, N, C) tokens
+        size: (B, N, 1) number of original tokens behind every token
+        r (int): number of tokens to remove, at most half of the mergeable tokens
+        num_head (int): leading tokens that are never merged (cls)
+        num_tail (int): trailing tokens that are never merged (det tokens)
+    Returns:
+        x: (B, N - r, C), size: (B, N - r, 1), head and tail tokens unchanged and in place
+    """
+    B, N, C = x.shape
+    end = N - num_tail
+    r = min(r, (end - num_head) // 2)
+    if r <= 0:
+        return x, size
+
+    head, tokens, tail = x[:, :num_head], x[:, num_head:end], x[:, end:]
+    size_head, sizes, size_tail = size[:, :num_head], size[:, num_head:end], size[:, end:]
+
+    with torch.no_grad():
+        metric = F.normalize(tokens, dim=-1)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)  # B, Na, Nb
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:]  # kept tokens of A
+        src_idx = edge_idx[:, :r]  # merged tokens of A
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+    def merge(t):
+        # sums, the weighted average is taken once below
+        t_a, t_b = t[:, ::2], t[:, 1::2]
+        c = t.shape[-1]
+        unm = t_a.gather(dim=1, index=unm_idx.expand(-1, -1, c))
+        src = t_a.gather(dim=1, index=src_idx.expand(-1, -1, c))
+        dst = t_b.scatter_add(1, dst_idx.expand(-1, -1, c), src)
+        return torch.cat([unm, dst], dim=1)
+
+    merged = merge(tokens * sizes)
+    sizes = merge(sizes)
+    tokens = merged / sizes
+    return torch.cat([head, tokens, tail], dim=1), torch.cat([size_head, sizes, size_tail], dim=1)
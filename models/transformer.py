@@ -14,11 +14,15 @@ import torch.nn.functional as F
 from functools import partial
 from einops import rearrange
 from typing import List
+from collections import OrderedDict
 
 
 from models.layers import DropPath, to_2tuple, trunc_normal_
+from models.attention import check_attn_backend, sdpa_attention, chunked_attention, gathered_attention, \
+    local_anchor_index, linear_attention
+from models.token_merging import merge_ratios, bipartite_merge
 
-# import torch.utils.checkpoint as checkpoint
+import torch.utils.checkpoint as checkpoint
 # from timm.models.vision_transformer import VisionTransformer as ViT
 
 
@@ -41,28 +45,114 @@ class Mlp(nn.Module):
         return x
 
 
+class TokenScorer(nn.Module):
+    """ Lightweight informativeness score of every patch token, (B, L, C) -> (B, L) """
+
+    def __init__(self, dim, hidden_dim=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+        super().__init__()
+        hidden_dim = hidden_dim or dim // 4
+        self.norm = norm_layer(dim)
+        self.fc1 = nn.Linear(dim, hidden_dim)
+        self.act = act_layer()
+        self.fc2 = nn.Linear(hidden_dim, 1)
+
+    def forward(self, x):
+        return self.fc2(self.act(self.fc1(self.norm(x)))).squeeze(-1)
+
+
+def select_tokens(x, pos, scores, k):
+    """ Keeps the `k` best scored tokens of every image, in their original order.
+
+    The kept tokens are multiplied by a straight-through gate (1 in the forward pass, d sigmoid(score) in the
+    backward pass), so the scorer is trained by the detection loss without changing the token values.
+
+    Args:
+        x: (B, L, C) patch tokens
+        pos: (1 | B, L, C) their pos embeddings
+        scores: (B, L)
+        k (int): number of tokens to keep
+    Returns:
+        x: (B, k, C), pos: (B, k, C), index: (B, k) original positions of the kept tokens
+    """
+    B, L, C = x.shape
+    index = scores.topk(k, dim=1).indices.sort(dim=1).values
+    gate = scores.gather(1, index).sigmoid()[..., None]
+    x = x.gather(1, index[..., None].expand(-1, -1, C)) * (1 + gate - gate.detach())
+    pos = pos.expand(B, -1, -1).gather(1, index[..., None].expand(-1, -1, C))
+    return x, pos, index
+
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.,
+                 attn_backend="naive", chunk_size=256, linear=False):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
+        # naive | sdpa | chunked, see `models.attention`; chunked holds `chunk_size` query rows at a time
+        self.attn_backend = check_attn_backend(attn_backend)
+        self.chunk_size = chunk_size
+        # kernelized linear attention instead of softmax attention, same weights
+        self.linear = linear
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def attend(self, q, k, v):
+        """ Dense attention of (B, h, Nq, d) queries over (B, h, Nk, d) keys / values with the backend """
+        if self.linear:
+            return linear_attention(q, k, v)
+        if self.attn_backend == "naive":
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            return attn @ v
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if self.attn_backend == "sdpa":
+            return sdpa_attention(q, k, v, scale=self.scale, dropout_p=dropout_p)
+        return chunked_attention(q, k, v, scale=self.scale, dropout_p=dropout_p, chunk_size=self.chunk_size)
+
+    def forward(self, x, sparse_index=None):
+        """ `sparse_index`: (L, K) keys of the L patch tokens that follow the cls token, see
+        `models.attention.local_anchor_index`; the patch tokens only attend to those keys while the cls and det
+        tokens (all the others) keep attending to every token. None is dense attention. """
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)  # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if sparse_index is None or self.linear:
+            x = self.attend(q, k, v)
+        else:
+            end = 1 + sparse_index.shape[0]
+            dropout_p = self.attn_drop.p if self.training else 0.
+            patch = gathered_attention(q[:, :, 1:end], k, v, sparse_index, scale=self.scale, dropout_p=dropout_p)
+            rest = self.attend(torch.cat((q[:, :, :1], q[:, :, end:]), dim=2), k, v)
+            x = torch.cat((rest[:, :, :1], patch, rest[:, :, 1:]), dim=2)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def forward_cross(self, x, context):
+        """ Queries from `x` only, keys / values from `context` (which should contain `x`), with the qkv weights
+
+        Args:
+            x: (B, Nq, C)
+            context: (B, Nk, C)
+        """
+        B, Nq, C = x.shape
+        Nk = context.shape[1]
+        weight, bias = self.qkv.weight, self.qkv.bias
+        q = F.linear(x, weight[:C], bias[:C] if bias is not None else None)
+        kv = F.linear(context, weight[C:], bias[C:] if bias is not None else None)
+        q = q.reshape(B, Nq, self.num_heads, C // self.num_heads).transpose(1, 2)
+        k, v = kv.reshape(B, Nk, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4).unbind(0)
+
+        x = self.attend(q, k, v)
+        x = x.transpose(1, 2).reshape(B, Nq, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -71,18 +161,34 @@ class Attention(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_backend="naive",
+                 linear_attn=False):
         super().__init__()
         self.norm1 = norm_layer(dim)
-        self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop)
+        self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop,
+                              attn_backend=attn_backend, linear=linear_attn)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
+        # recompute this block in backward instead of storing its activations
+        self.use_checkpoint = False
 
-    def forward(self, x):
-        x = x + self.drop_path(self.attn(self.norm1(x)))
+    def forward(self, x, sparse_index=None):
+        x = x + self.drop_path(self.attn(self.norm1(x), sparse_index))
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x
+
+    def forward_queries(self, x, context):
+        """ Updates the tokens `x` only: they attend to [context, x], `context` itself is left as it is
+
+        Args:
+            x: (B, Nq, C), e.g. the det tokens
+            context: (B, Nk, C), e.g. cls and patch tokens, frozen at an earlier block
+        """
+        x_norm = self.norm1(x)
+        x = x + self.drop_path(self.attn.forward_cross(x_norm, torch.cat((self.norm1(context), x_norm), dim=1)))
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
@@ -124,7 +230,9 @@ class VisionTransformer(nn.Module):
                  num_heads=12, mlp_ratio=4., qkv_bias=True, distilled=False,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.,  # embed_layer=PatchEmbed,
                  name="tiny",
-                 norm_layer=None, act_layer=None):
+                 norm_layer=None, act_layer=None, use_checkpoint=False, attn_backend="naive", pos_cache_size=8,
+                 merge_ratio=0., det_only_blocks=0, token_scorer=False, keep_tokens=0, exit_blocks=(),
+                 local_window=0, linear_blocks=()):
         """
         Args:
             img_size (int, tuple): input image size
@@ -142,6 +250,24 @@ class VisionTransformer(nn.Module):
             drop_path_rate (float): stochastic depth rate
             embed_layer (nn.Module): patch embedding layer
             norm_layer: (nn.Module): normalization layer
+            use_checkpoint (bool): recompute every block in backward to save activation memory
+            attn_backend (str): attention backend of the blocks: naive | sdpa | chunked
+            pos_cache_size (int): number of sequence lengths whose resized pos embeddings are cached
+            merge_ratio (float | list[float]): fraction of the patch tokens merged after every block (ToMe),
+                a list gives one ratio per block, cls and det tokens are never merged
+            det_only_blocks (int): the last `det_only_blocks` blocks update the det tokens only, they
+                cross-attend to the cls / patch tokens as they are before those blocks
+            token_scorer (bool): build a scoring head that selects the patch tokens fed to the blocks
+            keep_tokens (int): number of patch tokens kept per image by the scoring head, 0 keeps all of them,
+                can be changed at inference time
+            exit_blocks (list[int]): numbers of blocks after which the det tokens are also handed out (normed),
+                for auxiliary heads in training and early exit at inference
+            local_window (int): structured sparse attention, the patch tokens only attend to the
+                `local_window x local_window` neighbourhood in their own scale, to the same position in the other
+                scales and to the cls token, 0 is dense attention. Used while the patch tokens are still the pooled
+                grids (no token selection, up to the first merge).
+            linear_blocks (list[int]): indices of the blocks with kernelized linear attention, e.g. range(8)
+                for the first 8 blocks linear and the last 4 exact
             # weight_init: (str): weight init scheme
         """
         super().__init__()
@@ -183,8 +309,11 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.Sequential(*[
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, drop=drop_rate,
-                attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, act_layer=act_layer)
+                attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, act_layer=act_layer,
+                attn_backend=attn_backend, linear_attn=i in set(linear_blocks or ()))
             for i in range(depth)])
+        for blk in self.blocks:
+            blk.use_checkpoint = use_checkpoint
         self.norm = norm_layer(embed_dim)
 
         # TODO: Classifier head(s)
@@ -218,6 +347,43 @@ class VisionTransformer(nn.Module):
 
         self.apply(self._init_weights)
 
+        # pos embeddings resized to other token counts, length -> (pos_embed key, pos), see `get_pos_embed`
+        self.pos_cache_size = pos_cache_size
+        self._pos_cache = OrderedDict()
+        # number of pos_embed interpolations computed (cache misses), logged as a metric by the engine
+        self.pos_interpolations = 0
+
+        self.set_merge_ratio(merge_ratio)
+        self.det_only_blocks = det_only_blocks
+
+        # content-adaptive token selection, only built on demand so that older checkpoints still load strictly
+        self.token_scorer = TokenScorer(embed_dim) if token_scorer else None
+        self.keep_tokens = keep_tokens
+
+        self.exit_blocks = sorted(set(exit_blocks or ()))
+        assert all(0 < d < depth for d in self.exit_blocks), f"exit blocks must be within 1..{depth - 1}"
+        # number of blocks every image of the last forward went through
+        self.exit_depth = None
+
+        self.local_window = local_window
+        # (grids, window, device) -> key index of the sparse attention
+        self._sparse_index = {}
+
+    def set_merge_ratio(self, merge_ratio):
+        self.merge_ratios = merge_ratios(merge_ratio, len(self.blocks))
+
+    def train(self, mode=True):
+        self._pos_cache.clear()
+        return super().train(mode)
+
+    def _apply(self, fn):
+        self._pos_cache.clear()
+        return super()._apply(fn)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._pos_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
     def get_encoder(self, encoder: nn.Module):
         self.encoder = encoder
 
@@ -267,6 +433,41 @@ class VisionTransformer(nn.Module):
         # (b, 1 + patch + det_token_num, dim)
         self.pos_embed = torch.nn.Parameter(torch.cat((cls_pos, patch_pos, det_pos), dim=1))
 
+    def scale_projections(self):
+        """ Linear projection of every encoder scale to `embed_dim`, None where the dims already match """
+        if self.name == "tiny":
+            return [None, self.down_sample_1, self.down_sample_2, self.down_sample_3]
+        elif self.name == "small":
+            return [self.up_sample, None, self.down_sample_1, self.down_sample_2]
+        elif self.name == "base":
+            return [self.up_sample_1, self.up_sample_2, self.down_sample_1, self.down_sample_2]
+        else:
+            raise ValueError("Wrong sampling!")
+
+    def sparse_index(self, num_tokens, device):
+        """ Key index of the structured sparse attention for the scales of `num_tokens` tokens, None if the
+        pooled grids behind them are unknown """
+        pools = getattr(self.encoder, "pool_list", None)
+        if not self.local_window or pools is None:
+            return None
+        grids = tuple(tuple(pool.grid) for pool in pools[:len(num_tokens)])
+        if any(gh * gw != n for (gh, gw), n in zip(grids, num_tokens)):
+            return None
+        key = (grids, self.local_window, device)
+        if key not in self._sparse_index:
+            self._sparse_index[key] = local_anchor_index(grids, self.local_window, num_head=1).to(device)
+        return self._sparse_index[key]
+
+    def prune_det_tokens(self, keep):
+        """ Keeps only the det slots `keep` (indices into the current det tokens): slices `det_token` and the det
+        part of `pos_embed` """
+        keep = torch.as_tensor(keep, device=self.det_token.device).sort().values
+        det_pos = self.pos_embed[:, -self.det_token_num:][:, keep]
+        self.pos_embed = nn.Parameter(torch.cat((self.pos_embed[:, :-self.det_token_num], det_pos), dim=1).detach())
+        self.det_token = nn.Parameter(self.det_token[:, keep].detach())
+        self.det_token_num = len(keep)
+        self._pos_cache.clear()
+
     def pos_interpolation(self, pos_embed, actual_len=600):
 
         cls_pos = pos_embed[:, 0, :]
@@ -284,38 +485,65 @@ class VisionTransformer(nn.Module):
 
         return pos_embed
 
-    def forward_features(self, x):
-        batch_size, input_img_size = x.shape[0], (x.shape[2], x.shape[3])
-
-        out_list = self.encoder(x)
-
-        if self.name == "tiny":
-            token_1 = out_list[0]
-            token_2 = self.down_sample_1(out_list[1])
-            token_3 = self.down_sample_2(out_list[2])
-            token_4 = self.down_sample_3(out_list[3])
-            x = torch.cat((token_1, token_2, token_3, token_4), dim=1)  # B, L, D
-        elif self.name == "small":
-            token_1 = self.up_sample(out_list[0])
-            token_2 = out_list[1]
-            token_3 = self.down_sample_1(out_list[2])
-            token_4 = self.down_sample_2(out_list[3])
-            x = torch.cat((token_1, token_2, token_3, token_4), dim=1)  # B, L, D
-        elif self.name == "base":
-            token_1 = self.up_sample_1(out_list[0])
-            token_2 = self.up_sample_2(out_list[1])
-            token_3 = self.down_sample_1(out_list[2])
-            token_4 = self.down_sample_2(out_list[3])
-            x = torch.cat((token_1, token_2, token_3, token_4), dim=1)  # B, L, D
-        else:
-            raise ValueError("Wrong sampling!")
+    def get_pos_embed(self, num_patches, num_scales=4):
+        """ `pos_embed` matching `num_patches` patch tokens coming from the first `num_scales` encoder scales.
 
+        The resized embeddings are cached per (length, number of scales) whenever no gradient has to flow into `pos_embed`
+        (eval under no_grad or frozen). The cache is keyed on the storage and version counter of `pos_embed`,
+        so optimizer steps, `load_state_dict` and `.to()` invalidate it.
+        """
         # 检查 self.patch_pos 的 h, w 是否和传入相同
-        if (self.pos_embed.shape[1] - 1 - self.det_token_num) != (x.shape[1]):
-            pos = self.pos_interpolation(pos_embed=self.pos_embed, actual_len=x.shape[1])
-            print("warning: interpolate!")
+        num_patch_pos = self.pos_embed.shape[1] - 1 - self.det_token_num
+        if num_patch_pos == num_patches:
+            return self.pos_embed
+
+        table = self.pos_embed
+        cacheable = not table.requires_grad or (not self.training and not torch.is_grad_enabled())
+        key = (table.data_ptr(), table._version)
+        # the same length is sliced from the per-scale layout or interpolated depending on `num_scales`
+        slot = (num_patches, num_scales)
+        if cacheable and slot in self._pos_cache:
+            self._pos_cache.move_to_end(slot)
+            cached_key, pos = self._pos_cache[slot]
+            if cached_key == key:
+                return pos
+
+        num_list = getattr(self.encoder, "num_list", None)
+        if num_list and num_patch_pos == sum(num_list) and num_patches == sum(num_list[:num_scales]) \
+                and num_scales < len(num_list):
+            # the patch pos embeddings are laid out scale by scale, keep those of the scales produced so far
+            pos = torch.cat((table[:, :1 + num_patches], table[:, -self.det_token_num:]), dim=1)
         else:
-            pos = self.pos_embed
+            self.pos_interpolations += 1
+            pos = self.pos_interpolation(pos_embed=table, actual_len=num_patches)
+
+        if cacheable:
+            self._pos_cache[slot] = (key, pos.detach())
+            if len(self._pos_cache) > self.pos_cache_size:
+                self._pos_cache.popitem(last=False)
+        return pos
+
+    def forward_features(self, x, features=None, mask=None, exit_fn=None):
+        # `features`: precomputed encoder token lists, e.g. read from a feature store, `x` is unused then
+        # `mask`: padding mask of `x`, True on padding
+        # `exit_fn(det, active)`: early exit at the exit blocks, called with the normed det tokens of the images
+        #   still running and their batch indices, returns which of them are done
+        out_list = self.encoder(x, mask=mask) if features is None else features
+        batch_size = out_list[0].shape[0]
+
+        # an early exit of the encoder hands over only the first scales
+        tokens = [t if proj is None else proj(t) for proj, t in zip(self.scale_projections(), out_list)]
+        x = torch.cat(tokens, dim=1)  # B, L, D
+
+        pos = self.get_pos_embed(x.shape[1], num_scales=len(out_list))
+        sparse_index = self.sparse_index([t.shape[1] for t in tokens], x.device) if self.dist_token is None \
+            else None
+        if self.token_scorer is not None and 0 < self.keep_tokens < x.shape[1] and self.dist_token is None:
+            sparse_index = None
+            # gather the pos embeddings of the kept tokens with them
+            x, patch_pos, _ = select_tokens(x, pos[:, 1:1 + x.shape[1]], self.token_scorer(x), self.keep_tokens)
+            pos = torch.cat((pos[:, :1].expand(batch_size, -1, -1), patch_pos,
+                             pos[:, -self.det_token_num:].expand(batch_size, -1, -1)), dim=1)
 
         cls = self.cls_token.expand(batch_size, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         det = self.det_token.expand(batch_size, -1, -1)
@@ -327,17 +555,64 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls, self.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
 
         x = self.pos_drop(x + pos)
-        x = self.blocks(x)
+        merge = self.dist_token is None and any(r > 0 for r in self.merge_ratios)
+        size = x.new_ones(x.shape[0], x.shape[1], 1) if merge else None
+        first_det_only = len(self.blocks) - self.det_only_blocks if self.dist_token is None else len(self.blocks)
+        exits = self.exit_blocks if self.dist_token is None else []
+        aux = []
+        if exit_fn is not None:
+            # outputs of the images that exited, the others are dropped from the batch
+            out = x.new_zeros(batch_size, self.det_token_num, x.shape[-1])
+            active = torch.arange(batch_size, device=x.device)
+            self.exit_depth = torch.full((batch_size,), len(self.blocks), dtype=torch.long, device=x.device)
+        context = None
+        for i, (blk, ratio) in enumerate(zip(self.blocks, self.merge_ratios)):
+            if i >= first_det_only:
+                # only the det tokens feed the heads, cls / patch tokens stay as they are from here on
+                if i == first_det_only:
+                    context, x = x[:, :-self.det_token_num], x[:, -self.det_token_num:]
+                x = blk.forward_queries(x, context)
+            else:
+                if blk.use_checkpoint and torch.is_grad_enabled():
+                    x = checkpoint.checkpoint(blk, x, sparse_index, use_reentrant=False)
+                else:
+                    x = blk(x, sparse_index)
+                if merge and ratio > 0 and i + 1 < first_det_only:
+                    # merge the most similar patch tokens, cls (head) and det tokens (tail) stay in place
+                    r = int((x.shape[1] - 1 - self.det_token_num) * ratio)
+                    x, size = bipartite_merge(x, size, r, num_head=1, num_tail=self.det_token_num)
+                    # the merged tokens are no grid anymore
+                    sparse_index = None
+            if i + 1 not in exits:
+                continue
+            det = self.norm(x[:, -self.det_token_num:])
+            if exit_fn is None:
+                aux.append(det)
+                continue
+            done = exit_fn(det, active)
+            if done.any():
+                out[active[done]] = det[done]
+                self.exit_depth[active[done]] = i + 1
+                if done.all():
+                    return out
+                keep = ~done
+                active, x = active[keep], x[keep]
+                size = size[keep] if size is not None else None
+                context = context[keep] if context is not None else None
         x = self.norm(x)
 
         if self.dist_token is None:
             # return x[:, 0]
-            return x[:, -self.det_token_num:, :]
+            x = x[:, -self.det_token_num:, :]
+            if exit_fn is not None:
+                out[active] = x
+                return out
+            return (x, aux) if exits else x
         else:
             return x[:, 0], x[:, 1]
 
-    def forward(self, x):
-        x = self.forward_features(x)
+    def forward(self, x, features=None, mask=None, exit_fn=None):
+        x = self.forward_features(x, features=features, mask=mask, exit_fn=exit_fn)
         return x
 
 
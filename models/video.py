@@ -0,0 +1,62 @@
+# ---*--- File Information ---*---
+# @File       :  video.py
+# @Date&Time  :  2026-10-16, 21:05:37
+# @Project    :  swin-ssd
+# @Software   :  PyCharm
+# @Author     :  yoc
+# @Email      :  yyyyyoc@hotmail.com
+# stateful inference over camera streams, consecutive frames reuse the unchanged encoder windows
+
+
+import torch
+
+
+class VideoDetector(object):
+    """ Detection on the frames of video streams, one frame per stream and call.
+
+    The encoder only recomputes the (shifted) windows whose input changed by more than `threshold` since their
+    cached output was computed (`Encoder.forward_features_reuse`), and the neck and heads only run if any window
+    was recomputed. Windows below the threshold keep slightly stale outputs, so every `keyframe_interval` frames
+    the caches are dropped and the frame is computed from scratch.
+
+    Args:
+        model (Detector): in eval mode
+        threshold (float): max abs change of a window input (normalized image / activations) below which its
+            cached output is reused, 0 reuses exactly identical windows only
+        keyframe_interval (int): full refresh every `keyframe_interval` frames, 0 only refreshes on `reset`
+    """
+
+    def __init__(self, model, threshold=0.05, keyframe_interval=30):
+        self.model = model
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        """ Starts new streams (a scene cut, another camera) """
+        self.state = None
+        self.outputs = None
+        self.frame_index = 0
+        # fraction of the encoder windows recomputed for the last frame
+        self.recomputed = 1.
+
+    @torch.no_grad()
+    def __call__(self, frames):
+        """
+        Args:
+            frames: (B, 3, H, W) normalized frames, the next one of each of the B streams, same size every call
+        Returns:
+            the `Detector` outputs of the frames
+        """
+        assert not self.model.training, "video inference runs the model in eval mode"
+        encoder = self.model.backbone.encoder
+        keyframe = self.keyframe_interval > 0 and self.frame_index % self.keyframe_interval == 0
+        if self.state is None or keyframe:
+            self.state = encoder.init_reuse_state()
+
+        features, (recomputed, total) = encoder.forward_features_reuse(frames, self.state, self.threshold)
+        if recomputed > 0 or self.outputs is None:
+            self.outputs = self.model(None, features=features)
+        self.recomputed = recomputed / max(1, total)
+        self.frame_index += 1
+        return self.outputs
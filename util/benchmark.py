@@ -0,0 +1,680 @@
+"""
+Micro benchmarks of the optional fast paths. Their numerical parity is checked by the tests next to every
+module (`python -m pytest`); the synthetic inputs and former implementations below are shared with them.
+
+Usage:
+    python -m util.benchmark window_attention --model_name tiny --device cuda
+    python -m util.benchmark window_layout --model_name small
+    python -m util.benchmark neck_attention
+    python -m util.benchmark det_only --model_name base
+    python -m util.benchmark token_selection --keep_tokens 100 300 500
+    python -m util.benchmark token_merging --model_name tiny --ratios 0 0.05 0.1 0.2 [--coco_path ... --resume ...]
+    python -m util.benchmark sparse_neck --model_name all --windows 3 5
+    python -m util.benchmark linear_attention --model_name tiny --tokens 600 1000 2000 4000 --linear_blocks 0 8 12
+    python -m util.benchmark video --thresholds 0 0.05 --frames 8
+    python -m util.benchmark matcher --batch_sizes 2 8 32 64 --workers 0 4
+    python -m util.benchmark postprocess --batch_sizes 1 8 64
+    python -m util.benchmark auction --batch_sizes 8 64 --max_targets 20 --auction_eps 1e-3 --device cuda
+    python -m util.benchmark matching_cost --max_targets 500 --memory_mb 0 4 64
+    python -m util.benchmark paired_iou --pairs 100 1000 5000
+    python -m util.benchmark early_exit --exit_blocks 4 6 8 10 --thresholds 0 0.5 0.9 [--coco_path ... --resume ...]
+"""
+import argparse
+import copy
+import time
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from models.encoder import encoder_tiny_672_192, encoder_small_672_384, encoder_base_768_768
+from models.transformer import deit_tiny_patch16_224, deit_small_patch16_224, deit_base_patch16_224
+from models.detector import swin_ssd_tiny, swin_ssd_small, swin_ssd_base, PostProcess
+from models.video import VideoDetector
+from models.matcher import HungarianMatcher
+from util import box_ops
+from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+
+ENCODERS = {
+    "tiny": (encoder_tiny_672_192, 672),
+    "small": (encoder_small_672_384, 672),
+    "base": (encoder_base_768_768, 768),
+}
+
+DETECTORS = {
+    "tiny": (swin_ssd_tiny, 672),
+    "small": (swin_ssd_small, 672),
+    "base": (swin_ssd_base, 768),
+}
+
+# neck builder, sequence length: cls + default pooled tokens (4 * 169 / 225 / 289) + 100 det tokens
+NECKS = {
+    "tiny": (deit_tiny_patch16_224, 1 + 676 + 100),
+    "small": (deit_small_patch16_224, 1 + 900 + 100),
+    "base": (deit_base_patch16_224, 1 + 1156 + 100),
+}
+
+
+def _read_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_memory(device):
+    """ Resets the peak counter and returns the bytes currently held """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    # resets VmHWM of this process, see `man 5 proc` (/proc/[pid]/clear_refs)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return _read_status("VmRSS:")
+
+
+def _peak_memory(device):
+    """ Peak bytes since the last `_reset_peak_memory`: allocator peak on cuda, peak RSS on cpu """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    return _read_status("VmHWM:")
+
+
+@torch.no_grad()
+def measure(fn, *inputs, device, warmup=2, repeat=5):
+    """ Returns (mean latency in ms, peak memory in MB above the memory held before the call) of `fn(*inputs)` """
+    for _ in range(warmup):
+        fn(*inputs)
+    base = _reset_peak_memory(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    latency = (time.perf_counter() - start) / repeat * 1000
+    return latency, (_peak_memory(device) - base) / 2 ** 20
+
+
+# aten ops that only move data around, their outputs are counted as bytes moved
+_DATA_MOVEMENT_OPS = ("aten.clone", "aten.roll", "aten.index_select", "aten.gather", "aten.cat", "aten.copy_")
+
+
+class _BytesMoved(TorchDispatchMode):
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if str(func).startswith(_DATA_MOVEMENT_OPS) and isinstance(out, torch.Tensor):
+            self.bytes += out.numel() * out.element_size()
+        return out
+
+
+@torch.no_grad()
+def bytes_moved(fn, *inputs):
+    """ Bytes written by pure data movement ops (copies, rolls, gathers) during `fn(*inputs)` """
+    fn(*inputs)  # builds lazily cached masks / tables outside of the count
+    with _BytesMoved() as counter:
+        fn(*inputs)
+    return counter.bytes
+
+
+def _stage_inputs(encoder, batch_size, device):
+    inputs = []
+    for layer in encoder.layers:
+        H, W = layer.input_resolution
+        inputs.append(torch.randn(batch_size, H * W, layer.dim, device=device))
+    return inputs
+
+
+def with_attn_backend(module, backend):
+    """ Copy of `module` whose attentions all run `backend` """
+    module = copy.deepcopy(module)
+    for m in module.modules():
+        if hasattr(m, "attn_backend"):
+            m.attn_backend = backend
+    return module
+
+
+def benchmark_window_attention(model_name="tiny", batch_size=1, device="cpu",
+                               backends=("naive", "sdpa", "chunked")):
+    """ Latency and peak memory of every encoder stage for each window attention backend """
+    device = torch.device(device)
+    builder, _ = ENCODERS[model_name]
+    encoder = builder().to(device).eval()
+    inputs = _stage_inputs(encoder, batch_size, device)
+
+    results = {}
+    for backend in backends:
+        layers = with_attn_backend(encoder.layers, backend)
+        results[backend] = [measure(layer, x, device=device) for layer, x in zip(layers, inputs)]
+    return results
+
+
+def benchmark_window_layout(model_name="tiny", batch_size=1, device="cpu"):
+    """ Bytes moved, latency and peak memory of every encoder stage with and without the window layout """
+    device = torch.device(device)
+    builder, _ = ENCODERS[model_name]
+    encoder = builder().to(device).eval()
+    inputs = _stage_inputs(encoder, batch_size, device)
+
+    results = {}
+    for window_layout in (False, True):
+        stages = []
+        for layer, x in zip(encoder.layers, inputs):
+            layer.window_layout = window_layout
+            stages.append((bytes_moved(layer, x) / 2 ** 20,) + measure(layer, x, device=device))
+        results["window" if window_layout else "row-major"] = stages
+    return results
+
+
+def benchmark_neck_attention(model_name="tiny", batch_size=1, device="cpu",
+                             backends=("naive", "sdpa", "chunked")):
+    """ Latency and peak memory (RSS on cpu) of the 12 neck blocks for each attention backend """
+    device = torch.device(device)
+    builder, num_tokens = NECKS[model_name]
+    blocks = builder().blocks.to(device).eval()
+    x = torch.randn(batch_size, num_tokens, blocks[0].norm1.normalized_shape[0], device=device)
+    return {backend: measure(with_attn_backend(blocks, backend), x, device=device) for backend in backends}
+
+
+@torch.no_grad()
+def benchmark_token_merging(model_name="tiny", batch_size=1, device="cpu", ratios=(0., .05, .1, .2)):
+    """ Neck + heads latency (the encoder output is computed once) and peak memory for every merge ratio """
+    device = torch.device(device)
+    builder, img_size = DETECTORS[model_name]
+    model = builder().to(device).eval()
+    features = model.backbone.encoder(torch.randn(batch_size, 3, img_size, img_size, device=device))
+
+    results = {}
+    for ratio in ratios:
+        model.backbone.set_merge_ratio(ratio)
+        results[ratio] = measure(lambda f: model(None, features=f), features, device=device)
+    model.backbone.set_merge_ratio(0.)
+    return results
+
+
+@torch.no_grad()
+def benchmark_token_selection(model_name="tiny", batch_size=1, device="cpu", keep_tokens=(0, 100, 300, 500)):
+    """ Neck + heads latency and peak memory per number of kept patch tokens, 0 keeps all of them """
+    device = torch.device(device)
+    model = DETECTORS[model_name][0](keep_tokens=1).to(device).eval()
+    features = random_features(model, batch_size, device)
+
+    results = {}
+    for k in keep_tokens:
+        model.backbone.keep_tokens = k
+        results[k] = measure(lambda f: model(None, features=f), features, device=device)
+    model.backbone.keep_tokens = 0
+    return results
+
+
+@torch.no_grad()
+def benchmark_det_only_blocks(model_name="tiny", batch_size=1, device="cpu", num_blocks=(0, 2, 4, 6)):
+    """ Neck + heads latency and peak memory when the last K neck blocks only update the det tokens """
+    device = torch.device(device)
+    builder, img_size = DETECTORS[model_name]
+    model = builder().to(device).eval()
+    features = model.backbone.encoder(torch.randn(batch_size, 3, img_size, img_size, device=device))
+
+    results = {}
+    for k in num_blocks:
+        model.backbone.det_only_blocks = k
+        results[k] = measure(lambda f: model(None, features=f), features, device=device)
+    model.backbone.det_only_blocks = 0
+    return results
+
+
+@torch.no_grad()
+def benchmark_early_exit(model_name="tiny", batch_size=1, device="cpu", exit_blocks=(4, 6, 8, 10),
+                         thresholds=(0., .5, .9)):
+    """ Neck + heads latency, peak memory and the exit depth of every image for every exit threshold """
+    device = torch.device(device)
+    builder, img_size = DETECTORS[model_name]
+    model = builder(exit_blocks=exit_blocks).to(device).eval()
+    features = model.backbone.encoder(torch.randn(batch_size, 3, img_size, img_size, device=device))
+
+    results = {}
+    for threshold in thresholds:
+        model.exit_threshold = threshold
+        latency, peak = measure(lambda f: model(None, features=f), features, device=device)
+        depth = model(None, features=features).get("exit_depth")
+        depth = depth.tolist() if depth is not None else [len(model.backbone.blocks)] * batch_size
+        results[threshold] = (latency, peak, depth)
+    model.exit_threshold = 0.
+    return results
+
+
+@torch.no_grad()
+def benchmark_linear_attention(model_name="tiny", batch_size=1, device="cpu", tokens=(600, 1000, 2000, 3000, 4000),
+                               linear_blocks=(0, 8, 12)):
+    """ Latency and peak memory of the 12 neck blocks per patch token count, with the first K blocks linear """
+    device = torch.device(device)
+    builder, _ = NECKS[model_name]
+    blocks = builder().blocks.to(device).eval()
+    dim = blocks[0].norm1.normalized_shape[0]
+
+    results = {}
+    for num_tokens in tokens:
+        x = torch.randn(batch_size, 1 + num_tokens + 100, dim, device=device)
+        for k in linear_blocks:
+            for i, blk in enumerate(blocks):
+                blk.attn.linear = i < k
+            results[num_tokens, k] = measure(blocks, x, device=device, warmup=1, repeat=3)
+    for blk in blocks:
+        blk.attn.linear = False
+    return results
+
+
+def synthetic_stream(batch_size, img_size, frames, device="cpu"):
+    """ Static noise background with a bright square moving down by 16 pixels per frame """
+    background = torch.randn(batch_size, 3, img_size, img_size, device=device)
+    for t in range(frames):
+        frame = background.clone()
+        frame[:, :, 96 + 16 * t:160 + 16 * t, 288:352] += 2.
+        yield frame
+
+
+@torch.no_grad()
+def benchmark_video(model_name="tiny", batch_size=1, device="cpu", thresholds=(0., .05), frames=8,
+                    keyframe_interval=30):
+    """ Latency per frame (after the first one) and recomputed window fraction of the stream inference,
+    against the full forward (threshold None) """
+    device = torch.device(device)
+    builder, img_size = DETECTORS[model_name]
+    model = builder().to(device).eval()
+
+    results = {}
+    for threshold in (None,) + tuple(thresholds):
+        video = VideoDetector(model, threshold=threshold or 0., keyframe_interval=keyframe_interval)
+        latency, recomputed = [], []
+        for t, frame in enumerate(synthetic_stream(batch_size, img_size, frames, device)):
+            start = time.perf_counter()
+            model(frame) if threshold is None else video(frame)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            if t > 0:
+                latency.append((time.perf_counter() - start) * 1000)
+                recomputed.append(1. if threshold is None else video.recomputed)
+        results[threshold] = (sum(latency) / len(latency), sum(recomputed) / len(recomputed))
+    return results
+
+
+def synthetic_matching(batch_size, num_queries=100, num_classes=92, max_targets=20, device="cpu", seed=0):
+    """ Random predictions and between 1 and `max_targets` random targets per image """
+    g = torch.Generator().manual_seed(seed)
+    outputs = {"pred_logits": torch.randn(batch_size, num_queries, num_classes, generator=g).to(device),
+               "pred_boxes": (torch.rand(batch_size, num_queries, 4, generator=g) * .5 + .25).to(device)}
+    targets = []
+    for n in torch.randint(1, max_targets + 1, (batch_size,), generator=g).tolist():
+        targets.append({"labels": torch.randint(0, num_classes - 1, (n,), generator=g).to(device),
+                        "boxes": (torch.rand(n, 4, generator=g) * .5 + .25).to(device)})
+    return outputs, targets
+
+
+@torch.no_grad()
+def flattened_matching(matcher, outputs, targets):
+    """ The former matcher: costs between all the predictions and all the targets of the batch, then split """
+    from scipy.optimize import linear_sum_assignment
+
+    bs, num_queries = outputs["pred_logits"].shape[:2]
+    out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)
+    out_bbox = outputs["pred_boxes"].flatten(0, 1)
+    tgt_ids = torch.cat([v["labels"] for v in targets])
+    tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    C = matcher.cost_bbox * torch.cdist(out_bbox, tgt_bbox, p=1) - matcher.cost_class * out_prob[:, tgt_ids] \
+        - matcher.cost_giou * generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    C = C.view(bs, num_queries, -1).cpu()
+    sizes = [len(v["boxes"]) for v in targets]
+    indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+    return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+
+
+@torch.no_grad()
+def unfused_cost_matrices(matcher, outputs, targets):
+    """ The former cost of `HungarianMatcher.cost_matrices`: full [B, Q, max T] class, L1 and GIoU terms """
+    from torch.nn.utils.rnn import pad_sequence
+
+    out_prob = outputs["pred_logits"].softmax(-1)
+    out_bbox = outputs["pred_boxes"]
+    tgt_ids = pad_sequence([v["labels"] for v in targets], batch_first=True)
+    tgt_bbox = pad_sequence([v["boxes"] for v in targets], batch_first=True, padding_value=0.5)
+    cost_class = -out_prob.gather(2, tgt_ids[:, None, :].expand(-1, out_prob.shape[1], -1))
+    cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+    cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    return matcher.cost_bbox * cost_bbox + matcher.cost_class * cost_class + matcher.cost_giou * cost_giou
+
+
+def benchmark_matcher(batch_sizes=(2, 4, 8, 16, 32, 64), device="cpu", workers=(0, 4), max_targets=20,
+                      repeat=5):
+    """ Matching latency (cost + assignment) of the former flattened matcher and the block matcher per batch size
+    and number of assignment threads """
+    device = torch.device(device)
+    matcher = HungarianMatcher(1, 5, 2)
+    results = {}
+    for batch_size in batch_sizes:
+        outputs, targets = synthetic_matching(batch_size, max_targets=max_targets, device=device)
+        results[batch_size, "flattened"] = measure(lambda o, t: flattened_matching(matcher, o, t), outputs,
+                                                   targets, device=device, warmup=1, repeat=repeat)[0]
+        for n in workers:
+            matcher.num_workers = n
+            results[batch_size, n] = measure(matcher, outputs, targets, device=device, warmup=1, repeat=repeat)[0]
+    return results
+
+
+def synthetic_detections(batch_size, num_queries=100, num_classes=92, clusters=20, device="cpu", seed=0):
+    """ Confident random predictions whose boxes form overlapping clusters (NMS has work), and image sizes """
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.rand(batch_size, clusters, 4, generator=g) * .5 + .25
+    boxes = centers.repeat_interleave(num_queries // clusters, 1)
+    boxes = boxes + torch.randn(boxes.shape, generator=g) * .02
+    outputs = {"pred_logits": (torch.randn(batch_size, num_queries, num_classes, generator=g) * 3).to(device),
+               "pred_boxes": boxes.clamp(.05, .95).to(device)}
+    target_sizes = torch.randint(200, 800, (batch_size, 2), generator=g).to(device)
+    return outputs, target_sizes
+
+
+def reference_postprocess(outputs, target_sizes, top_k, score_threshold, nms_threshold):
+    """ Per-image loop: top-k (token, class) pairs, score threshold, then torchvision NMS class by class """
+    from torchvision.ops import nms
+
+    results = []
+    for logits, bbox, (h, w) in zip(outputs["pred_logits"], outputs["pred_boxes"], target_sizes):
+        prob = logits.softmax(-1)[:, :-1]
+        num_classes = prob.shape[1]
+        scores, index = prob.flatten().topk(min(top_k, prob.numel()))
+        labels = index % num_classes
+        boxes = box_cxcywh_to_xyxy(bbox[index // num_classes]) * torch.stack([w, h, w, h])
+        keep = (scores > score_threshold).nonzero().squeeze(1)
+        if nms_threshold > 0:
+            kept = [keep[labels[keep] == c][nms(boxes[keep[labels[keep] == c]], scores[keep[labels[keep] == c]],
+                                                nms_threshold)] for c in labels[keep].unique()]
+            keep = torch.cat(kept) if kept else keep
+        keep = keep[scores[keep].argsort(descending=True)]
+        results.append({"scores": scores[keep], "labels": labels[keep], "boxes": boxes[keep]})
+    return results
+
+
+def benchmark_postprocess(batch_sizes=(1, 8, 64), device="cpu", top_k=100, score_threshold=.05,
+                          nms_threshold=.5, repeat=5):
+    """ Latency of the filtered post-processing, per-image loop vs batched """
+    device = torch.device(device)
+    postprocess = PostProcess(top_k, score_threshold, nms_threshold)
+    results = {}
+    for batch_size in batch_sizes:
+        outputs, target_sizes = synthetic_detections(batch_size, device=device)
+        results[batch_size, "per-image"] = measure(
+            lambda o, t: reference_postprocess(o, t, top_k, score_threshold, nms_threshold), outputs,
+            target_sizes, device=device, warmup=1, repeat=repeat)[0]
+        results[batch_size, "batched"] = measure(postprocess, outputs, target_sizes, device=device, warmup=1,
+                                                 repeat=repeat)[0]
+    return results
+
+
+def benchmark_auction(batch_sizes=(2, 8, 32, 64), device="cpu", max_targets=20, eps=1e-3, repeat=5):
+    """ Matching latency of the scipy (host) and auction (device) solvers per batch size """
+    device = torch.device(device)
+    matchers = {"scipy": HungarianMatcher(1, 5, 2),
+                "auction": HungarianMatcher(1, 5, 2, solver="auction", auction_eps=eps)}
+    results = {}
+    for batch_size in batch_sizes:
+        outputs, targets = synthetic_matching(batch_size, max_targets=max_targets, device=device)
+        for name, matcher in matchers.items():
+            results[batch_size, name] = measure(matcher, outputs, targets, device=device, warmup=1,
+                                                repeat=repeat)[0]
+    return results
+
+
+def benchmark_matching_cost(batch_size=2, device="cpu", max_targets=500, memory_mb=(0, 4, 64), repeat=5):
+    """ Latency and peak memory of the matching cost of crowded images, unfused vs fused per memory budget """
+    device = torch.device(device)
+    outputs, targets = synthetic_matching(batch_size, max_targets=max_targets, device=device, seed=1)
+    matcher = HungarianMatcher(1, 5, 2)
+    results = {"unfused": measure(lambda o, t: unfused_cost_matrices(matcher, o, t), outputs, targets,
+                                  device=device, warmup=1, repeat=repeat)}
+    for mb in memory_mb:
+        matcher.memory_mb = mb
+        results[mb] = measure(matcher.cost_matrices, outputs, targets, device=device, warmup=1, repeat=repeat)
+    return results
+
+
+def random_box_pairs(num_pairs, device="cpu", seed=0):
+    """ Matched [x0, y0, x1, y1] box pairs: random, identical and disjoint ones """
+    g = torch.Generator().manual_seed(seed)
+    boxes = box_cxcywh_to_xyxy(torch.rand(2, num_pairs, 4, generator=g) * .5 + .25)
+    boxes[1, ::3] = boxes[0, ::3]
+    boxes[1, 1::3] = boxes[0, 1::3] + 2
+    return boxes[0].to(device), boxes[1].to(device)
+
+
+def benchmark_paired_box_iou(pairs=(100, 1000, 5000), device="cpu", repeat=5):
+    """ Latency and peak memory of the GIoU loss of matched pairs, diagonal of the pairwise matrix vs paired """
+    device = torch.device(device)
+    results = {}
+    for num_pairs in pairs:
+        boxes1, boxes2 = random_box_pairs(num_pairs, device)
+        results[num_pairs, "diagonal"] = measure(lambda a, b: torch.diag(generalized_box_iou(a, b)), boxes1, boxes2,
+                                                 device=device, warmup=1, repeat=repeat)
+        results[num_pairs, "paired"] = measure(box_ops.paired_generalized_box_iou, boxes1, boxes2, device=device,
+                                               warmup=1, repeat=repeat)
+    return results
+
+
+def random_features(model, batch_size, device="cpu"):
+    """ Encoder token lists of the right shapes, the neck cost does not depend on their values """
+    encoder = model.backbone.encoder
+    return [torch.randn(batch_size, n, d, device=device) for n, d in zip(encoder.num_list, encoder.dim_list)]
+
+
+@torch.no_grad()
+def benchmark_sparse_neck(model_name="tiny", batch_size=1, device="cpu", windows=(3, 5)):
+    """ Neck + heads latency and peak memory of the dense neck (window 0) and the sparse neck per window """
+    device = torch.device(device)
+    model = DETECTORS[model_name][0]().to(device).eval()
+    features = random_features(model, batch_size, device)
+
+    results = {}
+    for window in (0,) + tuple(windows):
+        model.backbone.local_window = window
+        results[window] = measure(lambda f: model(None, features=f), features, device=device)
+    model.backbone.local_window = 0
+    return results
+
+
+def _sweep_ap(model_name, coco_path, resume, settings, configure, batch_size=1, device="cpu"):
+    """ COCO val AP, wall time per image and the logged stats of a trained checkpoint for every setting,
+    `configure(model, setting)` applies a setting """
+    from main import get_args_parser, set_input_size
+    from models import build_model
+    from datasets import build_dataset, get_coco_api_from_dataset
+    from engine import evaluate
+    import util.misc as utils
+
+    args = get_args_parser().parse_args(["--model_name", model_name, "--coco_path", coco_path,
+                                         "--batch_size", str(batch_size), "--device", device])
+    set_input_size(args)
+
+    model, criterion, postprocessors = build_model(args)
+    model.load_state_dict(torch.load(resume, map_location="cpu", weights_only=False)["model"])
+    model.to(device)
+    dataset = build_dataset(image_set="val", args=args)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size, shuffle=False, drop_last=False,
+                                              collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    base_ds = get_coco_api_from_dataset(dataset)
+
+    results = {}
+    for setting in settings:
+        configure(model, setting)
+        start = time.perf_counter()
+        stats, _ = evaluate(model, criterion, postprocessors, data_loader, base_ds, torch.device(device), "")
+        results[setting] = (stats["coco_eval_bbox"][0], (time.perf_counter() - start) / len(dataset) * 1000, stats)
+    return results
+
+
+def sweep_token_merging(model_name, coco_path, resume, ratios, batch_size=1, device="cpu"):
+    """ COCO val AP and wall time per image of a trained checkpoint for every merge ratio """
+    return _sweep_ap(model_name, coco_path, resume, ratios, lambda m, r: m.backbone.set_merge_ratio(r),
+                     batch_size, device)
+
+
+def sweep_early_exit(model_name, coco_path, resume, exit_blocks, thresholds, batch_size=1, device="cpu"):
+    """ COCO val AP, wall time per image and mean exit depth of a trained checkpoint for every exit threshold """
+    def configure(model, threshold):
+        model.backbone.exit_blocks = sorted(exit_blocks)
+        model.exit_threshold = threshold
+
+    return _sweep_ap(model_name, coco_path, resume, thresholds, configure, batch_size, device)
+
+
+def main(args):
+    if args.task == "window_attention":
+        results = benchmark_window_attention(args.model_name, args.batch_size, args.device)
+        print(f"{'backend':<10}{'stage':<8}{'latency(ms)':>14}{'peak(MB)':>12}")
+        for backend, stages in results.items():
+            for i, (latency, peak) in enumerate(stages):
+                print(f"{backend:<10}{i + 1:<8}{latency:>14.2f}{peak:>12.1f}")
+    elif args.task == "window_layout":
+        results = benchmark_window_layout(args.model_name, args.batch_size, args.device)
+        print(f"{'layout':<11}{'stage':<7}{'moved(MB)':>11}{'latency(ms)':>14}{'peak(MB)':>12}")
+        for layout, stages in results.items():
+            for i, (moved, latency, peak) in enumerate(stages):
+                print(f"{layout:<11}{i + 1:<7}{moved:>11.1f}{latency:>14.2f}{peak:>12.1f}")
+    elif args.task == "neck_attention":
+        print(f"{'model':<7}{'tokens':>7}  {'backend':<10}{'latency(ms)':>14}{'peak(MB)':>12}")
+        for name in NECKS if args.model_name == "all" else [args.model_name]:
+            results = benchmark_neck_attention(name, args.batch_size, args.device)
+            for backend, (latency, peak) in results.items():
+                print(f"{name:<7}{NECKS[name][1]:>7}  {backend:<10}{latency:>14.2f}{peak:>12.1f}")
+    elif args.task == "det_only":
+        results = benchmark_det_only_blocks(args.model_name, args.batch_size, args.device)
+        print(f"{'det-only blocks':<17}{'neck latency(ms)':>18}{'peak(MB)':>12}")
+        for k, (latency, peak) in results.items():
+            print(f"{k:<17}{latency:>18.2f}{peak:>12.1f}")
+    elif args.task == "token_selection":
+        results = benchmark_token_selection(args.model_name, args.batch_size, args.device, args.keep_tokens)
+        print(f"{'kept tokens':<13}{'neck latency(ms)':>18}{'peak(MB)':>12}")
+        for k, (latency, peak) in results.items():
+            print(f"{k or 'all':<13}{latency:>18.2f}{peak:>12.1f}")
+    elif args.task == "token_merging":
+        results = benchmark_token_merging(args.model_name, args.batch_size, args.device, args.ratios)
+        print(f"{'ratio':<8}{'neck latency(ms)':>18}{'peak(MB)':>12}")
+        for ratio, (latency, peak) in results.items():
+            print(f"{ratio:<8.2f}{latency:>18.2f}{peak:>12.1f}")
+        if args.coco_path:
+            results = sweep_token_merging(args.model_name, args.coco_path, args.resume, args.ratios,
+                                          args.batch_size, args.device)
+            print(f"{'ratio':<8}{'AP':>8}{'ms/img':>10}")
+            for ratio, (ap, latency, _) in results.items():
+                print(f"{ratio:<8.2f}{ap:>8.3f}{latency:>10.1f}")
+    elif args.task == "sparse_neck":
+        print(f"{'model':<7}{'window':>7}{'neck latency(ms)':>18}{'peak(MB)':>12}")
+        for name in DETECTORS if args.model_name == "all" else [args.model_name]:
+            results = benchmark_sparse_neck(name, args.batch_size, args.device, args.windows)
+            for window, (latency, peak) in results.items():
+                print(f"{name:<7}{window:>7}{latency:>18.2f}{peak:>12.1f}")
+    elif args.task == "linear_attention":
+        results = benchmark_linear_attention(args.model_name, args.batch_size, args.device, args.tokens,
+                                             args.linear_blocks)
+        print(f"{'tokens':<8}{'linear blocks':>14}{'latency(ms)':>14}{'peak(MB)':>12}")
+        for (num_tokens, k), (latency, peak) in results.items():
+            print(f"{num_tokens:<8}{k:>14}{latency:>14.2f}{peak:>12.1f}")
+    elif args.task == "video":
+        results = benchmark_video(args.model_name, args.batch_size, args.device, args.thresholds or [0., .05],
+                                  args.frames)
+        print(f"{'threshold':<11}{'ms/frame':>10}{'recomputed windows':>20}")
+        for threshold, (latency, recomputed) in results.items():
+            name = "full" if threshold is None else f"{threshold:.3f}"
+            print(f"{name:<11}{latency:>10.1f}{recomputed:>20.1%}")
+    elif args.task == "matcher":
+        results = benchmark_matcher(args.batch_sizes, args.device, args.workers, args.max_targets)
+        print(f"{'batch':<7}{'matcher':<14}{'latency(ms)':>12}")
+        for (batch_size, name), latency in results.items():
+            name = name if name == "flattened" else f"block/{name} thr"
+            print(f"{batch_size:<7}{name:<14}{latency:>12.2f}")
+    elif args.task == "postprocess":
+        results = benchmark_postprocess(args.batch_sizes, args.device)
+        print(f"{'batch':<7}{'filtering':<11}{'latency(ms)':>12}")
+        for (batch_size, name), latency in results.items():
+            print(f"{batch_size:<7}{name:<11}{latency:>12.2f}")
+    elif args.task == "auction":
+        results = benchmark_auction(args.batch_sizes, args.device, args.max_targets, args.auction_eps)
+        print(f"{'batch':<7}{'solver':<10}{'latency(ms)':>12}")
+        for (batch_size, name), latency in results.items():
+            print(f"{batch_size:<7}{name:<10}{latency:>12.2f}")
+    elif args.task == "matching_cost":
+        results = benchmark_matching_cost(args.batch_size, args.device, args.max_targets, args.memory_mb)
+        print(f"{'cost':<10}{'latency(ms)':>12}{'peak(MB)':>12}")
+        for name, (latency, peak) in results.items():
+            name = name if name == "unfused" else f"{name:g}MB"
+            print(f"{name:<10}{latency:>12.2f}{peak:>12.1f}")
+    elif args.task == "paired_iou":
+        results = benchmark_paired_box_iou(args.pairs, args.device)
+        print(f"{'pairs':<8}{'giou':<10}{'latency(ms)':>12}{'peak(MB)':>12}")
+        for (num_pairs, name), (latency, peak) in results.items():
+            print(f"{num_pairs:<8}{name:<10}{latency:>12.3f}{peak:>12.1f}")
+    elif args.task == "early_exit":
+        args.thresholds = args.thresholds or [0., .5, .9]
+        results = benchmark_early_exit(args.model_name, args.batch_size, args.device, args.exit_blocks,
+                                       args.thresholds)
+        print(f"{'threshold':<11}{'neck latency(ms)':>18}{'peak(MB)':>12}  exit depth per image")
+        for threshold, (latency, peak, depth) in results.items():
+            print(f"{threshold:<11.2f}{latency:>18.2f}{peak:>12.1f}  {depth}")
+        if args.coco_path:
+            results = sweep_early_exit(args.model_name, args.coco_path, args.resume, args.exit_blocks,
+                                       args.thresholds, args.batch_size, args.device)
+            print(f"{'threshold':<11}{'AP':>8}{'ms/img':>10}{'depth':>8}")
+            for threshold, (ap, latency, stats) in results.items():
+                depth = f"{stats['exit_depth']:.2f}" if "exit_depth" in stats else "all"
+                print(f"{threshold:<11.2f}{ap:>8.3f}{latency:>10.1f}{depth:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("T-SSD micro benchmarks")
+    parser.add_argument("task", choices=["window_attention", "window_layout", "neck_attention", "det_only",
+                                         "token_selection", "token_merging", "sparse_neck", "linear_attention",
+                                         "video", "matcher", "postprocess", "auction", "matching_cost",
+                                         "paired_iou", "early_exit"])
+    parser.add_argument("--model_name", default="tiny", choices=list(ENCODERS) + ["all"],
+                        help="`all` runs every model size (neck_attention, sparse_neck)")
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--ratios", default=[0., .05, .1, .2], nargs="+", type=float,
+                        help="token merging ratios to sweep")
+    parser.add_argument("--keep_tokens", default=[0, 100, 300, 500], nargs="+", type=int,
+                        help="numbers of kept patch tokens to compare, 0 keeps all (token_selection)")
+    parser.add_argument("--windows", default=[3, 5], nargs="+", type=int,
+                        help="local windows of the sparse neck to compare with the dense one")
+    parser.add_argument("--tokens", default=[600, 1000, 2000, 3000, 4000], nargs="+", type=int,
+                        help="neck patch token counts (linear_attention)")
+    parser.add_argument("--linear_blocks", default=[0, 8, 12], nargs="+", type=int,
+                        help="numbers of leading linear neck blocks to compare (linear_attention)")
+    parser.add_argument("--batch_sizes", default=[2, 4, 8, 16, 32, 64], nargs="+", type=int,
+                        help="batch sizes (matcher, postprocess, auction)")
+    parser.add_argument("--workers", default=[0, 4], nargs="+", type=int,
+                        help="assignment threads to compare, 0 is serial (matcher)")
+    parser.add_argument("--max_targets", default=20, type=int,
+                        help="max targets per image (matcher, auction, matching_cost)")
+    parser.add_argument("--memory_mb", default=[0, 4, 64], nargs="+", type=float,
+                        help="memory budgets of the fused matching cost, 0 is one target per block")
+    parser.add_argument("--pairs", default=[100, 1000, 5000], nargs="+", type=int,
+                        help="numbers of matched box pairs (paired_iou)")
+    parser.add_argument("--auction_eps", default=1e-3, type=float, help="bid increment of the auction solver")
+    parser.add_argument("--exit_blocks", default=[4, 6, 8, 10], nargs="+", type=int,
+                        help="neck blocks followed by an exit (early_exit)")
+    parser.add_argument("--thresholds", default=None, nargs="+", type=float,
+                        help="early exit thresholds (default 0 0.5 0.9) / window change thresholds of the video "
+                             "reuse (default 0 0.05) to sweep")
+    parser.add_argument("--frames", default=8, type=int, help="frames of the synthetic stream (video)")
+    parser.add_argument("--coco_path", default="", help="also sweep COCO val AP (token_merging, early_exit)")
+    parser.add_argument("--resume", default="", help="trained checkpoint for the AP sweep")
+    main(parser.parse_args())
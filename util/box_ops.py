@@ -2,8 +2,9 @@
 """
 Utilities for bounding box manipulation and GIoU.
 """
+import math
+
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -20,18 +21,23 @@ def box_xyxy_to_cxcywh(x):
     return torch.stack(b, dim=-1)
 
 
-# modified from torchvision to also return the union
+def _area(boxes):
+    # box_area of torchvision for any number of leading dims
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+# modified from torchvision to also return the union, and to take batches of box sets ([..., N, 4], [..., M, 4])
 def box_iou(boxes1, boxes2):
-    area1 = box_area(boxes1)
-    area2 = box_area(boxes2)
+    area1 = _area(boxes1)
+    area2 = _area(boxes2)
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
@@ -44,23 +50,129 @@ def generalized_box_iou(boxes1, boxes2):
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2), [..., N, M] for batches of box sets
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+    assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
 
+# paired versions: box i of boxes1 with box i of boxes2 only ([..., N, 4], [..., N, 4] -> [..., N]), for the
+# matched pairs of the losses. O(N) instead of the diagonal of the [N, N] pairwise matrix, and no degenerate box
+# check (host sync), the boxes are expected in [x0, y0, x1, y1] format with x1 >= x0 and y1 >= y0
+def paired_box_iou(boxes1, boxes2):
+    lt = torch.max(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.min(boxes1[..., 2:], boxes2[..., 2:])
+
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[..., 0] * wh[..., 1]
+
+    union = _area(boxes1) + _area(boxes2) - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def _enclosing_wh(boxes1, boxes2):
+    lt = torch.min(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.max(boxes1[..., 2:], boxes2[..., 2:])
+    return (rb - lt).clamp(min=0)
+
+
+def paired_generalized_box_iou(boxes1, boxes2):
+    """ Generalized IoU of the box pairs, the diagonal of `generalized_box_iou` """
+    iou, union = paired_box_iou(boxes1, boxes2)
+    wh = _enclosing_wh(boxes1, boxes2)
+    area = wh[..., 0] * wh[..., 1]
+    return iou - (area - union) / area
+
+
+def _paired_diou_iou(boxes1, boxes2, eps):
+    iou, _ = paired_box_iou(boxes1, boxes2)
+    wh = _enclosing_wh(boxes1, boxes2)
+    diagonal_squared = wh[..., 0] ** 2 + wh[..., 1] ** 2 + eps
+    centers = (boxes1[..., :2] + boxes1[..., 2:]) / 2 - (boxes2[..., :2] + boxes2[..., 2:]) / 2
+    centers_squared = centers[..., 0] ** 2 + centers[..., 1] ** 2
+    return iou - centers_squared / diagonal_squared, iou
+
+
+def paired_distance_box_iou(boxes1, boxes2, eps=1e-7):
+    """ Distance IoU of the box pairs (https://arxiv.org/abs/1911.08287), the diagonal of
+    `torchvision.ops.distance_box_iou` """
+    return _paired_diou_iou(boxes1, boxes2, eps)[0]
+
+
+def paired_complete_box_iou(boxes1, boxes2, eps=1e-7):
+    """ Complete IoU of the box pairs (https://arxiv.org/abs/1911.08287), the diagonal of
+    `torchvision.ops.complete_box_iou` """
+    diou, iou = _paired_diou_iou(boxes1, boxes2, eps)
+    wh1, wh2 = boxes1[..., 2:] - boxes1[..., :2], boxes2[..., 2:] - boxes2[..., :2]
+    v = (4 / math.pi ** 2) * (torch.atan(wh1[..., 0] / wh1[..., 1]) - torch.atan(wh2[..., 0] / wh2[..., 1])) ** 2
+    with torch.no_grad():
+        alpha = v / (1 - iou + v + eps)
+    return diou - alpha * v
+
+
+def matching_cost(out_prob, out_bbox, tgt_ids, tgt_bbox, cost_class=1., cost_bbox=1., cost_giou=1.,
+                  max_bytes=256 * 2 ** 20):
+    """
+    Weighted matching cost -cost_class * prob[target class] + cost_bbox * L1 - cost_giou * GIoU between every
+    prediction and every target, the boxes being in [cx, cy, w, h] format.
+
+    The three terms are accumulated into the output block by block of targets, per coordinate and mostly in
+    place, so no [..., N, M, 2] / [..., N, M, 4] intermediate is built and the temporaries of a block hold at
+    most `max_bytes` (the output itself is not counted), whatever the number of targets.
+
+    Args:
+        out_prob: [..., N, num_classes] class probabilities
+        out_bbox: [..., N, 4] predicted boxes
+        tgt_ids: [..., M] target classes
+        tgt_bbox: [..., M, 4] target boxes
+    Returns:
+        [..., N, M] cost
+    """
+    N, M = out_bbox.shape[-2], tgt_bbox.shape[-2]
+    cost = out_bbox.new_empty(out_bbox.shape[:-1] + (M,))
+    if M == 0:
+        return cost
+    # a block keeps about 6 [..., N, block] temporaries alive
+    column_bytes = 6 * cost[..., :1].numel() * cost.element_size()
+    block = max(1, min(M, max_bytes // column_bytes))
+
+    p = out_bbox[..., :, None, :].unbind(-1)  # [..., N, 1] each
+    p_xyxy = box_cxcywh_to_xyxy(out_bbox)[..., :, None, :].unbind(-1)
+    p_area = _area(box_cxcywh_to_xyxy(out_bbox))[..., :, None]
+    for start in range(0, M, block):
+        end = min(M, start + block)
+        out = cost[..., start:end]
+        ids = tgt_ids[..., None, start:end].expand(out.shape)
+        torch.mul(out_prob.gather(-1, ids), -cost_class, out=out)
+
+        boxes = tgt_bbox[..., None, start:end, :]  # [..., 1, block, 4]
+        for a, b in zip(p, boxes.unbind(-1)):
+            out.add_((a - b).abs_(), alpha=cost_bbox)
+
+        (x0, y0, x1, y1), t_area = box_cxcywh_to_xyxy(boxes).unbind(-1), _area(box_cxcywh_to_xyxy(boxes))
+        inter = (torch.min(p_xyxy[2], x1) - torch.max(p_xyxy[0], x0)).clamp_(min=0)
+        inter.mul_((torch.min(p_xyxy[3], y1) - torch.max(p_xyxy[1], y0)).clamp_(min=0))
+        union = (p_area + t_area).sub_(inter)
+        enclosing = (torch.max(p_xyxy[2], x1) - torch.min(p_xyxy[0], x0)).clamp_(min=0)
+        enclosing.mul_((torch.max(p_xyxy[3], y1) - torch.min(p_xyxy[1], y0)).clamp_(min=0))
+        # giou = inter / union - (enclosing - union) / enclosing
+        out.sub_(inter.div_(union).sub_((enclosing - union).div_(enclosing)), alpha=cost_giou)
+    return cost
+
+
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
 
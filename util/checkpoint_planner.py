@@ -0,0 +1,138 @@
+"""
+Memory-budgeted activation checkpointing across the Swin encoder blocks and the DeiT neck blocks.
+
+A dry run measures, for every block, the bytes it saves for backward and the time it takes to recompute.
+The planner then picks the cheapest set of blocks to checkpoint so that the remaining activations fit the budget.
+"""
+import time
+
+import torch
+
+from models.encoder import SwinTransformerBlock
+from models.transformer import Block
+
+CHECKPOINTABLE = (SwinTransformerBlock, Block)
+
+
+def checkpointable_blocks(model):
+    return [(name, m) for name, m in model.named_modules() if isinstance(m, CHECKPOINTABLE)]
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def profile_blocks(model, samples):
+    """ Dry run of `model(samples)` with autograd on.
+
+    Returns:
+        {block name: {"act": bytes saved for backward, "input": bytes of the block input,
+                      "cost": forward seconds, i.e. the price of recomputing the block}}
+    """
+    blocks = checkpointable_blocks(model)
+    params = {p.data_ptr() for p in model.parameters()}
+    stats = {name: {"act": 0, "input": 0, "cost": 0.} for name, _ in blocks}
+    state = {"block": None, "seen": set(), "start": 0.}
+    cuda = next(model.parameters()).is_cuda
+
+    def pre_hook(name):
+        def hook(module, inputs):
+            if cuda:
+                torch.cuda.synchronize()
+            state["block"], state["seen"], state["start"] = name, set(), time.perf_counter()
+            stats[name]["input"] = sum(_nbytes(t) for t in inputs if isinstance(t, torch.Tensor))
+        return hook
+
+    def post_hook(name):
+        def hook(module, inputs, output):
+            if cuda:
+                torch.cuda.synchronize()
+            stats[name]["cost"] = time.perf_counter() - state["start"]
+            state["block"] = None
+        return hook
+
+    def pack(t):
+        # tensors saved by several ops (or weights) are only stored once / are not activations
+        key = (t.data_ptr(), t.numel())
+        if state["block"] is not None and t.data_ptr() not in params and key not in state["seen"]:
+            state["seen"].add(key)
+            stats[state["block"]]["act"] += _nbytes(t)
+        return t
+
+    handles = []
+    for name, m in blocks:
+        m.use_checkpoint = False
+        handles.append(m.register_forward_pre_hook(pre_hook(name)))
+        handles.append(m.register_forward_hook(post_hook(name)))
+    was_training = model.training
+    model.train()
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            model(samples)
+    finally:
+        for h in handles:
+            h.remove()
+        model.train(was_training)
+    return stats
+
+
+def plan_checkpoints(stats, budget, scale=1.):
+    """ Cheapest set of blocks to recompute so that the stored activations fit in `budget` bytes.
+
+    A checkpointed block still keeps its input, so it frees `act - input`. This is a min-cost cover, solved
+    exactly by dynamic programming over the freed memory in MiB (rounded down, so the plan never undershoots).
+
+    Args:
+        stats: output of `profile_blocks`
+        budget (int): activation budget in bytes
+        scale (float): multiplier of the profiled bytes, e.g. batch_size / profiled batch size
+    Returns:
+        (names of the blocks to checkpoint, estimated activation bytes with the plan)
+    """
+    names = list(stats)
+    act = {n: stats[n]["act"] * scale for n in names}
+    free = {n: max(0., act[n] - stats[n]["input"] * scale) for n in names}
+    total = sum(act.values())
+    if total <= budget:
+        return [], total
+
+    unit = 2 ** 20
+    need = int(-(-(total - budget) // unit))
+    gain = [int(free[n] // unit) for n in names]
+    if sum(gain) < need:
+        print(f"checkpoint planner: {total / unit:.0f}MiB of activations cannot fit {budget / unit:.0f}MiB, "
+              f"checkpointing every block")
+        return names, total - sum(free.values())
+
+    # best[j]: (cost, picked) of the cheapest set freeing at least j units
+    inf = float("inf")
+    best = [(0., ())] + [(inf, ())] * need
+    for i, n in enumerate(names):
+        if gain[i] == 0:
+            continue
+        cost = stats[n]["cost"]
+        for j in range(need, 0, -1):
+            prev = best[max(0, j - gain[i])]
+            if prev[0] + cost < best[j][0]:
+                best[j] = (prev[0] + cost, prev[1] + (i,))
+    picked = [names[i] for i in best[need][1]]
+    return picked, total - sum(free[n] for n in picked)
+
+
+def apply_checkpoint_plan(model, picked):
+    picked = set(picked)
+    for name, m in checkpointable_blocks(model):
+        m.use_checkpoint = name in picked
+
+
+def plan_for_budget(model, samples, budget, batch_size=None):
+    """ Profiles `model` on `samples`, plans for `budget` bytes at `batch_size` and applies the plan """
+    stats = profile_blocks(model, samples)
+    scale = (batch_size or len(samples)) / len(samples)
+    picked, estimate = plan_checkpoints(stats, budget, scale=scale)
+    apply_checkpoint_plan(model, picked)
+    total = sum(s["act"] for s in stats.values()) * scale
+    print(f"checkpoint planner: {len(picked)}/{len(stats)} blocks recomputed, "
+          f"activations {total / 2 ** 20:.0f}MiB -> {estimate / 2 ** 20:.0f}MiB "
+          f"(budget {budget / 2 ** 20:.0f}MiB)")
+    return picked
@@ -0,0 +1,88 @@
+"""
+Inference-time pruning of the det tokens by their usage.
+
+A calibration pass runs the Hungarian matcher of the criterion over a dataset and counts, per det slot, how often
+the slot is matched to a ground truth box. The slots that are (almost) never matched only produce "no object"
+predictions, so the pruned detector keeps the top-N slots, slicing `det_token` and the det part of `pos_embed`.
+The neck cost scales with the sequence length, so this also saves the attention over the dropped slots.
+
+    python -m util.det_token_pruning --model_name tiny --coco_path /path/to/coco \\
+        --resume checkpoint.pth --keep_det 50 --prune_output pruned.pth
+
+The pruned checkpoint is loaded with `--det_token_num 50 --resume pruned.pth`.
+"""
+import argparse
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+import util.misc as utils
+
+
+@torch.no_grad()
+def det_slot_usage(model, matcher, data_loader, device, max_images=0):
+    """ Number of ground truth boxes matched to every det slot over `data_loader` (the first `max_images`) """
+    model.eval()
+    counts = torch.zeros(model.backbone.det_token_num, dtype=torch.long)
+    seen = 0
+    for samples, targets in data_loader:
+        samples = samples.to(device)
+        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        outputs = model(samples)
+        for src, _ in matcher(outputs, targets):
+            counts += torch.bincount(src.cpu(), minlength=len(counts))
+        seen += len(targets)
+        if max_images and seen >= max_images:
+            break
+    return counts
+
+
+def most_used_slots(counts, keep):
+    """ Indices of the `keep` most matched slots, in their original order """
+    return counts.topk(keep).indices.sort().values
+
+
+def main(args):
+    from main import set_input_size
+    from models import build_model
+    from datasets import build_dataset
+
+    set_input_size(args)
+    device = torch.device(args.device)
+    model, criterion, _ = build_model(args)
+    # checkpoints of main.py also pickle the argparse Namespace
+    model.load_state_dict(torch.load(args.resume, map_location="cpu", weights_only=False)["model"])
+    model.to(device)
+    if args.keep_det >= model.backbone.det_token_num:
+        raise ValueError(f"--keep_det {args.keep_det} keeps all the {model.backbone.det_token_num} det tokens")
+
+    dataset = build_dataset(image_set=args.calib_set, args=args)
+    data_loader = DataLoader(dataset, args.batch_size, sampler=SequentialSampler(dataset), drop_last=False,
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    counts = det_slot_usage(model, criterion.matcher, data_loader, device, max_images=args.calib_images)
+    keep = most_used_slots(counts, args.keep_det)
+    print(f"det slots: {counts.sum().item()} matches, kept {len(keep)}/{len(counts)} slots "
+          f"cover {counts[keep].sum().item() / max(1, counts.sum().item()):.2%} of them")
+
+    model.backbone.prune_det_tokens(keep)
+    args.det_token_num = len(keep)
+    utils.save_on_master({
+        'model': model.state_dict(),
+        'args': args,
+        'det_slot_usage': counts,
+        'det_slots': keep.cpu(),
+    }, args.prune_output)
+    print(f"pruned detector saved to {args.prune_output}")
+
+
+if __name__ == '__main__':
+    from main import get_args_parser
+
+    parser = argparse.ArgumentParser('Det token pruning', parents=[get_args_parser()])
+    parser.add_argument('--keep_det', type=int, required=True, help='number of det tokens to keep')
+    parser.add_argument('--prune_output', default='pruned.pth', help='path of the pruned checkpoint')
+    parser.add_argument('--calib_set', default='train', choices=['train', 'val'],
+                        help='dataset split the slot usage is measured on')
+    parser.add_argument('--calib_images', type=int, default=0,
+                        help='number of calibration images, 0 for the whole split')
+    main(parser.parse_args())
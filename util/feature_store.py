@@ -0,0 +1,106 @@
+"""
+Memory-mapped store of the pooled multi-scale encoder tokens, for training the neck and heads on a frozen encoder.
+
+Every (image id, augmentation variant) owns one row in each per-scale memmap. The first epoch fills the rows as
+they come, later epochs read them back instead of running the encoder. The only random augmentation of the
+training pipeline is the horizontal flip, so the variant is the `flipped` flag recorded by
+`datasets.transforms.RandomHorizontalFlip`; resizing must be deterministic (a fixed square size).
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+import util.misc as utils
+
+NUM_VARIANTS = 2  # not flipped / flipped
+
+
+def variant_of(target):
+    return int(target["flipped"]) if "flipped" in target else 0
+
+
+class FeatureStore(object):
+    """
+    Args:
+        root (str): directory of the memmaps, shared by all processes
+        image_ids (list[int]): image ids of the dataset
+        shapes (list[tuple[int]]): (num_tokens, dim) of every encoder scale
+        tag (str): fingerprint of the encoder and input setting, a store written with another tag is reset
+        dtype (str): storage dtype, float16 halves the disk and I/O footprint
+        num_variants (int): augmentation variants per image
+    """
+
+    def __init__(self, root, image_ids, shapes, tag="", dtype="float32", num_variants=NUM_VARIANTS):
+        self.root = root
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtype = np.dtype(dtype)
+        self.num_variants = num_variants
+        self.row_of = {int(i): r for r, i in enumerate(image_ids)}
+        self.num_rows = len(self.row_of) * num_variants
+
+        meta = {"tag": tag, "shapes": [list(s) for s in self.shapes], "dtype": self.dtype.name,
+                "rows": self.num_rows}
+        if utils.is_main_process():
+            os.makedirs(root, exist_ok=True)
+            if self._read_meta() != meta:
+                self._create(meta)
+        if utils.is_dist_avail_and_initialized():
+            torch.distributed.barrier()
+
+        self.valid = np.memmap(self._path("valid.bin"), dtype=np.uint8, mode="r+", shape=(self.num_rows,))
+        self.scales = [np.memmap(self._path(f"scale{i}.bin"), dtype=self.dtype, mode="r+",
+                                 shape=(self.num_rows,) + shape) if np.prod(shape) > 0 else None
+                       for i, shape in enumerate(self.shapes)]
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _read_meta(self):
+        try:
+            with open(self._path("meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _create(self, meta):
+        print(f"feature store: creating {self.num_rows} rows in {self.root}")
+        np.memmap(self._path("valid.bin"), dtype=np.uint8, mode="w+", shape=(self.num_rows,)).flush()
+        for i, shape in enumerate(self.shapes):
+            if np.prod(shape) > 0:
+                np.memmap(self._path(f"scale{i}.bin"), dtype=self.dtype, mode="w+",
+                          shape=(self.num_rows,) + shape).flush()
+        # written last, an interrupted creation is redone on the next start
+        with open(self._path("meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def rows(self, targets):
+        return [self.row_of[int(t["image_id"])] * self.num_variants + variant_of(t) for t in targets]
+
+    def get(self, rows, device):
+        """ Token lists of `rows` as float32 tensors on `device`, None unless every row has been stored """
+        if not self.valid[rows].all():
+            return None
+        features = []
+        for shape, scale in zip(self.shapes, self.scales):
+            if scale is None:
+                features.append(torch.zeros((len(rows),) + shape, device=device))
+            else:
+                features.append(torch.from_numpy(scale[rows]).to(device, torch.float32, non_blocking=True))
+        return features
+
+    def put(self, rows, features):
+        for scale, t in zip(self.scales, features):
+            if scale is not None:
+                scale[rows] = t.detach().cpu().numpy().astype(self.dtype)
+        self.valid[rows] = 1
+
+    def flush(self):
+        for scale in self.scales:
+            if scale is not None:
+                scale.flush()
+        self.valid.flush()
+
+    def filled(self):
+        return int(self.valid.sum()) / max(1, self.num_rows)
@@ -0,0 +1,16 @@
+from util.benchmark import sweep_token_merging, sweep_early_exit
+
+
+def test_token_merging_sweep_runs_on_a_tiny_checkpoint(coco_path, tiny_checkpoint):
+    results = sweep_token_merging("tiny", str(coco_path), str(tiny_checkpoint), ratios=[0., .1])
+    assert list(results) == [0., .1]
+    for ap, latency, stats in results.values():
+        assert len(stats["coco_eval_bbox"]) == 12 and latency > 0
+
+
+def test_early_exit_sweep_runs_on_a_tiny_checkpoint(coco_path, tiny_checkpoint):
+    results = sweep_early_exit("tiny", str(coco_path), str(tiny_checkpoint), exit_blocks=[4, 8],
+                               thresholds=[0., .5])
+    assert list(results) == [0., .5]
+    assert "exit_depth" not in results[0.][2]
+    assert 4 <= results[.5][2]["exit_depth"] <= 12
@@ -0,0 +1,30 @@
+import pytest
+import torch
+import torchvision.ops
+
+from util import box_ops
+from util.benchmark import random_box_pairs
+
+PAIRS = {
+    "iou": (lambda a, b: box_ops.paired_box_iou(a, b)[0], lambda a, b: box_ops.box_iou(a, b)[0]),
+    "giou": (box_ops.paired_generalized_box_iou, box_ops.generalized_box_iou),
+    "diou": (box_ops.paired_distance_box_iou, torchvision.ops.distance_box_iou),
+    "ciou": (box_ops.paired_complete_box_iou, torchvision.ops.complete_box_iou),
+}
+
+
+@pytest.mark.parametrize("name", list(PAIRS))
+def test_paired_ious_match_the_pairwise_diagonal(name):
+    paired, pairwise = PAIRS[name]
+    boxes1, boxes2 = random_box_pairs(300)
+    assert (paired(boxes1, boxes2) - torch.diag(pairwise(boxes1, boxes2))).abs().max().item() < 1e-6
+
+
+def test_paired_giou_loss_gradient():
+    boxes1, boxes2 = random_box_pairs(300)
+    grads = []
+    for fn in (box_ops.paired_generalized_box_iou, lambda a, b: torch.diag(box_ops.generalized_box_iou(a, b))):
+        src = boxes1.clone().requires_grad_()
+        (1 - fn(src, boxes2)).sum().backward()
+        grads.append(src.grad)
+    assert (grads[0] - grads[1]).abs().max().item() < 1e-6
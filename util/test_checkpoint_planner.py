@@ -0,0 +1,43 @@
+import itertools
+
+import torch
+
+from models.detector import swin_ssd_tiny
+from util.checkpoint_planner import profile_blocks, plan_checkpoints, apply_checkpoint_plan
+
+
+def test_planned_model_fits_the_budget_and_keeps_the_gradients(budget_ratio=.5):
+    model = swin_ssd_tiny().eval()
+    x = torch.randn(1, 3, 672, 672)
+    stats = profile_blocks(model, x)
+    total = sum(s["act"] for s in stats.values())
+    picked, estimate = plan_checkpoints(stats, int(total * budget_ratio))
+    assert picked and estimate <= total * budget_ratio, f"plan keeps {estimate} of {total} activation bytes"
+
+    grads = []
+    for plan in ([], picked):
+        apply_checkpoint_plan(model, plan)
+        model.zero_grad()
+        out = model(x)
+        (out["pred_logits"].sum() + out["pred_boxes"].sum()).backward()
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+    assert len(grads[0]) == len(grads[1])
+    assert max((a - b).abs().max().item() for a, b in zip(*grads)) < 1e-5
+
+
+def test_plan_is_the_cheapest_feasible_set(num_blocks=10):
+    """ Brute force over every subset of random block stats """
+    g = torch.Generator().manual_seed(0)
+    unit = 2 ** 20
+    stats = {f"block{i}": {"act": int(a) * unit, "input": int(i_) * unit, "cost": c}
+             for i, (a, i_, c) in enumerate(zip(torch.randint(4, 64, (num_blocks,), generator=g),
+                                                torch.randint(0, 4, (num_blocks,), generator=g),
+                                                torch.rand(num_blocks, generator=g).tolist()))}
+    total = sum(s["act"] for s in stats.values())
+    budget = total // 2
+    picked, estimate = plan_checkpoints(stats, budget)
+    best = min((sum(stats[n]["cost"] for n in subset), subset)
+               for k in range(num_blocks + 1) for subset in itertools.combinations(stats, k)
+               if total - sum(stats[n]["act"] - stats[n]["input"] for n in subset) <= budget)
+    assert estimate <= budget and abs(sum(stats[n]["cost"] for n in picked) - best[0]) < 1e-9, \
+        f"plan {picked} is not the cheapest feasible set {best[1]}"
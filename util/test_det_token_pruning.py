@@ -0,0 +1,34 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import torch
+
+from util.det_token_pruning import most_used_slots
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_most_used_slots_keeps_the_original_order():
+    counts = torch.tensor([5, 0, 9, 1, 7])
+    assert most_used_slots(counts, 3).tolist() == [0, 2, 4]
+
+
+def test_cli_prunes_a_tiny_checkpoint(coco_path, tiny_checkpoint, tmp_path):
+    output = tmp_path / "pruned.pth"
+    subprocess.run([sys.executable, "-m", "util.det_token_pruning", "--model_name", "tiny", "--device", "cpu",
+                    "--coco_path", str(coco_path), "--resume", str(tiny_checkpoint), "--keep_det", "60",
+                    "--calib_set", "val", "--batch_size", "1", "--prune_output", str(output)],
+                   cwd=ROOT, check=True)
+
+    checkpoint = torch.load(output, map_location="cpu", weights_only=False)
+    assert checkpoint["args"].det_token_num == 60
+    assert len(checkpoint["det_slots"]) == 60
+    assert checkpoint["det_slot_usage"].sum() == 2  # one box per image
+
+    from main import get_args_parser, set_input_size
+    from models import build_model
+    args = get_args_parser().parse_args(["--model_name", "tiny", "--device", "cpu", "--det_token_num", "60"])
+    set_input_size(args)
+    model, _, _ = build_model(args)
+    model.load_state_dict(checkpoint["model"])